@@ -12,6 +12,8 @@ import matplotlib.pyplot as plt
 import matplotlib.style as style
 
 from matplotlib import gridspec
+from galaxy_catalogue import GalaxyCatalogue
+from morpho_kinematics import MorphoKinematic
 
 style.use("classic")
 plt.rcParams.update({'font.family':'serif'})
@@ -35,13 +37,14 @@ class DiscToTotalCRVsDiscToTotal:
         # Load the data #
         start_local_time = time.time()  # Start the local time.
 
-        glx_disc_fractions_IT20 = np.load(data_path + 'glx_disc_fractions_IT20.npy')
-        glx_disc_fractions_IT20_cr = np.load(data_path + 'glx_disc_fractions_IT20_cr_all.npy')
+        catalogue = GalaxyCatalogue(data_path + 'galaxy_catalogue.hdf5')
+        glx_disc_fractions_IT20 = catalogue.load('glx_disc_fractions_IT20')
+        glx_disc_fractions_IT20_cr = catalogue.load('glx_disc_fractions_IT20_cr_all')
 
         # Normalise the disc fractions #
-        chi = 0.5 * (1 - np.cos(np.pi / 6))
+        chi = MorphoKinematic.isotropic_disc_fraction(MorphoKinematic.disc_angle)
         glx_disc_fractions_IT20 = np.divide(1, 1 - chi) * (glx_disc_fractions_IT20 - chi)
-        chi = (1 - np.cos(np.pi / 6))
+        chi = 2 * MorphoKinematic.isotropic_disc_fraction(MorphoKinematic.disc_angle)  # Co- and counter-rotating cones.
         glx_disc_fractions_IT20_cr = np.divide(1, 1 - chi) * (glx_disc_fractions_IT20_cr - chi)
         print('Loaded data for ' + re.split('Planck1/|/PE', simulation_path)[1] + ' in %.4s s' % (time.time() - start_local_time))
         print('–––––––––––––––––––––––––––––––––––––––––––––')
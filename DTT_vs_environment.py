@@ -12,6 +12,8 @@ import matplotlib.pyplot as plt
 import matplotlib.style as style
 
 from matplotlib import gridspec
+from galaxy_catalogue import GalaxyCatalogue
+from morpho_kinematics import MorphoKinematic
 
 style.use("classic")
 plt.rcParams.update({'font.family':'serif'})
@@ -36,16 +38,17 @@ class DTTVsEnvironment:
         # Load the data #
         start_local_time = time.time()  # Start the local time.
 
-        group_numbers = np.load(data_path + 'group_numbers.npy')
-        subgroup_numbers = np.load(data_path + 'subgroup_numbers.npy')
-        glx_disc_fractions_IT20 = np.load(data_path + 'glx_disc_fractions_IT20.npy')
-        glx_stellar_angular_momenta = np.load(data_path + 'glx_stellar_angular_momenta.npy')
-        glx_gaseous_angular_momenta = np.load(data_path + 'glx_gaseous_angular_momenta.npy')
-        disc_stellar_angular_momenta = np.load(data_path + 'disc_stellar_angular_momenta.npy')
-        spheroid_stellar_angular_momenta = np.load(data_path + 'spheroid_stellar_angular_momenta.npy')
+        catalogue = GalaxyCatalogue(data_path + 'galaxy_catalogue.hdf5')
+        group_numbers = catalogue.load('group_numbers')
+        subgroup_numbers = catalogue.load('subgroup_numbers')
+        glx_disc_fractions_IT20 = catalogue.load('glx_disc_fractions_IT20')
+        glx_stellar_angular_momenta = catalogue.load('glx_stellar_angular_momenta')
+        glx_gaseous_angular_momenta = catalogue.load('glx_gaseous_angular_momenta')
+        disc_stellar_angular_momenta = catalogue.load('disc_stellar_angular_momenta')
+        spheroid_stellar_angular_momenta = catalogue.load('spheroid_stellar_angular_momenta')
 
         # Normalise the disc fractions #
-        chi = 0.5 * (1 - np.cos(np.pi / 6))
+        chi = MorphoKinematic.isotropic_disc_fraction(MorphoKinematic.disc_angle)
         glx_disc_fractions_IT20 = np.divide(1, 1 - chi) * (glx_disc_fractions_IT20 - chi)
         print('Loaded data for ' + re.split('Planck1/|/PE', simulation_path)[1] + ' in %.4s s' % (time.time() - start_local_time))
         print('–––––––––––––––––––––––––––––––––––––––––––––')
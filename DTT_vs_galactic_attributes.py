@@ -12,6 +12,8 @@ import matplotlib.pyplot as plt
 import matplotlib.style as style
 
 from matplotlib import gridspec
+from galaxy_catalogue import GalaxyCatalogue
+from morpho_kinematics import MorphoKinematic
 
 style.use("classic")
 plt.rcParams.update({'font.family':'serif'})
@@ -35,14 +37,15 @@ class DiscToTotalVsGalacticAttributes:
         # Load the data #
         start_local_time = time.time()  # Start the local time.
 
-        glx_gaseous_masses = np.load(data_path + 'glx_gaseous_masses.npy')
-        glx_stellar_masses = np.load(data_path + 'glx_stellar_masses.npy')
-        glx_disc_fractions_IT20 = np.load(data_path + 'glx_disc_fractions_IT20.npy')
-        glx_star_formation_rates = np.load(data_path + 'glx_star_formation_rates.npy')
-        glx_stellar_angular_momenta = np.load(data_path + 'glx_stellar_angular_momenta.npy')
+        catalogue = GalaxyCatalogue(data_path + 'galaxy_catalogue.hdf5')
+        glx_gaseous_masses = catalogue.load('glx_gaseous_masses')
+        glx_stellar_masses = catalogue.load('glx_stellar_masses')
+        glx_disc_fractions_IT20 = catalogue.load('glx_disc_fractions_IT20')
+        glx_star_formation_rates = catalogue.load('glx_star_formation_rates')
+        glx_stellar_angular_momenta = catalogue.load('glx_stellar_angular_momenta')
 
         # Normalise the disc fractions #
-        chi = 0.5 * (1 - np.cos(np.pi / 6))
+        chi = MorphoKinematic.isotropic_disc_fraction(MorphoKinematic.disc_angle)
         glx_disc_fractions_IT20 = np.divide(1, 1 - chi) * (glx_disc_fractions_IT20 - chi)
         print('Loaded data for ' + re.split('Planck1/|/PE', simulation_path)[1] + ' in %.4s s' % (time.time() - start_local_time))
         print('–––––––––––––––––––––––––––––––––––––––––––––')
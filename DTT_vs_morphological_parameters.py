@@ -12,6 +12,8 @@ import matplotlib.pyplot as plt
 import matplotlib.style as style
 
 from matplotlib import gridspec
+from galaxy_catalogue import GalaxyCatalogue
+from morpho_kinematics import MorphoKinematic
 
 style.use("classic")
 plt.rcParams.update({'font.family':'serif'})
@@ -36,14 +38,15 @@ class DiscToTotalVsMorphologicalParameters:
         # Load the data #
         start_local_time = time.time()  # Start the local time.
 
-        glx_disc_fractions = np.load(data_path + 'glx_disc_fractions.npy')
-        glx_circularities = np.load(data_path + 'glx_circularities.npy')
-        glx_kappas_corotation = np.load(data_path + 'glx_kappas_corotation.npy')
-        glx_disc_fractions_IT20 = np.load(data_path + 'glx_disc_fractions_IT20.npy')
-        glx_rotationals_over_dispersions = np.load(data_path + 'glx_rotationals_over_dispersions.npy')
+        catalogue = GalaxyCatalogue(data_path + 'galaxy_catalogue.hdf5')
+        glx_disc_fractions = catalogue.load('glx_disc_fractions')
+        glx_circularities = catalogue.load('glx_circularities')
+        glx_kappas_corotation = catalogue.load('glx_kappas_corotation')
+        glx_disc_fractions_IT20 = catalogue.load('glx_disc_fractions_IT20')
+        glx_rotationals_over_dispersions = catalogue.load('glx_rotationals_over_dispersions')
 
         # Normalise the disc fractions #
-        chi = 0.5 * (1 - np.cos(np.pi / 6))
+        chi = MorphoKinematic.isotropic_disc_fraction(MorphoKinematic.disc_angle)
         glx_disc_fractions_IT20 = np.divide(1, 1 - chi) * (glx_disc_fractions_IT20 - chi)
         print('Loaded data for ' + re.split('Planck1/|/PE', simulation_path)[1] + ' in %.4s s' % (time.time() - start_local_time))
         print('–––––––––––––––––––––––––––––––––––––––––––––')
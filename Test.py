@@ -9,7 +9,7 @@ import matplotlib
 matplotlib.use('Agg')
 
 import numpy as np
-import healpy as hlp
+import healpix_tools
 import seaborn as sns
 import matplotlib.cbook
 import astropy.units as u
@@ -284,11 +284,7 @@ class RAEl:
         densities = np.bincount(indices, minlength=hp.npix)  # Count number of points in each HEALPix grid cell.
 
         # Perform a top-hat smoothing on the densities #
-        smoothed_densities = np.zeros(hp.npix)
-        # Loop over all grid cells #
-        for i in range(hp.npix):
-            mask = hlp.query_disc(nside, hlp.pix2vec(nside, i), np.pi / 6.0)  # Do a 30degree cone search around each grid cell.
-            smoothed_densities[i] = np.mean(densities[mask])  # Average the densities of the ones inside and assign this value to the grid cell.
+        smoothed_densities = healpix_tools.smooth(densities, nside)  # Average the densities within a 30degree cone around each grid cell.
 
         # Find the location of the density maximum and plot its positions and the ra and el of the galactic angular momentum #
         index_densest = np.argmax(smoothed_densities)
@@ -12,6 +12,8 @@ import matplotlib.pyplot as plt
 import matplotlib.style as style
 
 from matplotlib import gridspec
+from galaxy_catalogue import GalaxyCatalogue
+from morpho_kinematics import MorphoKinematic
 
 style.use("classic")
 plt.rcParams.update({'font.family':'serif'})
@@ -35,17 +37,18 @@ class TullyFisherFaberJackson:
         # Load the data #
         start_local_time = time.time()  # Start the local time.
 
-        glx_sigma_0s = np.load(data_path + 'glx_sigma_0s_re.npy')
-        disc_sigma_0s = np.load(data_path + 'disc_sigma_0s_re.npy')
-        spheroid_sigma_0s = np.load(data_path + 'spheroid_sigma_0s_re.npy')
-        glx_rotationals = np.load(data_path + 'glx_rotationals.npy')
-        disc_rotationals = np.load(data_path + 'disc_rotationals.npy')
-        spheroid_rotationals = np.load(data_path + 'spheroid_rotationals.npy')
-        glx_stellar_masses = np.load(data_path + 'glx_stellar_masses.npy')
-        glx_disc_fractions_IT20 = np.load(data_path + 'glx_disc_fractions_IT20.npy')
+        catalogue = GalaxyCatalogue(data_path + 'galaxy_catalogue.hdf5')
+        glx_sigma_0s = catalogue.load('glx_sigma_0s_re')
+        disc_sigma_0s = catalogue.load('disc_sigma_0s_re')
+        spheroid_sigma_0s = catalogue.load('spheroid_sigma_0s_re')
+        glx_rotationals = catalogue.load('glx_rotationals')
+        disc_rotationals = catalogue.load('disc_rotationals')
+        spheroid_rotationals = catalogue.load('spheroid_rotationals')
+        glx_stellar_masses = catalogue.load('glx_stellar_masses')
+        glx_disc_fractions_IT20 = catalogue.load('glx_disc_fractions_IT20')
 
         # Normalise the disc fractions #
-        chi = 0.5 * (1 - np.cos(np.pi / 6))
+        chi = MorphoKinematic.isotropic_disc_fraction(MorphoKinematic.disc_angle)
         glx_disc_fractions_IT20 = np.divide(1, 1 - chi) * (glx_disc_fractions_IT20 - chi)
         print('Loaded data for ' + re.split('Planck1/|/PE', simulation_path)[1] + ' in %.4s s' % (time.time() - start_local_time))
         print('–––––––––––––––––––––––––––––––––––––––––––––')
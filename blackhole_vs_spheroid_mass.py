@@ -9,6 +9,8 @@ import numpy as np
 import matplotlib.cbook
 import matplotlib.pyplot as plt
 import matplotlib.style as style
+from galaxy_catalogue import GalaxyCatalogue
+from morpho_kinematics import MorphoKinematic
 
 style.use("classic")
 plt.rcParams.update({'font.family':'serif'})
@@ -32,12 +34,13 @@ class BlackholeVsSpheroidMass:
         # Load the data #
         start_local_time = time.time()  # Start the local time.
 
-        bh_masses = np.load(data_path + 'bh_masses.npy')
-        glx_stellar_masses = np.load(data_path + 'glx_stellar_masses.npy')
-        glx_disc_fractions_IT20 = np.load(data_path + 'glx_disc_fractions_IT20.npy')
+        catalogue = GalaxyCatalogue(data_path + 'galaxy_catalogue.hdf5')
+        bh_masses = catalogue.load('bh_masses')
+        glx_stellar_masses = catalogue.load('glx_stellar_masses')
+        glx_disc_fractions_IT20 = catalogue.load('glx_disc_fractions_IT20')
 
         # Normalise the disc fractions #
-        chi = 0.5 * (1 - np.cos(np.pi / 6))
+        chi = MorphoKinematic.isotropic_disc_fraction(MorphoKinematic.disc_angle)
         glx_disc_fractions_IT20 = np.divide(1, 1 - chi) * (glx_disc_fractions_IT20 - chi)
         print('Loaded data for ' + re.split('Planck1/|/PE', simulation_path)[1] + ' in %.4s s' % (time.time() - start_local_time))
         print('–––––––––––––––––––––––––––––––––––––––––––––')
@@ -12,6 +12,8 @@ import matplotlib.pyplot as plt
 import matplotlib.style as style
 
 from matplotlib import gridspec
+from galaxy_catalogue import GalaxyCatalogue
+from morpho_kinematics import MorphoKinematic
 
 style.use("classic")
 plt.rcParams.update({'font.family':'serif'})
@@ -35,15 +37,16 @@ class ComponentAgeMetallicityVsMass:
         # Load the data #
         start_local_time = time.time()  # Start the local time.
 
-        disc_weighted_as = np.load(data_path + 'disc_weighted_as.npy')
-        spheroid_weighted_as = np.load(data_path + 'spheroid_weighted_as.npy')
-        glx_stellar_masses = np.load(data_path + 'glx_stellar_masses.npy')
-        disc_metallicities = np.load(data_path + 'disc_metallicities.npy')
-        spheroid_metallicities = np.load(data_path + 'spheroid_metallicities.npy')
-        glx_disc_fractions_IT20 = np.load(data_path + 'glx_disc_fractions_IT20.npy')
+        catalogue = GalaxyCatalogue(data_path + 'galaxy_catalogue.hdf5')
+        disc_weighted_as = catalogue.load('disc_weighted_as')
+        spheroid_weighted_as = catalogue.load('spheroid_weighted_as')
+        glx_stellar_masses = catalogue.load('glx_stellar_masses')
+        disc_metallicities = catalogue.load('disc_metallicities')
+        spheroid_metallicities = catalogue.load('spheroid_metallicities')
+        glx_disc_fractions_IT20 = catalogue.load('glx_disc_fractions_IT20')
 
         # Normalise the disc fractions #
-        chi = 0.5 * (1 - np.cos(np.pi / 6))
+        chi = MorphoKinematic.isotropic_disc_fraction(MorphoKinematic.disc_angle)
         glx_disc_fractions_IT20 = np.divide(1, 1 - chi) * (glx_disc_fractions_IT20 - chi)
         print('Loaded data for ' + re.split('Planck1/|/PE', simulation_path)[1] + ' in %.4s s' % (time.time() - start_local_time))
         print('–––––––––––––––––––––––––––––––––––––––––––––')
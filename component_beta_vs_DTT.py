@@ -10,6 +10,8 @@ import numpy as np
 import matplotlib.cbook
 import matplotlib.pyplot as plt
 import matplotlib.style as style
+from galaxy_catalogue import GalaxyCatalogue
+from morpho_kinematics import MorphoKinematic
 
 style.use("classic")
 plt.rcParams.update({'font.family':'serif'})
@@ -33,11 +35,12 @@ class ComponentBetaVsDTT:
         # Load the data #
         start_local_time = time.time()  # Start the local time.
 
-        spheroid_deltas = np.load(data_path + 'spheroid_betas.npy')
-        glx_disc_fractions_IT20 = np.load(data_path + 'glx_disc_fractions_IT20.npy')
+        catalogue = GalaxyCatalogue(data_path + 'galaxy_catalogue.hdf5')
+        spheroid_deltas = catalogue.load('spheroid_betas')
+        glx_disc_fractions_IT20 = catalogue.load('glx_disc_fractions_IT20')
 
         # Normalise the disc fractions #
-        chi = 0.5 * (1 - np.cos(np.pi / 6))
+        chi = MorphoKinematic.isotropic_disc_fraction(MorphoKinematic.disc_angle)
         glx_disc_fractions_IT20 = np.divide(1, 1 - chi) * (glx_disc_fractions_IT20 - chi)
         print('Loaded data for ' + re.split('Planck1/|/PE', simulation_path)[1] + ' in %.4s s' % (time.time() - start_local_time))
         print('–––––––––––––––––––––––––––––––––––––––––––––')
@@ -0,0 +1,19 @@
+import os
+
+
+def atomic_write(file_name, write):
+    """
+    Write a file in a temporary file next to it which then replaces it, so concurrent jobs (or a restart after a failed job) never see a
+    half-written file. A temporary file left by a failed write is removed.
+    :param file_name: path of the file.
+    :param write: function called with the path of the temporary file, which writes it (and, e.g., records its outputs before the file appears).
+    :return: None
+    """
+    tmp_file = file_name + '.' + str(os.getpid()) + '.tmp'
+    try:
+        write(tmp_file)
+        os.replace(tmp_file, file_name)
+    finally:
+        if os.path.isfile(tmp_file):
+            os.remove(tmp_file)
+    return None
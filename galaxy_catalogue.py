@@ -0,0 +1,267 @@
+import os
+import glob
+import h5py
+
+import numpy as np
+
+from file_tools import atomic_write
+
+
+# Schema of the galaxy catalogue as column: (dtype, shape of a row, units). Columns whose rows have a different length for each galaxy (e.g., one
+# value per particle) have a shape of None and are stored as ragged columns #
+schema = {'group_numbers':(np.int64, (), ''), 'subgroup_numbers':(np.int64, (), ''), 'CoPs':(np.float64, (3,), 'kpc'),
+          'glx_deltas':(np.float64, (), ''), 'glx_delta_rs':(np.float64, (), ''), 'glx_sigma_0s':(np.float64, (), 'km s^-1'),
+          'glx_sigma_0s_re':(np.float64, (), 'km s^-1'), 'glx_Sersic_indices':(np.float64, (), ''), 'glx_scale_lengths':(np.float64, (), 'kpc'),
+          'glx_effective_radii':(np.float64, (), 'kpc'), 'glx_n_particles':(np.int64, (), ''), 'glx_concentration_indices':(np.float64, (), ''),
+          'glx_delta_thetas':(np.float64, (), 'deg'), 'glx_fitting_flags':(np.int64, (), ''), 'glx_stellar_masses':(np.float64, (), 'Msun'),
+          'glx_disc_fractions':(np.float64, (), ''), 'glx_rotationals':(np.float64, (), 'km s^-1'), 'glx_rotationals_re':(np.float64, (), 'km s^-1'),
+          'glx_as':(np.float64, (), ''), 'glx_circularities':(np.float64, (), ''), 'glx_kappas_corotation':(np.float64, (), ''),
+          'glx_disc_fractions_IT20':(np.float64, (), ''), 'glx_disk_fraction_profiles':(np.float64, (), ''),
+          'glx_disc_fractions_IT20_cr_all':(np.float64, (), ''), 'glx_disc_fractions_IT20_cr_strict':(np.float64, (), ''),
+          'glx_rotationals_over_dispersions':(np.float64, (), ''), 'glx_stellar_angular_momenta':(np.float64, (3,), 'Msun kpc km s^-1'),
+          'glx_gaseous_angular_momenta':(np.float64, (3,), 'Msun kpc km s^-1'), 'glx_gaseous_masses':(np.float64, (), 'Msun'),
+          'glx_star_formation_rates':(np.float64, (), 'Msun yr^-1'), 'glx_star_forming':(np.float64, (), 'Msun'),
+          'glx_non_star_forming':(np.float64, (), 'Msun'), 'bh_masses':(np.float64, (), 'Msun'), 'dark_matter_masses':(np.float64, (), 'Msun'),
+          'disc_as':(np.float64, (), ''), 'disc_betas':(np.float64, (), ''), 'disc_deltas':(np.float64, (), ''),
+          'disc_sigma_0s':(np.float64, (), 'km s^-1'), 'disc_sigma_0s_re':(np.float64, (), 'km s^-1'), 'disc_rotationals':(np.float64, (), 'km s^-1'),
+          'disc_weighted_as':(np.float64, (), ''), 'disc_metallicities':(np.float64, (), ''), 'disc_birth_densities':(object, None, 'Msun kpc^-3'),
+          'disc_stellar_angular_momenta':(np.float64, (3,), 'Msun kpc km s^-1'), 'spheroid_as':(np.float64, (), ''),
+          'spheroid_betas':(np.float64, (), ''), 'spheroid_deltas':(np.float64, (), ''), 'spheroid_sigma_0s':(np.float64, (), 'km s^-1'),
+          'spheroid_sigma_0s_re':(np.float64, (), 'km s^-1'), 'spheroid_rotationals':(np.float64, (), 'km s^-1'),
+          'spheroid_weighted_as':(np.float64, (), ''), 'spheroid_metallicities':(np.float64, (), ''),
+          'spheroid_birth_densities':(object, None, 'Msun kpc^-3'), 'spheroid_stellar_angular_momenta':(np.float64, (3,), 'Msun kpc km s^-1')}
+
+
+class ScalarCatalogue:
+    """
+    A per-shard catalogue with one row per galaxy of its scalar (and other small) attributes, so that collecting them never requires the
+    particle data. Attributes whose shape varies between galaxies (e.g., component birth densities) are stored as ragged columns.
+    """
+
+
+    def __init__(self, catalogue_file):
+        """
+        A constructor method for the class.
+        :param catalogue_file: path of the catalogue.
+        """
+        self.catalogue_file = catalogue_file
+        os.makedirs(os.path.dirname(catalogue_file), exist_ok=True)
+
+        # Keep the rows a previous run saved in the same catalogue, so a resumed job only adds (or replaces) rows #
+        self.rows = self.read(catalogue_file) if os.path.isfile(catalogue_file) else {}  # Dictionary of (GroupNumber, SubGroupNumber):
+        # dictionary of attributes.
+
+
+    def add(self, group_number, subgroup_number, attributes):
+        """
+        Add (or replace) the row of a galaxy.
+        :param group_number: from read_add_attributes.py.
+        :param subgroup_number: from read_add_attributes.py.
+        :param attributes: dictionary of attribute: value.
+        :return: None
+        """
+        self.rows[(int(group_number), int(subgroup_number))] = attributes
+        return None
+
+
+    def write(self):
+        """
+        Save the rows. The catalogue is written in a temporary file and then replaces the old one, so it is never left half-written.
+        :return: None
+        """
+        rows = self.rows
+        if len(rows) == 0:
+            return None
+
+        keys = list(rows.keys())
+
+        def write(tmp_file):
+            with h5py.File(tmp_file, 'w') as f:
+                f.create_dataset('GroupNumber', data=np.array([key[0] for key in keys], dtype=np.int64))
+                f.create_dataset('SubGroupNumber', data=np.array([key[1] for key in keys], dtype=np.int64))
+                for attribute in rows[keys[0]].keys():
+                    values = [np.asarray(rows[key][attribute]) for key in keys]
+                    if len(set(value.shape for value in values)) == 1:
+                        f.create_dataset('columns/' + attribute, data=np.stack(values))
+                    else:  # Store values with different shapes as a ragged column.
+                        f.create_dataset('ragged/' + attribute + '/values', data=np.concatenate([np.atleast_1d(value) for value in values]))
+                        f.create_dataset('ragged/' + attribute + '/lengths', data=np.array([np.atleast_1d(value).shape[0] for value in values]))
+
+        atomic_write(self.catalogue_file, write)
+        return None
+
+
+    @staticmethod
+    def read(catalogue_file):
+        """
+        Load the rows of a catalogue.
+        :param catalogue_file: path of the catalogue.
+        :return: rows: dictionary of (GroupNumber, SubGroupNumber): dictionary of attributes
+        """
+        with h5py.File(catalogue_file, 'r') as f:
+            keys = list(zip(f['GroupNumber'][...].tolist(), f['SubGroupNumber'][...].tolist()))
+            rows = {key:{} for key in keys}
+            for attribute in f.get('columns', {}).keys():
+                values = f['columns/' + attribute][...]
+                for key, value in zip(keys, values):
+                    rows[key][attribute] = value
+            for attribute in f.get('ragged', {}).keys():
+                lengths = f['ragged/' + attribute + '/lengths'][...]
+                values = np.split(f['ragged/' + attribute + '/values'][...], np.cumsum(lengths)[:-1])
+                for key, value in zip(keys, values):
+                    rows[key][attribute] = value
+        return rows
+
+
+class ColumnAccumulator:
+    """
+    Preallocated columns of the galaxy catalogue which are filled one row at a time. Every row has to provide exactly the columns of the schema, so
+    columns can never be misaligned.
+    """
+
+
+    def __init__(self, n_rows):
+        """
+        A constructor method for the class.
+        :param n_rows: number of galaxies.
+        """
+        self.columns = {}  # Dictionary of column: array with n_rows rows.
+        for attribute, (dtype, shape, units) in schema.items():
+            self.columns[attribute] = np.empty(n_rows, dtype=object) if shape is None else np.zeros((n_rows,) + shape, dtype=dtype)
+
+
+    def set_row(self, row, attributes):
+        """
+        Fill a row with the attributes of a galaxy.
+        :param row: index of the row.
+        :param attributes: dictionary of attribute: value.
+        :return: None
+        """
+        if attributes.keys() != schema.keys():
+            raise ValueError('Attributes do not match the schema of the galaxy catalogue: ' + str(sorted(attributes.keys() ^ schema.keys())))
+        for attribute, value in attributes.items():
+            shape = schema[attribute][1]
+            self.columns[attribute][row] = value if shape is None else np.reshape(value, shape)
+        return None
+
+
+def concatenate_catalogues(catalogue_path, group_numbers, subgroup_numbers):
+    """
+    Concatenate the per-shard catalogues into one preallocated column per attribute, ordered as the given galaxies. If a galaxy appears in more
+    than one catalogue, the row of the most recent one is used.
+    :param catalogue_path: directory of the catalogues.
+    :param group_numbers: group numbers of the galaxies.
+    :param subgroup_numbers: subgroup numbers of the galaxies.
+    :return: columns: dictionary of attribute: array, missing: list of (GroupNumber, SubGroupNumber) without a row
+    """
+    rows = {}
+    for catalogue_file in sorted(glob.glob(catalogue_path + '*.hdf5'), key=os.path.getmtime):
+        rows.update(ScalarCatalogue.read(catalogue_file))
+
+    keys = [(int(group_number), int(subgroup_number)) for group_number, subgroup_number in zip(group_numbers, subgroup_numbers)]
+    missing = [key for key in keys if key not in rows]
+    accumulator = ColumnAccumulator(len(keys) - len(missing))
+    for row, key in enumerate([key for key in keys if key in rows]):
+        accumulator.set_row(row, rows[key])
+    return accumulator.columns, missing
+
+
+class GalaxyCatalogue:
+    """
+    A single catalogue with one row per galaxy and one named column per attribute (with its units). Columns are read only when they are
+    requested and rows are aligned by construction, so scripts never have to keep separate files in the same order.
+    """
+
+
+    def __init__(self, catalogue_file):
+        """
+        A constructor method for the class.
+        :param catalogue_file: path of the catalogue.
+        """
+        self.catalogue_file = catalogue_file
+        self.index = None  # Dictionary of (GroupNumber, SubGroupNumber): row, built the first time a row is requested.
+
+
+    @staticmethod
+    def write(catalogue_file, columns):
+        """
+        Save the columns in the catalogue. The catalogue is written in a temporary file and then replaces the old one, so it is never left
+        half-written.
+        :param catalogue_file: path of the catalogue.
+        :param columns: dictionary of attribute: array (one row per galaxy, ragged columns as object arrays), including 'group_numbers' and
+        'subgroup_numbers'.
+        :return: None
+        """
+        n_rows = len(columns.get('group_numbers', []))
+        for attribute, values in columns.items():
+            if len(values) != n_rows:
+                raise ValueError('Column ' + attribute + ' has ' + str(len(values)) + ' rows instead of ' + str(n_rows))
+
+        def write(tmp_file):
+            with h5py.File(tmp_file, 'w') as f:
+                for attribute, values in columns.items():
+                    values = np.asarray(values)
+                    if values.dtype != object:
+                        dataset = f.create_dataset('columns/' + attribute, data=values)
+                    else:  # Store object arrays as a ragged column.
+                        values = [np.atleast_1d(value) for value in values]
+                        dataset = f.create_dataset('ragged/' + attribute + '/values', data=np.concatenate(values) if n_rows > 0 else np.empty(0))
+                        f.create_dataset('ragged/' + attribute + '/lengths', data=np.array([value.shape[0] for value in values], dtype=np.int64))
+                    dataset.attrs['units'] = schema[attribute][2] if attribute in schema else ''
+
+        atomic_write(catalogue_file, write)
+        return None
+
+
+    def get_columns(self):
+        """
+        Get the names of the columns of the catalogue.
+        :return: columns
+        """
+        with h5py.File(self.catalogue_file, 'r') as f:
+            columns = sorted(list(f.get('columns', {}).keys()) + list(f.get('ragged', {}).keys()))
+        return columns
+
+
+    def get_units(self, attribute):
+        """
+        Get the units of a column.
+        :param attribute: name of the column.
+        :return: units
+        """
+        with h5py.File(self.catalogue_file, 'r') as f:
+            dataset = f['columns/' + attribute] if 'columns/' + attribute in f else f['ragged/' + attribute + '/values']
+            return dataset.attrs['units']
+
+
+    def get_row(self, group_number, subgroup_number):
+        """
+        Get the row of a galaxy.
+        :param group_number: from read_add_attributes.py.
+        :param subgroup_number: from read_add_attributes.py.
+        :return: row
+        """
+        if self.index is None:
+            group_numbers, subgroup_numbers = self.load('group_numbers').tolist(), self.load('subgroup_numbers').tolist()
+            self.index = {(group_number, subgroup_number):row for row, (group_number, subgroup_number) in
+                          enumerate(zip(group_numbers, subgroup_numbers))}
+        return self.index[(int(group_number), int(subgroup_number))]
+
+
+    def load(self, attribute, rows=None):
+        """
+        Load only the requested column (a ragged one as an object array).
+        :param attribute: name of the column.
+        :param rows: rows to select (default: all).
+        :return: column
+        """
+        with h5py.File(self.catalogue_file, 'r') as f:
+            if 'columns/' + attribute in f:
+                column = f['columns/' + attribute][...]
+            else:
+                lengths = f['ragged/' + attribute + '/lengths'][...]
+                values = np.split(f['ragged/' + attribute + '/values'][...], np.cumsum(lengths)[:-1])
+                column = np.empty(len(values), dtype=object)
+                for i, value in enumerate(values):
+                    column[i] = value
+        return column if rows is None else column[rows]
@@ -0,0 +1,188 @@
+import healpy as hlp
+import numpy as np
+import healpix_tools
+
+from plot_tools import RotateCoordinates
+from morpho_kinematics import MassProfile
+
+
+class GalaxyView:
+    """
+    A view of the stellar particles of a galaxy which calculates each derived quantity (e.g., angular momenta, radii, rotated frames, the densest
+    grid cell of the angular momentum map) the first time a kernel asks for it and then returns the cached value, so the kernels which are
+    applied to the same galaxy never repeat the same calculation. The particle columns are read as stellar_view['Mass'].
+    """
+    __slots__ = ['data_tmp', 'cached_prc_specific_angular_momentum', 'cached_prc_angular_momentum', 'cached_glx_angular_momentum',
+                 'cached_prc_spherical_radius', 'cached_mass_profile', 'cached_cylindrical_mass_profile', 'cached_rotated_X',
+                 'cached_rotated_Jz', 'cached_densities', 'cached_smoothed_densities', 'cached_densest_unit_vector',
+                 'cached_angular_theta_from_densest']
+
+
+    def __init__(self, data_tmp):
+        """
+        A constructor method for the class.
+        :param data_tmp: dictionary of particle attributes (e.g., stellar_data_tmp).
+        """
+        self.data_tmp = data_tmp
+        for slot in self.__slots__[1:]:
+            setattr(self, slot, None)
+
+
+    def __getitem__(self, attribute):
+        return self.data_tmp[attribute]
+
+
+    @property
+    def prc_specific_angular_momentum(self):
+        """
+        Specific angular momentum of each particle in kpc km s^-1.
+        """
+        if self.cached_prc_specific_angular_momentum is None:
+            self.cached_prc_specific_angular_momentum = np.cross(self.data_tmp['Coordinates'], self.data_tmp['Velocity'])
+        return self.cached_prc_specific_angular_momentum
+
+
+    @property
+    def prc_angular_momentum(self):
+        """
+        Angular momentum of each particle in Msun kpc km s^-1.
+        """
+        if self.cached_prc_angular_momentum is None:
+            self.cached_prc_angular_momentum = self.data_tmp['Mass'][:, np.newaxis] * self.prc_specific_angular_momentum
+        return self.cached_prc_angular_momentum
+
+
+    @property
+    def glx_angular_momentum(self):
+        """
+        Angular momentum of the galaxy in Msun kpc km s^-1.
+        """
+        if self.cached_glx_angular_momentum is None:
+            self.cached_glx_angular_momentum = np.sum(self.prc_angular_momentum, axis=0)
+        return self.cached_glx_angular_momentum
+
+
+    @property
+    def glx_unit_vector(self):
+        """
+        Unit vector parallel to the angular momentum of the galaxy.
+        """
+        return self.glx_angular_momentum / np.linalg.norm(self.glx_angular_momentum)
+
+
+    @property
+    def prc_spherical_radius(self):
+        """
+        Spherical distance of each particle in kpc.
+        """
+        if self.cached_prc_spherical_radius is None:
+            self.cached_prc_spherical_radius = np.sqrt(np.sum(self.data_tmp['Coordinates'] ** 2, axis=1))
+        return self.cached_prc_spherical_radius
+
+
+    @property
+    def mass_profile(self):
+        """
+        Cumulative mass profile wrt the spherical distance of the particles.
+        """
+        if self.cached_mass_profile is None:
+            self.cached_mass_profile = MassProfile(self.prc_spherical_radius, self.data_tmp['Mass'])
+        return self.cached_mass_profile
+
+
+    @property
+    def cylindrical_mass_profile(self):
+        """
+        Cumulative mass profile wrt the cylindrical distance of the particles in the plane perpendicular to the angular momentum of the galaxy.
+        """
+        if self.cached_cylindrical_mass_profile is None:
+            coordinates = self.rotated_Jz[0]
+            self.cached_cylindrical_mass_profile = MassProfile(np.sqrt(coordinates[:, 0] ** 2 + coordinates[:, 1] ** 2), self.data_tmp['Mass'])
+        return self.cached_cylindrical_mass_profile
+
+
+    def r_mass(self, fraction):
+        """
+        Calculate the radius that contains a provided fraction of the total mass (as MorphoKinematic.r_mass, but the particles are sorted once).
+        :param fraction: fraction (or list of fractions) of the total mass.
+        :return: r_mass
+        """
+        return self.mass_profile.radius(fraction)
+
+
+    @property
+    def rotated_X(self):
+        """
+        Output of RotateCoordinates.rotate_X wrt the angular momentum of the galaxy: coordinates, velocities, prc_unit_vector, glx_unit_vector.
+        """
+        if self.cached_rotated_X is None:
+            self.cached_rotated_X = RotateCoordinates.rotate_X(self.data_tmp, self.glx_unit_vector, self.prc_angular_momentum)
+        return self.cached_rotated_X
+
+
+    @property
+    def rotated_Jz(self):
+        """
+        Output of RotateCoordinates.rotate_Jz: coordinates, velocities, prc_angular_momentum, glx_angular_momentum.
+        """
+        if self.cached_rotated_Jz is None:
+            self.cached_rotated_Jz = RotateCoordinates.rotate_Jz(self.data_tmp, self.prc_angular_momentum)
+        return self.cached_rotated_Jz
+
+
+    @property
+    def densities(self):
+        """
+        Number of particles in each grid cell of the HEALPix map (nside=16) of the (rotated) angular momentum unit vectors of the particles.
+        """
+        if self.cached_densities is None:
+            prc_unit_vector = self.rotated_X[2]
+            self.cached_densities = healpix_tools.get_densities(prc_unit_vector, [0, len(prc_unit_vector)], 2 ** 4)[0]
+        return self.cached_densities
+
+
+    @property
+    def smoothed_densities(self):
+        """
+        Top-hat smoothed (within 30 degrees) densities of the HEALPix map.
+        """
+        if self.cached_smoothed_densities is None:
+            self.cached_smoothed_densities = healpix_tools.smooth(self.densities, 2 ** 4)
+        return self.cached_smoothed_densities
+
+
+    @property
+    def densest_unit_vector(self):
+        """
+        Unit vector of the centre of the densest grid cell of the top-hat smoothed HEALPix map of the (rotated) angular momentum unit vectors of
+        the particles.
+        """
+        if self.cached_densest_unit_vector is None:
+            self.cached_densest_unit_vector = np.array(hlp.pix2vec(2 ** 4, np.argmax(self.smoothed_densities)))
+        return self.cached_densest_unit_vector
+
+
+    @property
+    def angular_theta_from_densest(self):
+        """
+        Angular distance (in radians) of the (rotated) angular momentum unit vector of each particle from the densest grid cell.
+        """
+        if self.cached_angular_theta_from_densest is None:
+            prc_unit_vector = self.rotated_X[2]
+            self.cached_angular_theta_from_densest = np.arccos(np.clip(np.dot(prc_unit_vector, self.densest_unit_vector), -1.0, 1.0))
+        return self.cached_angular_theta_from_densest
+
+
+    @staticmethod
+    def set_densest_unit_vectors(views):
+        """
+        Find the densest grid cell of many galaxies with one batched call (e.g., for a batch of small galaxies, whose time is dominated by the
+        overhead of the calls rather than by the arithmetic).
+        :param views: list of GalaxyView.
+        :return: None
+        """
+        prc_unit_vectors = [view.rotated_X[2] for view in views]
+        offsets = np.hstack([0, np.cumsum([len(prc_unit_vector) for prc_unit_vector in prc_unit_vectors])])
+        densest_unit_vectors = healpix_tools.get_densest_unit_vectors(np.concatenate(prc_unit_vectors), offsets)
+        for view, densest_unit_vector in zip(views, densest_unit_vectors):
+            view.cached_densest_unit_vector = densest_unit_vector
@@ -0,0 +1,164 @@
+import os
+
+import numpy as np
+import healpy as hlp
+
+from scipy import sparse
+from file_tools import atomic_write
+
+smoothing_operators = {}  # Top-hat smoothing operators of this process, keyed by (nside, radius).
+neighbour_tables = {}  # Neighbours of each pixel, keyed by nside.
+default_operator_path = None  # Directory where the operators are saved (opt-in: by default they are only cached in memory).
+
+
+def build_smoothing_operator(nside, radius):
+    """
+    Build the top-hat smoothing operator of a HEALPix (ring ordered) map, i.e., a sparse matrix whose row i has a one for each pixel within a
+    cone of a given radius around pixel i.
+    :param nside: resolution of the grid.
+    :param radius: radius of the cone in radians.
+    :return: operator (CSR matrix of shape (npix, npix)), n_pixels (number of pixels in each cone)
+    """
+    npix = hlp.nside2npix(nside)
+    cones = [hlp.query_disc(nside, hlp.pix2vec(nside, i), radius) for i in range(npix)]  # Do a cone search around each pixel.
+    n_pixels = np.array([len(cone) for cone in cones])
+    indptr = np.hstack([0, np.cumsum(n_pixels)])
+    operator = sparse.csr_matrix((np.ones(indptr[-1]), np.concatenate(cones), indptr), shape=(npix, npix))
+    return operator, n_pixels
+
+
+def get_smoothing_operator(nside, radius, operator_path=None):
+    """
+    Get the top-hat smoothing operator of a HEALPix map from the cache of this process, else from the operator_path directory, else build it
+    (and save it in the operator_path directory, so that other processes only load it).
+    :param nside: resolution of the grid.
+    :param radius: radius of the cone in radians.
+    :param operator_path: directory where the operators are saved (default: default_operator_path, i.e., none unless a script sets it).
+    :return: operator, n_pixels
+    """
+    key = (nside, radius)
+    if key in smoothing_operators:
+        return smoothing_operators[key]
+
+    operator_path = default_operator_path if operator_path is None else operator_path
+    file = None if operator_path is None else os.path.join(operator_path, 'top_hat_%d_%.8f.npz' % key)
+    if file is not None and os.path.isfile(file):
+        operator = sparse.load_npz(file).tocsr()
+        n_pixels = np.diff(operator.indptr)
+    else:
+        operator, n_pixels = build_smoothing_operator(nside, radius)
+
+        # Save the operator through a temporary file (opened here, since save_npz appends '.npz' to other names), so that concurrent jobs never
+        # read a partial file #
+        def write(tmp_file):
+            with open(tmp_file, 'wb') as f:
+                sparse.save_npz(f, operator)
+
+        if file is not None:
+            os.makedirs(operator_path, exist_ok=True)
+            atomic_write(file, write)
+
+    smoothing_operators[key] = operator, n_pixels
+    return operator, n_pixels
+
+
+def smooth(densities, nside, radius=np.pi / 6.0):
+    """
+    Perform a top-hat smoothing on one or more HEALPix maps with one sparse matrix product, i.e., replace the density of each pixel with the
+    mean density of the pixels within a cone around it.
+    :param densities: density of each pixel (ring ordered), or one row of densities per map.
+    :param nside: resolution of the grid.
+    :param radius: radius of the cone in radians (default: 30 degrees).
+    :return: smoothed_densities
+    """
+    operator, n_pixels = get_smoothing_operator(nside, radius)
+    smoothed_densities = operator.dot(np.asarray(densities, dtype=np.float64).T).T / n_pixels
+    return smoothed_densities
+
+
+def get_densities(unit_vectors, offsets, nside):
+    """
+    Count the unit vectors of many galaxies in each pixel of a HEALPix map per galaxy with one histogram.
+    :param unit_vectors: unit vectors of all galaxies, concatenated.
+    :param offsets: index of the first unit vector of each galaxy and the total number of unit vectors (i.e., n_galaxies + 1 elements).
+    :param nside: resolution of the grid.
+    :return: densities (one row of densities per galaxy)
+    """
+    npix, n_galaxies = hlp.nside2npix(nside), len(offsets) - 1
+    galaxies = np.repeat(np.arange(n_galaxies), np.diff(offsets))
+    indices = hlp.vec2pix(nside, unit_vectors[:, 0], unit_vectors[:, 1], unit_vectors[:, 2])  # HEALPix index of each unit vector.
+    densities = np.bincount(galaxies * npix + indices, minlength=n_galaxies * npix).reshape(n_galaxies, npix)
+    return densities
+
+
+def get_densest_unit_vectors(unit_vectors, offsets, nside=2 ** 4, radius=np.pi / 6.0):
+    """
+    Find the centre of the densest pixel of the top-hat smoothed HEALPix map of the unit vectors of each galaxy. All galaxies are histogrammed,
+    smoothed and searched at once, so a batch of small galaxies costs about as many calls as a single galaxy.
+    :param unit_vectors: unit vectors of all galaxies, concatenated.
+    :param offsets: index of the first unit vector of each galaxy and the total number of unit vectors (i.e., n_galaxies + 1 elements).
+    :param nside: resolution of the grid (default: 16).
+    :param radius: radius of the cone in radians (default: 30 degrees).
+    :return: densest_unit_vectors (one row per galaxy)
+    """
+    smoothed_densities = smooth(get_densities(unit_vectors, offsets, nside), nside, radius)
+    index_densest = np.argmax(smoothed_densities, axis=1)
+    densest_unit_vectors = np.array(hlp.pix2vec(nside, index_densest)).T
+    return densest_unit_vectors
+
+
+def get_neighbour_table(nside):
+    """
+    Get the (up to) 8 neighbours of each pixel of a HEALPix (ring ordered) map from the cache of this process, else build it.
+    :param nside: resolution of the grid.
+    :return: neighbours (array of shape (8, npix), -1 where a pixel has only 7 neighbours)
+    """
+    if nside not in neighbour_tables:
+        neighbour_tables[nside] = hlp.get_all_neighbours(nside, np.arange(hlp.nside2npix(nside)))
+    return neighbour_tables[nside]
+
+
+def find_peaks(densities, nside, radius=np.pi / 6.0, threshold=5.0, smoothed_densities=None):
+    """
+    Find the local maxima of the top-hat smoothed HEALPix map of counts whose significance is above a threshold. A pixel is a local maximum if
+    its smoothed density is higher than the ones of its neighbours (ties are broken by the pixel index). Since the noise of the smoothed map
+    makes secondary maxima on the flanks of a peak, a maximum within a cone of the smoothing radius around a higher significant peak is
+    suppressed. The significance is the excess of the counts in the cone of the pixel over the ones of an isotropic distribution, in units of
+    its Poisson noise.
+    :param densities: number of counts in each pixel (ring ordered).
+    :param nside: resolution of the grid.
+    :param radius: radius of the cone of the smoothing in radians (default: 30 degrees).
+    :param threshold: minimum significance of a peak (default: 5 sigma, since there are thousands of overlapping cones).
+    :param smoothed_densities: smoothed densities (from smooth), calculated if not provided.
+    :return: peak_indices, significances (sorted by decreasing smoothed density)
+    """
+    # An empty map has no peaks (and no mean density to compare with) #
+    if np.sum(densities) == 0:
+        return np.array([], dtype=int), np.array([])
+
+    operator, n_pixels = get_smoothing_operator(nside, radius)
+    if smoothed_densities is None:
+        smoothed_densities = smooth(densities, nside, radius)
+    neighbours = get_neighbour_table(nside)
+    pixels = np.arange(len(smoothed_densities))
+
+    # Compare each pixel with all its neighbours at once #
+    neighbour_densities = np.where(neighbours >= 0, smoothed_densities[neighbours], -np.inf)
+    is_peak = np.all((smoothed_densities > neighbour_densities) | ((smoothed_densities == neighbour_densities) & (pixels < neighbours)), axis=0)
+    peak_indices, = np.where(is_peak)
+
+    # Calculate the significance of each peak wrt an isotropic distribution with the same number of counts #
+    mean_density = np.sum(densities) / len(densities)
+    significances = (smoothed_densities[peak_indices] - mean_density) * np.sqrt(n_pixels[peak_indices] / mean_density)
+
+    sort = np.argsort(-smoothed_densities[peak_indices], kind='stable')
+    peak_indices, significances = peak_indices[sort], significances[sort]
+    mask = significances > threshold
+    peak_indices, significances = peak_indices[mask], significances[mask]
+
+    # Keep a peak only if it is not within the smoothing radius of a higher one #
+    unit_vectors = np.array(hlp.pix2vec(nside, peak_indices)).T.reshape(-1, 3)
+    is_kept = np.ones(len(peak_indices), dtype=bool)
+    for i in range(1, len(peak_indices)):
+        is_kept[i] = np.all(np.dot(unit_vectors[:i][is_kept[:i]], unit_vectors[i]) < np.cos(radius))
+    return peak_indices[is_kept], significances[is_kept]
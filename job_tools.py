@@ -0,0 +1,479 @@
+import os
+import re
+import sys
+import time
+import glob
+import h5py
+import heapq
+import multiprocessing
+
+import numpy as np
+
+from file_tools import atomic_write
+from particle_store import GroupIndex
+
+worker_function = None  # Function called by the worker processes (inherited when the pool is forked, so it is never pickled).
+
+
+def run_worker(arguments):
+    """
+    Call the worker function of the pool with the arguments of a task.
+    :param arguments: tuple of arguments.
+    :return: result
+    """
+    return worker_function(*arguments)
+
+
+def run_pool(function, tasks, n_processes):
+    """
+    Run a function over a list of tasks in a pool of forked worker processes. The workers inherit the memory of the parent process, so only the
+    arguments of each task and its result are pickled.
+    :param function: function to call with the arguments of each task.
+    :param tasks: list of argument tuples.
+    :param n_processes: number of worker processes (tasks are run serially in this process if it is 1).
+    :return: results
+    """
+    global worker_function
+    worker_function = function
+
+    if n_processes <= 1 or len(tasks) <= 1:
+        return [function(*arguments) for arguments in tasks]
+
+    with multiprocessing.get_context('fork').Pool(min(n_processes, len(tasks))) as pool:
+        results = pool.map(run_worker, tasks, chunksize=1)
+    return results
+
+
+def get_job_number():
+    """
+    Get the number of this job: the (0-based) SLURM array task id, or the MPI rank if the script was launched with 'mpi' instead of a task id.
+    :return: job_number
+    """
+    if str(sys.argv[2]) == 'mpi':
+        from mpi4py import MPI
+        job_number = MPI.COMM_WORLD.Get_rank()
+    else:
+        job_number = int(sys.argv[2]) - 1
+    return job_number
+
+
+def get_costs(particle_counts, group_numbers, subgroup_numbers, timings=None):
+    """
+    Estimate the cost of each galaxy from its number of particles, or use its recorded time if it was timed in a previous run. Particle counts
+    of galaxies that were not timed are scaled to seconds with the median time per particle of those that were.
+    :param particle_counts: number of particles of each galaxy.
+    :param group_numbers: group numbers of the galaxies.
+    :param subgroup_numbers: subgroup numbers of the galaxies.
+    :param timings: dictionary of (GroupNumber, SubGroupNumber): seconds.
+    :return: costs
+    """
+    costs = np.array(particle_counts, dtype=np.float64)
+    if timings:
+        recorded_times = np.array([timings.get((int(group_number), int(subgroup_number)), np.nan) for group_number, subgroup_number in
+                                   zip(group_numbers, subgroup_numbers)])
+        timed_mask = np.isfinite(recorded_times) & (costs > 0)
+        if np.any(timed_mask):
+            costs *= np.median(recorded_times[timed_mask] / costs[timed_mask])
+            costs[timed_mask] = recorded_times[timed_mask]
+    return costs
+
+
+def partition(costs, n_jobs):
+    """
+    Assign galaxies to jobs so that every job has a similar total cost: the most expensive remaining galaxy is always given to the least loaded
+    job (longest processing time first).
+    :param costs: cost of each galaxy.
+    :param n_jobs: number of jobs.
+    :return: job_numbers
+    """
+    job_numbers = np.zeros(len(costs), dtype=np.int64)
+    loads = [(0.0, job_number) for job_number in range(n_jobs)]
+    for i in np.argsort(-np.asarray(costs), kind='stable'):
+        load, job_number = heapq.heappop(loads)
+        job_numbers[i] = job_number
+        heapq.heappush(loads, (load + costs[i], job_number))
+    return job_numbers
+
+
+def partition_parts(part_files, costs, n_jobs):
+    """
+    Assign the part files of the galaxy store to cost-balanced jobs, so that all galaxies of a part file belong to the same job. The partition
+    only depends on the part files and the costs of their galaxies, so all jobs get the same one without sharing a manifest.
+    :param part_files: part file of each galaxy.
+    :param costs: cost of each galaxy (e.g., its number of particles).
+    :param n_jobs: number of jobs.
+    :return: job_numbers (of each galaxy)
+    """
+    unique_part_files, inverse = np.unique(np.asarray(part_files), return_inverse=True)
+    job_numbers = partition(np.bincount(inverse, weights=costs, minlength=len(unique_part_files)), n_jobs)[inverse]
+    return job_numbers
+
+
+class JobManifest:
+    """
+    An HDF5 manifest of the galaxies of a run and the job (SLURM array task or MPI rank) each one is assigned to.
+    """
+
+
+    def __init__(self, manifest_file):
+        """
+        A constructor method for the class.
+        :param manifest_file: path of the manifest.
+        """
+        self.manifest_file = manifest_file
+
+
+    def write(self, group_numbers, subgroup_numbers, costs, n_jobs):
+        """
+        Partition the galaxies into cost-balanced jobs and save the manifest.
+        :param group_numbers: group numbers of the galaxies.
+        :param subgroup_numbers: subgroup numbers of the galaxies.
+        :param costs: from get_costs.
+        :param n_jobs: number of jobs.
+        :return: None
+        """
+        job_numbers = partition(costs, n_jobs)
+
+        # Write the manifest through a temporary file, so concurrent jobs never see a half-written file #
+        def write(tmp_file):
+            with h5py.File(tmp_file, 'w') as f:
+                f.create_dataset('GroupNumber', data=np.asarray(group_numbers))
+                f.create_dataset('SubGroupNumber', data=np.asarray(subgroup_numbers))
+                f.create_dataset('cost', data=costs)
+                f.create_dataset('job_number', data=job_numbers)
+                f.attrs['n_jobs'] = n_jobs
+
+        atomic_write(self.manifest_file, write)
+        return None
+
+
+    def is_valid(self, group_numbers, subgroup_numbers, n_jobs):
+        """
+        Check whether the manifest exists and was built for the same galaxies and number of jobs.
+        :param group_numbers: group numbers of the galaxies.
+        :param subgroup_numbers: subgroup numbers of the galaxies.
+        :param n_jobs: number of jobs.
+        :return: is_valid
+        """
+        if not os.path.isfile(self.manifest_file):
+            return False
+        with h5py.File(self.manifest_file, 'r') as f:
+            is_valid = f.attrs.get('n_jobs') == n_jobs and np.array_equal(np.sort(GroupIndex.group_keys(f['GroupNumber'][...],
+                                                                                                          f['SubGroupNumber'][...])),
+                                                                           np.sort(GroupIndex.group_keys(group_numbers, subgroup_numbers)))
+        return is_valid
+
+
+    def read_job(self, job_number):
+        """
+        Get the galaxies of a job in their original (SUBFIND) order.
+        :param job_number: from get_job_number.
+        :return: group_numbers, subgroup_numbers
+        """
+        with h5py.File(self.manifest_file, 'r') as f:
+            n_jobs = int(f.attrs['n_jobs'])
+            if not 0 <= job_number < n_jobs:  # E.g., an array task id above the number of jobs, which would otherwise get no galaxies.
+                raise ValueError('Job ' + str(job_number) + ' is out of range: the manifest ' + self.manifest_file + ' has ' + str(n_jobs) + ' jobs')
+            job_mask, = np.where(f['job_number'][...] == job_number)
+            group_numbers, subgroup_numbers = f['GroupNumber'][...][job_mask], f['SubGroupNumber'][...][job_mask]
+        return group_numbers, subgroup_numbers
+
+
+def get_job_galaxies(manifest_file, subhalo_data_tmp, n_jobs):
+    """
+    Get the galaxies of this job from the manifest. If the manifest is missing or was built for different galaxies, it is rebuilt from the
+    particle counts only, so that all jobs which rebuild it concurrently get the same partition.
+    :param manifest_file: path of the manifest.
+    :param subhalo_data_tmp: masked subhalo data with 'GroupNumber', 'SubGroupNumber' and 'SubLengthType'.
+    :param n_jobs: number of jobs.
+    :return: job_number, group_numbers, subgroup_numbers
+    """
+    manifest = JobManifest(manifest_file)
+    if not manifest.is_valid(subhalo_data_tmp['GroupNumber'], subhalo_data_tmp['SubGroupNumber'], n_jobs):
+        build_manifest(manifest_file, subhalo_data_tmp, n_jobs)
+
+    job_number = get_job_number()
+    group_numbers, subgroup_numbers = manifest.read_job(job_number)
+    return job_number, group_numbers, subgroup_numbers
+
+
+def build_manifest(manifest_file, subhalo_data_tmp, n_jobs, timings=None):
+    """
+    Estimate the cost of each galaxy and save a cost-balanced manifest.
+    :param manifest_file: path of the manifest.
+    :param subhalo_data_tmp: masked subhalo data with 'GroupNumber', 'SubGroupNumber' and 'SubLengthType'.
+    :param n_jobs: number of jobs.
+    :param timings: from load_timings.
+    :return: None
+    """
+    costs = get_costs(np.sum(subhalo_data_tmp['SubLengthType'], axis=1), subhalo_data_tmp['GroupNumber'], subhalo_data_tmp['SubGroupNumber'],
+                      timings=timings)
+    JobManifest(manifest_file).write(subhalo_data_tmp['GroupNumber'], subhalo_data_tmp['SubGroupNumber'], costs, n_jobs)
+    return None
+
+
+class TimingLog:
+    """
+    Record the time spent on each galaxy so that later runs can balance their jobs with measured instead of estimated costs.
+    """
+
+
+    def __init__(self, timings_file):
+        """
+        A constructor method for the class.
+        :param timings_file: path of the timings file.
+        """
+        self.timings_file = timings_file
+        self.group_numbers, self.subgroup_numbers, self.times = [], [], []
+
+
+    def add(self, group_number, subgroup_number, seconds):
+        """
+        Record the time spent on a galaxy.
+        :param group_number: from read_add_attributes.py.
+        :param subgroup_number: from read_add_attributes.py.
+        :param seconds: time spent on the galaxy.
+        :return: None
+        """
+        self.group_numbers.append(group_number)
+        self.subgroup_numbers.append(subgroup_number)
+        self.times.append(seconds)
+        return None
+
+
+    def write(self):
+        """
+        Save the recorded times.
+        :return: None
+        """
+        os.makedirs(os.path.dirname(self.timings_file), exist_ok=True)
+        with h5py.File(self.timings_file, 'w') as f:
+            f.create_dataset('GroupNumber', data=np.array(self.group_numbers, dtype=np.int64))
+            f.create_dataset('SubGroupNumber', data=np.array(self.subgroup_numbers, dtype=np.int64))
+            f.create_dataset('time', data=np.array(self.times, dtype=np.float64))
+        return None
+
+
+def load_timings(timings_path):
+    """
+    Load the times recorded by previous runs. The latest time of a galaxy in each stage (e.g., 'read' or 'add') is used and the times of
+    different stages are added up.
+    :param timings_path: directory of the timings files.
+    :return: timings
+    """
+    stage_timings = {}
+    for timings_file in sorted(glob.glob(timings_path + '*.hdf5'), key=os.path.getmtime):
+        stage = os.path.basename(timings_file).split('_')[0]
+        with h5py.File(timings_file, 'r') as f:
+            for group_number, subgroup_number, seconds in zip(f['GroupNumber'][...], f['SubGroupNumber'][...], f['time'][...]):
+                stage_timings[(stage, int(group_number), int(subgroup_number))] = seconds
+
+    timings = {}
+    for (stage, group_number, subgroup_number), seconds in stage_timings.items():
+        timings[(group_number, subgroup_number)] = timings.get((group_number, subgroup_number), 0.0) + seconds
+    return timings
+
+
+def get_sequence_file(file_prefix, sequence_numbers):
+    """
+    Get the next file of a sequence of files (e.g., the records files of a writer, <file_prefix>.<sequence_number>.hdf5). The sequence of a
+    prefix continues after the files of previous runs.
+    :param file_prefix: path of the files without the sequence number and the extension.
+    :param sequence_numbers: dictionary of file_prefix: sequence number of the next file, updated in place.
+    :return: file_name
+    """
+    if file_prefix not in sequence_numbers:
+        sequence_numbers[file_prefix] = max([int(re.split(r'\.', file_name)[-2]) for file_name in glob.glob(file_prefix + '.*.hdf5')],
+                                            default=-1) + 1
+    file_name = file_prefix + '.' + str(sequence_numbers[file_prefix]) + '.hdf5'
+    sequence_numbers[file_prefix] += 1
+    return file_name
+
+
+class CompletionManifest:
+    """
+    Per-galaxy completion records of a stage (e.g., 'read' or 'add'): the output file and checksum of each completed galaxy. Each writer (job or
+    worker process) keeps its own records files, so concurrent writers never share a file and a restart reads the records of all of them.
+    """
+
+
+    def __init__(self, manifest_path, stage):
+        """
+        A constructor method for the class.
+        :param manifest_path: directory of the records files.
+        :param stage: name of the stage.
+        """
+        self.manifest_path = manifest_path
+        self.stage = stage
+        self.sequence_numbers = {}  # Dictionary of records file prefix: sequence number of its next records file.
+        os.makedirs(manifest_path, exist_ok=True)
+
+
+    def load(self):
+        """
+        Load the completion records of all writers of the stage.
+        :return: records: dictionary of (GroupNumber, SubGroupNumber): (output_file, checksum)
+        """
+        records = {}
+        for records_file in sorted(glob.glob(self.manifest_path + self.stage + '_*.hdf5'), key=os.path.getmtime):
+            with h5py.File(records_file, 'r') as f:
+                for group_number, subgroup_number, output_file, checksum in zip(f['GroupNumber'][...], f['SubGroupNumber'][...],
+                                                                                f['output_file'].asstr()[...], f['checksum'][...]):
+                    records[(int(group_number), int(subgroup_number))] = (output_file, int(checksum))
+        return records
+
+
+    def add(self, writer_name, group_numbers, subgroup_numbers, output_file, checksums):
+        """
+        Record galaxies as completed by a writer in a new records file, so the cost of a call does not grow with the records of earlier calls.
+        :param writer_name: name of the writer (e.g., the name of its part file).
+        :param group_numbers: group numbers of the galaxies.
+        :param subgroup_numbers: subgroup numbers of the galaxies.
+        :param output_file: file which holds the outputs of the galaxies.
+        :param checksums: checksum of the outputs of each galaxy.
+        :return: None
+        """
+        def write(tmp_file):
+            with h5py.File(tmp_file, 'w') as f:
+                f.create_dataset('GroupNumber', data=np.asarray(group_numbers, dtype=np.int64))
+                f.create_dataset('SubGroupNumber', data=np.asarray(subgroup_numbers, dtype=np.int64))
+                f.create_dataset('output_file', data=[output_file] * len(group_numbers), dtype=h5py.string_dtype())
+                f.create_dataset('checksum', data=np.asarray(checksums, dtype=np.uint32))
+
+        atomic_write(get_sequence_file(self.manifest_path + self.stage + '_' + writer_name, self.sequence_numbers), write)
+        return None
+
+
+class WalltimeGuard:
+    """
+    Stop a job cleanly before its walltime: no new galaxy is started unless there is time to finish it (and to save the outputs of the job)
+    even if it takes twice as long as the slowest galaxy so far.
+    """
+
+
+    def __init__(self, walltime, start_time):
+        """
+        A constructor method for the class.
+        :param walltime: available time in seconds.
+        :param start_time: time the job started.
+        """
+        self.walltime = walltime
+        self.start_time = start_time
+        self.slowest = 0.0  # Time spent on the slowest galaxy so far.
+
+
+    def record(self, seconds):
+        """
+        Record the time spent on a galaxy.
+        :param seconds: time spent on the galaxy.
+        :return: None
+        """
+        self.slowest = max(self.slowest, seconds)
+        return None
+
+
+    def is_time_up(self):
+        """
+        Check whether the job should stop before it starts another galaxy.
+        :return: is_time_up
+        """
+        is_time_up = time.time() - self.start_time + 2 * self.slowest > self.walltime
+        return is_time_up
+
+
+def get_incomplete_galaxies(manifest, group_numbers, subgroup_numbers, get_checksum, verify=False):
+    """
+    Get the galaxies which have not been completed by a previous run, i.e., those without a completion record or whose output file is missing.
+    The records are written just before their output file appears, so the outputs are only re-read and compared with the recorded checksums
+    if verify is True (e.g., after files were modified or copied by hand).
+    :param manifest: CompletionManifest of the stage.
+    :param group_numbers: group numbers of the galaxies.
+    :param subgroup_numbers: subgroup numbers of the galaxies.
+    :param get_checksum: function which returns the checksum of the outputs of a galaxy given its group and subgroup numbers.
+    :param verify: also mark as incomplete the galaxies whose outputs no longer match the recorded checksum.
+    :return: group_numbers, subgroup_numbers
+    """
+    records = manifest.load()
+    is_output_file = {}  # Dictionary of output_file: whether it exists.
+    incomplete_mask = np.ones(len(group_numbers), dtype=bool)
+    for i, (group_number, subgroup_number) in enumerate(zip(group_numbers, subgroup_numbers)):
+        if (int(group_number), int(subgroup_number)) in records:
+            output_file, checksum = records[(int(group_number), int(subgroup_number))]
+            if output_file not in is_output_file:
+                is_output_file[output_file] = os.path.isfile(output_file)
+            if is_output_file[output_file] is False:  # E.g., the part file was removed.
+                incomplete_mask[i] = True
+            elif verify is True:
+                try:
+                    incomplete_mask[i] = get_checksum(group_number, subgroup_number) != checksum
+                except (KeyError, OSError):  # The output is missing or unreadable.
+                    incomplete_mask[i] = True
+            else:
+                incomplete_mask[i] = False
+    return np.asarray(group_numbers)[incomplete_mask], np.asarray(subgroup_numbers)[incomplete_mask]
+
+
+class QuarantineLog:
+    """
+    Galaxies of a stage (e.g., 'read' or 'add') which raised an exception, with the traceback of the failure. Each writer (job or worker
+    process) keeps its own files, so the failure of one galaxy never stops the others and a retry run can process only the failed ones.
+    """
+
+
+    def __init__(self, quarantine_path, stage):
+        """
+        A constructor method for the class.
+        :param quarantine_path: directory of the quarantine files.
+        :param stage: name of the stage.
+        """
+        self.quarantine_path = quarantine_path
+        self.stage = stage
+        self.sequence_numbers = {}  # Dictionary of quarantine file prefix: sequence number of its next quarantine file.
+        os.makedirs(quarantine_path, exist_ok=True)
+
+
+    def add(self, writer_name, group_number, subgroup_number, error_traceback):
+        """
+        Quarantine a galaxy in a new quarantine file of the writer.
+        :param writer_name: name of the writer (e.g., the name of its part file).
+        :param group_number: from read_add_attributes.py.
+        :param subgroup_number: from read_add_attributes.py.
+        :param error_traceback: traceback of the failure.
+        :return: None
+        """
+        def write(tmp_file):
+            with h5py.File(tmp_file, 'w') as f:
+                f.create_dataset('GroupNumber', data=np.array([group_number], dtype=np.int64))
+                f.create_dataset('SubGroupNumber', data=np.array([subgroup_number], dtype=np.int64))
+                f.create_dataset('traceback', data=[error_traceback], dtype=h5py.string_dtype())
+
+        atomic_write(get_sequence_file(self.quarantine_path + self.stage + '_' + writer_name, self.sequence_numbers), write)
+        return None
+
+
+    def load(self):
+        """
+        Load the quarantined galaxies of all writers of the stage.
+        :return: quarantine: dictionary of (GroupNumber, SubGroupNumber): traceback of the latest failure
+        """
+        quarantine = {}
+        for quarantine_file in sorted(glob.glob(self.quarantine_path + self.stage + '_*.hdf5'), key=os.path.getmtime):
+            with h5py.File(quarantine_file, 'r') as f:
+                for group_number, subgroup_number, error_traceback in zip(f['GroupNumber'][...], f['SubGroupNumber'][...],
+                                                                          f['traceback'].asstr()[...]):
+                    quarantine[(int(group_number), int(subgroup_number))] = error_traceback
+        return quarantine
+
+
+def get_quarantined_galaxies(quarantine_log, group_numbers, subgroup_numbers):
+    """
+    Get the galaxies which are quarantined.
+    :param quarantine_log: QuarantineLog of the stage.
+    :param group_numbers: group numbers of the galaxies.
+    :param subgroup_numbers: subgroup numbers of the galaxies.
+    :return: group_numbers, subgroup_numbers
+    """
+    quarantine = quarantine_log.load()
+    quarantined_mask = np.array([(int(group_number), int(subgroup_number)) in quarantine for group_number, subgroup_number in
+                                 zip(group_numbers, subgroup_numbers)], dtype=bool)
+    return np.asarray(group_numbers)[quarantined_mask], np.asarray(subgroup_numbers)[quarantined_mask]
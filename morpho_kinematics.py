@@ -1,8 +1,12 @@
 import numpy as np
-from scipy import interpolate, linalg
+import quantile_tools
+
+from scipy import linalg
 
 
 class MorphoKinematic:
+    disc_angle = np.pi / 6.0  # Maximum angular distance (in radians) of the angular momentum of a disc particle from the densest grid cell (IT20).
+
 
     @staticmethod
     def weighted_median(a, weights=None):
@@ -12,30 +16,19 @@ class MorphoKinematic:
         :param weights: Weights.
         :return: P (median)
         """
-
-        if weights is None:
-            weights = np.ones(np.array(a).shape)
-        A = np.array(a).astype('float')
-        W = np.array(weights).astype('float')
-        if not (np.product(np.isnan(A))):
-            I = np.argsort(A)
-            cumweight = np.hstack([0, np.cumsum(W[I])])
-            X = np.hstack([0, (cumweight[:-1] + cumweight[1:]) / (2 * cumweight[-1]), 1])
-            Y = np.hstack([np.min(A), A[I], np.max(A)])
-            P = interpolate.interp1d(X, Y)(0.5)
-            return float(P)
-        else:
-            return np.nan
+        P = quantile_tools.weighted_quantile(a, weights, 0.5)
+        return P
 
 
     @staticmethod
-    def kinematic_diagnostics(coordinates, masses, velocities, binding_energies):
+    def kinematic_diagnostics(coordinates, masses, velocities, binding_energies, prc_s_angular_momentum=None):
         """
         Calculate various kinematics parameters
         :param coordinates: Coordinates of particles.
         :param masses: Masses of particles.
         :param velocities: Velocities of particles.
         :param binding_energies: Specific binding energies of particles.
+        :param prc_s_angular_momentum: Specific angular momenta of particles (e.g., from GalaxyView), calculated if not provided.
         :return: kappa, disc_fraction, circularity, rotational_over_dispersion, vrots, rotational_velocity, sigma_0, delta
         """
 
@@ -45,7 +38,8 @@ class MorphoKinematic:
         glx_mass = np.sum(prc_attributes[:, 3])
 
         # Calculate the angular momenta #
-        prc_s_angular_momentum = np.cross(prc_attributes[:, :3], prc_attributes[:, 4:7])  # In kpc km s^-1.
+        if prc_s_angular_momentum is None:
+            prc_s_angular_momentum = np.cross(prc_attributes[:, :3], prc_attributes[:, 4:7])  # In kpc km s^-1.
         glx_angular_momentum = np.sum(prc_attributes[:, 3][:, np.newaxis] * prc_s_angular_momentum, axis=0)  # In Msun kpc km s^-1.
         glx_angular_momentum_magnitude = np.linalg.norm(glx_angular_momentum)  # In Msun kpc km s^-1.
 
@@ -75,7 +69,7 @@ class MorphoKinematic:
         orbi = np.median(circularity)
 
         # Calculate rotation-to-dispersion and dispersion anisotropy parameter.
-        rotational_velocity = np.abs(MorphoKinematic.weighted_median(vrots, weights=prc_attributes[:, 3]))
+        rotational_velocity = np.abs(quantile_tools.weighted_quantile(vrots, prc_attributes[:, 3], 0.5))
         sigma_xy = np.sqrt(np.average(np.sum(prc_attributes[:, [3]] * np.vstack([vrads, vrots]).T ** 2, axis=0) / glx_mass))
         sigma_0 = np.sqrt(sigma_xy ** 2 - 0.5 * rotational_velocity ** 2)
         sigma_z = np.sqrt(np.average(vheis ** 2, weights=prc_attributes[:, 3]))
@@ -179,23 +173,98 @@ class MorphoKinematic:
         return ellip, triax, Transform, abc
 
 
+    @staticmethod
+    def isotropic_disc_fraction(angle):
+        """
+        Calculate the fraction of an isotropic distribution of angular momenta which is within a given angle from any direction (i.e., the disc
+        fraction the IT20 method assigns to a non-rotating spheroid).
+        :param angle: cut angle in radians.
+        :return: chi
+        """
+        chi = 0.5 * (1 - np.cos(angle))
+        return chi
+
+
+    @staticmethod
+    def disc_fraction_sweep(angular_theta_from_densest, masses, angles):
+        """
+        Calculate the IT20 disc-to-total ratio for many cut angles with one sort, i.e., the mass fraction of the particles whose angular momentum
+        is within each angle from the densest grid cell, together with the disc-to-total ratio corrected for the contamination of an isotropic
+        spheroid.
+        :param angular_theta_from_densest: angular distance of each particle from the densest grid cell in radians (from decomposition_IT20).
+        :param masses: mass of each particle.
+        :param angles: cut angles in radians.
+        :return: disc_fractions, corrected_disc_fractions
+        """
+        # Calculate the mass within each angle (i.e., of the particles with angular_theta_from_densest<angle) from the cumulative mass #
+        sort = np.argsort(angular_theta_from_densest)
+        cumulative_mass = np.hstack([0, np.cumsum(np.asarray(masses, dtype=np.float64)[sort])])
+        index = np.searchsorted(np.asarray(angular_theta_from_densest)[sort], angles, side='left')
+        disc_fractions = cumulative_mass[index] / cumulative_mass[-1]
+
+        chi = MorphoKinematic.isotropic_disc_fraction(np.asarray(angles))
+        corrected_disc_fractions = np.divide(1, 1 - chi) * (disc_fractions - chi)
+        return disc_fractions, corrected_disc_fractions
+
+
     @staticmethod
     def r_mass(stellar_data_tmp, fraction):
         """
         Calculate the radius that contains a provided fraction of the total stellar mass.
         stellar_data_tmp: from read_add_attributes.py.
+        :param fraction: fraction (or list of fractions) of the total mass.
         :return: r_mass
         """
 
-        # Calculate the spherical distance of each particle and sort their masses based on that #
+        # Calculate the spherical distance of each particle and the cumulative mass profile #
         prc_spherical_radius = np.sqrt(np.sum(stellar_data_tmp['Coordinates'] ** 2, axis=1))
-        sort = np.argsort(prc_spherical_radius)
-        sorted_prc_spherical_radius = prc_spherical_radius[sort]
-
-        # Calculate r_50 #
-        total_mass = np.sum(stellar_data_tmp['Mass'])
-        cumulative_mass = np.cumsum(stellar_data_tmp['Mass'][sort])
-        index = np.argmin(np.abs(cumulative_mass - (fraction * total_mass)))
-        r_mass = sorted_prc_spherical_radius[index]
+        r_mass = MassProfile(prc_spherical_radius, stellar_data_tmp['Mass']).radius(fraction)
 
         return r_mass
+
+
+class MassProfile:
+    """
+    Cumulative mass profile of a set of particles (e.g., a galaxy or a component) for spherical or cylindrical radii. The particles are sorted
+    once, then each query is a binary search.
+    """
+
+
+    def __init__(self, radii, masses):
+        """
+        A constructor method for the class.
+        :param radii: spherical or cylindrical distance of each particle.
+        :param masses: mass of each particle.
+        """
+        sort = np.argsort(radii)
+        self.sorted_radii = np.asarray(radii)[sort]
+        self.cumulative_mass = np.cumsum(np.asarray(masses)[sort])
+        self.total_mass = self.cumulative_mass[-1] if len(self.cumulative_mass) > 0 else 0.0
+
+
+    def radius(self, fractions):
+        """
+        Calculate the radius that contains a provided fraction of the total mass (i.e., of the particle whose cumulative mass is the closest to
+        it).
+        :param fractions: fraction or list of fractions of the total mass (e.g., [0.2, 0.5, 0.8, 0.9]).
+        :return: radii
+        """
+        targets = np.asarray(fractions, dtype=np.float64) * self.total_mass
+        index = np.clip(np.searchsorted(self.cumulative_mass, targets), 1, len(self.cumulative_mass) - 1)
+
+        # Choose between the particles on either side of each target (the inner one on ties, as np.argmin does) #
+        inner = targets - self.cumulative_mass[index - 1] <= self.cumulative_mass[index] - targets
+        index = np.where(inner, index - 1, index)
+        if len(self.cumulative_mass) == 1:
+            index = np.zeros_like(index)
+        return self.sorted_radii[index]
+
+
+    def mass(self, radii):
+        """
+        Calculate the mass enclosed within (i.e., at radius smaller than or equal to) provided radii.
+        :param radii: radius or list of radii.
+        :return: masses
+        """
+        index = np.searchsorted(self.sorted_radii, radii, side='right')
+        return np.where(index > 0, self.cumulative_mass[np.maximum(index - 1, 0)], 0.0)
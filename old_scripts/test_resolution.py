@@ -106,12 +106,13 @@ class TestResolution:
             indices = hp.lonlat_to_healpix(ra * u.deg, dec * u.deg)  # Create a list of HEALPix indices from particles' ra and dec.
             densities = np.bincount(indices, minlength=hp.npix)  # Count number of data points in each HEALPix pixel.
 
-        # Perform a top-hat smoothing on the densities #
-        smoothed_densities = np.zeros(hp.npix)
-        # Loop over all grid cells #
-        for i in range(hp.npix):
-            mask = hlp.query_disc(nside, hlp.pix2vec(nside, i), np.pi / 6.0)  # Do a 30degree cone search around each grid cell.
-            smoothed_densities[i] = np.mean(densities[mask])  # Average the densities of the ones inside and assign this value to the grid cell.
+            # Perform a top-hat smoothing on the densities (with a cone search per grid cell, since the sparse operator of the finest grids does not
+            # fit in memory) #
+            smoothed_densities = np.zeros(hp.npix)
+            # Loop over all grid cells #
+            for i in range(hp.npix):
+                mask = hlp.query_disc(nside, hlp.pix2vec(nside, i), np.pi / 6.0)  # Do a 30degree cone search around each grid cell.
+                smoothed_densities[i] = np.mean(densities[mask])  # Average the densities of the ones inside and assign this value to the grid cell.
             
             # Find the location of the density maximum and plot its positions and the ra (lon) and dec (lat) of the galactic angular momentum #
             index_densest = np.argmax(smoothed_densities)
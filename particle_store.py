@@ -0,0 +1,511 @@
+import os
+import glob
+import h5py
+import zlib
+import shutil
+
+import numpy as np
+
+from file_tools import atomic_write
+from collections.abc import Mapping
+
+
+class GroupIndex:
+    """
+    Sort particles by (GroupNumber, SubGroupNumber) once and store the offset and length of each (sub)halo's contiguous block of particles.
+    """
+
+
+    def __init__(self, particle_data):
+        """
+        A constructor method for the class.
+        :param particle_data: dictionary of particle attributes which contains 'GroupNumber' and 'SubGroupNumber'. It is sorted in place.
+        """
+        # Sort all particle attributes by their (GroupNumber, SubGroupNumber) key #
+        keys = self.group_keys(particle_data['GroupNumber'], particle_data['SubGroupNumber'])
+        sort = np.argsort(keys, kind='stable')
+        for attribute in particle_data.keys():
+            if np.ndim(particle_data[attribute]) > 0:  # Scalar (constant-mass) columns are shared by all particles.
+                particle_data[attribute] = particle_data[attribute][sort]
+
+        # Store the unique keys and the offset and length of each block #
+        self.keys, self.offsets, self.lengths = np.unique(keys[sort], return_index=True, return_counts=True)
+
+
+    @staticmethod
+    def group_keys(group_numbers, subgroup_numbers):
+        """
+        Combine group and subgroup numbers into a single sortable 64-bit key.
+        :param group_numbers: GroupNumber of each particle/subhalo.
+        :param subgroup_numbers: SubGroupNumber of each particle/subhalo.
+        :return: keys
+        """
+        keys = np.asarray(group_numbers, dtype=np.int64) * 2 ** 32 + np.asarray(subgroup_numbers, dtype=np.int64)
+        return keys
+
+
+    def get_slice(self, group_number, subgroup_number):
+        """
+        Get the slice of the sorted particle arrays that belongs to a given galaxy.
+        :param group_number: from read_add_attributes.py.
+        :param subgroup_number: from read_add_attributes.py.
+        :return: slice(start, stop)
+        """
+        key = self.group_keys(group_number, subgroup_number)
+        index = np.searchsorted(self.keys, key)
+
+        # Return an empty slice if the galaxy has no particles of this type #
+        if index == len(self.keys) or self.keys[index] != key:
+            return slice(0, 0)
+        return slice(self.offsets[index], self.offsets[index] + self.lengths[index])
+
+
+def periodic_wrap(coordinates, centre, box_side):
+    """
+    Periodically wrap coordinates around a centre. A new array is returned so the (shared) box arrays are never modified.
+    :param coordinates: coordinates of the candidate particles.
+    :param centre: centre of potential of the galaxy.
+    :param box_side: box side length in the same units as the coordinates.
+    :return: wrapped_coordinates
+    """
+    wrapped_coordinates = np.mod(coordinates - centre + 0.5 * box_side, box_side) + centre - 0.5 * box_side
+    return wrapped_coordinates
+
+
+class GalaxyStore:
+    """
+    A ragged HDF5 store of per-galaxy particle data. Each part file holds the concatenated particle columns of every particle type and an
+    offset/length table keyed by (GroupNumber, SubGroupNumber), while the global (box and FOF) tables are stored once per run.
+    """
+    particle_types = ['stellar', 'gaseous', 'blackhole', 'dark_matter']
+
+
+    def __init__(self, store_path, compression=None):
+        """
+        A constructor method for the class.
+        :param store_path: directory of the store.
+        :param compression: HDF5 compression filter of the particle columns ('gzip', 'lzf' or None).
+        """
+        self.store_path = store_path
+        self.compression = compression
+        self.galaxies = []  # Galaxies buffered until the next flush.
+        self.attributes = []  # Attributes buffered until the next flush_attributes.
+        self.index = None  # Dictionary of (GroupNumber, SubGroupNumber): (part_file, row), built on first read.
+        if not os.path.exists(store_path):
+            os.makedirs(store_path, exist_ok=True)
+
+
+    def write_global(self, box_data, FOF_data):
+        """
+        Save the global box and FOF tables once per run.
+        :param box_data: from read_add_attributes.py.
+        :param FOF_data: from read_add_attributes.py.
+        :return: None
+        """
+        global_file = self.store_path + 'global_data.hdf5'
+        if os.path.isfile(global_file):
+            return None
+
+        # Write the tables through a temporary file, so concurrent jobs never see a half-written file #
+        def write(tmp_file):
+            with h5py.File(tmp_file, 'w') as f:
+                for attribute in box_data.keys():
+                    f.create_dataset('box_data/' + attribute, data=box_data[attribute])
+                for attribute in FOF_data.keys():
+                    f.create_dataset('FOF_data/' + attribute, data=FOF_data[attribute], compression=self.compression)
+
+        atomic_write(global_file, write)
+        return None
+
+
+    def add_galaxy(self, group_number, subgroup_number, subhalo_data_tmp, stellar_data_tmp, gaseous_data_tmp, blackhole_data_tmp,
+                   dark_matter_data_tmp, attributes=None):
+        """
+        Buffer the data of a galaxy until the next flush.
+        :param group_number: from read_add_attributes.py.
+        :param subgroup_number: from read_add_attributes.py.
+        :param subhalo_data_tmp: from mask_galaxies.
+        :param stellar_data_tmp: from mask_galaxies.
+        :param gaseous_data_tmp: from mask_galaxies.
+        :param blackhole_data_tmp: from mask_galaxies.
+        :param dark_matter_data_tmp: from mask_galaxies.
+        :param attributes: dictionary of particle_type: attributes which are not particle columns (e.g., the ones calculated by AddAttributes),
+        saved with the galaxy so they never have to be added to the part file later.
+        :return: None
+        """
+        self.galaxies.append((group_number, subgroup_number, subhalo_data_tmp,
+                              [stellar_data_tmp, gaseous_data_tmp, blackhole_data_tmp, dark_matter_data_tmp], attributes))
+        return None
+
+
+    def flush(self, part_name, on_write=None):
+        """
+        Write the buffered galaxies into a new part file of the store.
+        :param part_name: name of the part file (e.g., 'part_<job_number>').
+        :param on_write: function called with (part_file, group_numbers, subgroup_numbers, checksums, attributes_checksums) once the part file has
+        been written but before it appears in the store (e.g., to record the galaxies as completed). The attributes checksum of a galaxy which
+        was buffered without attributes is None.
+        :return: None
+        """
+        if len(self.galaxies) == 0:
+            return None
+
+        part_file = self.store_path + part_name + '.hdf5'
+
+        # Write the part file through a temporary file and record its galaxies before it appears in the store #
+        def write(tmp_file):
+            with h5py.File(tmp_file, 'w') as f:
+                # Save the galaxy table and the subhalo attributes (one row per galaxy) #
+                f.create_dataset('Galaxies/GroupNumber', data=np.array([galaxy[0] for galaxy in self.galaxies]))
+                f.create_dataset('Galaxies/SubGroupNumber', data=np.array([galaxy[1] for galaxy in self.galaxies]))
+                for attribute in self.galaxies[0][2].keys():
+                    f.create_dataset('Subhalo/' + attribute, data=np.concatenate([galaxy[2][attribute] for galaxy in self.galaxies]))
+
+                # Concatenate the particle columns of each particle type and save the offset and length of each galaxy #
+                for i, particle_type in enumerate(self.particle_types):
+                    lengths = np.array([len(galaxy[3][i]['Coordinates']) for galaxy in self.galaxies], dtype=np.int64)
+                    f.create_dataset('Galaxies/' + particle_type + '_lengths', data=lengths)
+                    f.create_dataset('Galaxies/' + particle_type + '_offsets', data=np.cumsum(lengths) - lengths)
+                    for attribute in self.galaxies[0][3][i].keys():
+                        column = np.concatenate([galaxy[3][i][attribute] for galaxy in self.galaxies])
+                        f.create_dataset(particle_type + '/' + attribute, data=column, compression=self.compression if column.size > 0 else None)
+
+                # Save the attributes which were buffered with the galaxies #
+                for galaxy in self.galaxies:
+                    if galaxy[4] is not None:
+                        for particle_type, data_tmp in galaxy[4].items():
+                            for attribute in data_tmp.keys():
+                                f.create_dataset('Attributes/' + str(galaxy[0]) + '_' + str(galaxy[1]) + '/' + particle_type + '/' + attribute,
+                                                 data=np.asarray(data_tmp[attribute]))
+
+            if on_write is not None:
+                on_write(part_file, [galaxy[0] for galaxy in self.galaxies], [galaxy[1] for galaxy in self.galaxies],
+                         [self.checksum(galaxy[2], galaxy[3]) for galaxy in self.galaxies],
+                         [self.attributes_checksum(galaxy[4]) if galaxy[4] is not None else None for galaxy in self.galaxies])
+
+        atomic_write(part_file, write)
+
+        self.galaxies = []
+        self.index = None
+        return None
+
+
+    def remove_parts(self, referenced_files):
+        """
+        Remove the part files which are not referenced (e.g., by the completion records of a stage), i.e., those left by a failed run.
+        :param referenced_files: function which returns the referenced part files. It is called after the part files have been listed, so a
+        part file which is referenced before it appears in the store is never removed.
+        :return: None
+        """
+        part_files = glob.glob(self.store_path + 'part_*.hdf5')
+        referenced_files = set(referenced_files())
+        for part_file in part_files:
+            if part_file not in referenced_files:
+                os.remove(part_file)
+        self.index = None
+        return None
+
+
+    @staticmethod
+    def checksum(subhalo_data_tmp, particle_data):
+        """
+        Calculate the checksum of the subhalo attributes and particle columns of a galaxy.
+        :param subhalo_data_tmp: dictionary of subhalo attributes.
+        :param particle_data: list of dictionaries of particle attributes (one per GalaxyStore.particle_types).
+        :return: checksum
+        """
+        checksum = 0
+        for data in [subhalo_data_tmp] + list(particle_data):
+            for attribute in sorted(data.keys()):
+                checksum = zlib.crc32(np.ascontiguousarray(data[attribute]).tobytes(), checksum)
+        return checksum
+
+
+    def get_checksum(self, group_number, subgroup_number):
+        """
+        Calculate the checksum of the subhalo attributes and particle columns of a galaxy in the store (attributes added later are excluded).
+        :param group_number: from read_add_attributes.py.
+        :param subgroup_number: from read_add_attributes.py.
+        :return: checksum
+        """
+        part_file, row = self.get_location(group_number, subgroup_number)
+
+        with h5py.File(part_file, 'r') as f:
+            subhalo_data_tmp = {name:dataset[row:row + 1] for name, dataset in self.get_datasets(f['Subhalo']).items()}
+            particle_data = []
+            for particle_type in self.particle_types:
+                offset = f['Galaxies/' + particle_type + '_offsets'][row]
+                length = f['Galaxies/' + particle_type + '_lengths'][row]
+                particle_data.append({name:dataset[offset:offset + length] for name, dataset in self.get_datasets(f[particle_type]).items()})
+        return self.checksum(subhalo_data_tmp, particle_data)
+
+
+    @staticmethod
+    def attributes_checksum(attributes):
+        """
+        Calculate the checksum of the attributes of a galaxy which are not particle columns.
+        :param attributes: dictionary of particle_type: attributes.
+        :return: checksum
+        """
+        attributes_data = [{name:np.asarray(value) for name, value in attributes[particle_type].items()} for particle_type in sorted(attributes)]
+        return GalaxyStore.checksum({}, attributes_data)
+
+
+    def get_attributes_checksum(self, group_number, subgroup_number):
+        """
+        Calculate the checksum of the attributes saved for a galaxy after it was extracted.
+        :param group_number: from read_add_attributes.py.
+        :param subgroup_number: from read_add_attributes.py.
+        :return: checksum
+        """
+        part_file, row = self.get_location(group_number, subgroup_number)
+
+        with h5py.File(part_file, 'r') as f:
+            checksum = self.read_attributes_checksum(f, group_number, subgroup_number)
+        return checksum
+
+
+    @staticmethod
+    def read_attributes_checksum(f, group_number, subgroup_number):
+        """
+        Calculate the checksum of the attributes saved for a galaxy in an open part file.
+        :param f: HDF5 part file.
+        :param group_number: from read_add_attributes.py.
+        :param subgroup_number: from read_add_attributes.py.
+        :return: checksum
+        """
+        attributes = {}
+        attributes_group = 'Attributes/' + str(group_number) + '_' + str(subgroup_number)
+        if attributes_group in f:
+            for particle_type in f[attributes_group].keys():
+                datasets = GalaxyStore.get_datasets(f[attributes_group + '/' + particle_type])
+                attributes[particle_type] = {name:dataset[()] for name, dataset in datasets.items()}
+        return GalaxyStore.attributes_checksum(attributes)
+
+
+    def get_index(self):
+        """
+        Map each (GroupNumber, SubGroupNumber) to the part file and row that contain it.
+        :return: index
+        """
+        if self.index is None:
+            self.index = {}
+            for part_file in sorted(glob.glob(self.store_path + 'part_*.hdf5')):
+                with h5py.File(part_file, 'r') as f:
+                    for row, (group_number, subgroup_number) in enumerate(zip(f['Galaxies/GroupNumber'][...], f['Galaxies/SubGroupNumber'][...])):
+                        self.index[(int(group_number), int(subgroup_number))] = (part_file, row)
+        return self.index
+
+
+    def get_location(self, group_number, subgroup_number):
+        """
+        Get the part file and row that contain a galaxy.
+        :param group_number: from read_add_attributes.py.
+        :param subgroup_number: from read_add_attributes.py.
+        :return: part_file, row
+        """
+        location = self.get_index().get((int(group_number), int(subgroup_number)))
+        if location is None:
+            raise KeyError('Halo ' + str(group_number) + '_' + str(subgroup_number) + ' is not in the galaxy store ' + self.store_path)
+        return location
+
+
+    def load_global(self):
+        """
+        Load the global box and FOF tables.
+        :return: box_data, FOF_data
+        """
+        with h5py.File(self.store_path + 'global_data.hdf5', 'r') as f:
+            box_data = {name:dataset[()] for name, dataset in self.get_datasets(f['box_data']).items()}
+            FOF_data = {name:dataset[...] for name, dataset in self.get_datasets(f['FOF_data']).items()}
+        return box_data, FOF_data
+
+
+    def load_galaxy(self, group_number, subgroup_number, particle_type):
+        """
+        Load the particle columns (or subhalo attributes) of a galaxy as a slice of the store, together with any attributes added later.
+        :param group_number: from read_add_attributes.py.
+        :param subgroup_number: from read_add_attributes.py.
+        :param particle_type: 'subhalo' or one of GalaxyStore.particle_types.
+        :return: data_tmp
+        """
+        part_file, row = self.get_location(group_number, subgroup_number)
+
+        data_tmp = {}
+        with h5py.File(part_file, 'r') as f:
+            if particle_type == 'subhalo':
+                for name, dataset in self.get_datasets(f['Subhalo']).items():
+                    data_tmp[name] = dataset[row:row + 1]
+            else:
+                offset = f['Galaxies/' + particle_type + '_offsets'][row]
+                length = f['Galaxies/' + particle_type + '_lengths'][row]
+                for name, dataset in self.get_datasets(f[particle_type]).items():
+                    data_tmp[name] = dataset[offset:offset + length]
+
+            # Add the attributes that were saved for this galaxy after it was extracted #
+            attributes_group = 'Attributes/' + str(group_number) + '_' + str(subgroup_number) + '/' + particle_type
+            if attributes_group in f:
+                for name, dataset in self.get_datasets(f[attributes_group]).items():
+                    data_tmp[name] = dataset[()]
+
+        return data_tmp
+
+
+    def load_lazy_galaxy(self, group_number, subgroup_number, particle_type):
+        """
+        Get a lazy view of a galaxy whose columns are memory-mapped and read only when accessed.
+        :param group_number: from read_add_attributes.py.
+        :param subgroup_number: from read_add_attributes.py.
+        :param particle_type: 'subhalo' or one of GalaxyStore.particle_types.
+        :return: LazyGalaxy
+        """
+        part_file, row = self.get_location(group_number, subgroup_number)
+        return LazyGalaxy(part_file, row, group_number, subgroup_number, particle_type)
+
+
+    def save_attributes(self, group_number, subgroup_number, particle_type, data_tmp):
+        """
+        Buffer the attributes of a galaxy that are not particle columns of the store (e.g., the ones calculated by AddAttributes) until the next
+        flush_attributes.
+        :param group_number: from read_add_attributes.py.
+        :param subgroup_number: from read_add_attributes.py.
+        :param particle_type: 'subhalo' or one of GalaxyStore.particle_types.
+        :param data_tmp: dictionary of attributes.
+        :return: None
+        """
+        part_file, row = self.get_location(group_number, subgroup_number)
+        self.attributes.append((part_file, group_number, subgroup_number, particle_type, data_tmp))
+        return None
+
+
+    def flush_attributes(self, on_write=None):
+        """
+        Save the buffered attributes. Each part file is copied, the attributes are written in the copy and the copy then replaces the part file,
+        so a failed job never leaves a completed part file half-written.
+        :param on_write: function called with (part_file, group_numbers, subgroup_numbers, attributes_checksums) once the copy of a part file has
+        been written but before it replaces the part file (e.g., to record the galaxies as completed).
+        :return: None
+        """
+        # Write the attributes of a part file in a copy of it and record its galaxies before the copy replaces the part file #
+        def write(tmp_file, part_file):
+            shutil.copyfile(part_file, tmp_file)
+            haloes = []  # List of (GroupNumber, SubGroupNumber) of the part file in the order they were buffered.
+            with h5py.File(tmp_file, 'r+') as f:
+                for attributes_part_file, group_number, subgroup_number, particle_type, data_tmp in self.attributes:
+                    if attributes_part_file != part_file:
+                        continue
+                    if (group_number, subgroup_number) not in haloes:
+                        haloes.append((group_number, subgroup_number))
+
+                    columns_group = 'Subhalo' if particle_type == 'subhalo' else particle_type
+                    columns = self.get_datasets(f[columns_group]).keys() if columns_group in f else []  # E.g., 'versions' has no particle columns.
+                    attributes_group = f.require_group('Attributes/' + str(group_number) + '_' + str(subgroup_number) + '/' + particle_type)
+                    for attribute in data_tmp.keys():
+                        if attribute in columns:
+                            continue
+                        if attribute in attributes_group:
+                            del attributes_group[attribute]
+                        attributes_group.create_dataset(attribute, data=np.asarray(data_tmp[attribute]))
+                attributes_checksums = [self.read_attributes_checksum(f, group_number, subgroup_number) for group_number, subgroup_number in haloes]
+
+            if on_write is not None:
+                on_write(part_file, [halo[0] for halo in haloes], [halo[1] for halo in haloes], attributes_checksums)
+
+        for part_file in sorted(set(attributes[0] for attributes in self.attributes)):
+            atomic_write(part_file, lambda tmp_file:write(tmp_file, part_file))
+
+        self.attributes = []
+        return None
+
+
+    def load_versions(self, group_number, subgroup_number):
+        """
+        Load the versions of the AddAttributes computations whose outputs are saved for a galaxy.
+        :param group_number: from read_add_attributes.py.
+        :param subgroup_number: from read_add_attributes.py.
+        :return: versions: dictionary of computation: version
+        """
+        part_file, row = self.get_location(group_number, subgroup_number)
+
+        with h5py.File(part_file, 'r') as f:
+            versions_group = 'Attributes/' + str(group_number) + '_' + str(subgroup_number) + '/versions'
+            versions = {name:int(dataset[()]) for name, dataset in self.get_datasets(f[versions_group]).items()} if versions_group in f else {}
+        return versions
+
+
+    @staticmethod
+    def get_datasets(group):
+        """
+        Get all datasets under an HDF5 group, keyed by their path relative to the group (e.g., 'ApertureMeasurements/Mass/030kpc').
+        :param group: HDF5 group.
+        :return: datasets
+        """
+        datasets = {}
+        group.visititems(lambda name, item:datasets.update({name:item}) if isinstance(item, h5py.Dataset) else None)
+        return datasets
+
+
+class LazyGalaxy(Mapping):
+    """
+    A dictionary-like view of a galaxy in the galaxy store. Each column is memory-mapped (or read as a slice if it is compressed) only when it
+    is accessed, so scripts that need a few columns never read the full per-galaxy payload.
+    """
+
+
+    def __init__(self, part_file, row, group_number, subgroup_number, particle_type):
+        """
+        A constructor method for the class.
+        :param part_file: part file of the galaxy store that contains the galaxy.
+        :param row: row of the galaxy in the part file.
+        :param group_number: from read_add_attributes.py.
+        :param subgroup_number: from read_add_attributes.py.
+        :param particle_type: 'subhalo' or one of GalaxyStore.particle_types.
+        """
+        self.part_file = part_file
+        self.columns = {}  # Dictionary of name: (dataset path, start, stop, file offset, dtype, shape).
+        self.cache = {}
+
+        with h5py.File(part_file, 'r') as f:
+            # Find the slice of the galaxy in the particle columns (or its row in the subhalo table) #
+            if particle_type == 'subhalo':
+                group_path, start, stop = 'Subhalo', row, row + 1
+            else:
+                group_path = particle_type
+                start = f['Galaxies/' + particle_type + '_offsets'][row]
+                stop = start + f['Galaxies/' + particle_type + '_lengths'][row]
+            for name, dataset in GalaxyStore.get_datasets(f[group_path]).items():
+                self.columns[name] = (group_path + '/' + name, start, stop, dataset.id.get_offset(), dataset.dtype, dataset.shape)
+
+            # Add the attributes that were saved for this galaxy after it was extracted #
+            attributes_path = 'Attributes/' + str(group_number) + '_' + str(subgroup_number) + '/' + particle_type
+            if attributes_path in f:
+                for name, dataset in GalaxyStore.get_datasets(f[attributes_path]).items():
+                    self.columns[name] = (attributes_path + '/' + name, None, None, None, dataset.dtype, dataset.shape)
+
+
+    def __getitem__(self, name):
+        """
+        Memory-map or read a column on first access.
+        :param name: name of the column.
+        :return: column
+        """
+        if name not in self.cache:
+            dataset_path, start, stop, file_offset, dtype, shape = self.columns[name]
+
+            # Memory-map contiguous (uncompressed) particle columns, otherwise read the slice through HDF5 #
+            if file_offset is not None and start is not None:
+                row_size = dtype.itemsize * int(np.prod(shape[1:]))
+                self.cache[name] = np.memmap(self.part_file, dtype=dtype, mode='r', offset=file_offset + start * row_size,
+                                             shape=(stop - start,) + shape[1:])
+            else:
+                with h5py.File(self.part_file, 'r') as f:
+                    self.cache[name] = f[dataset_path][start:stop] if start is not None else f[dataset_path][()]
+        return self.cache[name]
+
+
+    def __iter__(self):
+        return iter(self.columns)
+
+
+    def __len__(self):
+        return len(self.columns)
@@ -1,5 +1,6 @@
 import numpy as np
-import healpy as hlp
+import healpix_tools
+import quantile_tools
 import astropy.units as u
 import matplotlib.pyplot as plt
 
@@ -10,32 +11,87 @@ from morpho_kinematics import MorphoKinematic
 
 class RotateCoordinates:
     """
-    Rotate coordinates and velocities wrt different quantities.
+    Rotate coordinates and velocities wrt different quantities. Each frame is a single 3x3 rotation matrix which is applied to all vector
+    columns (e.g., coordinates, velocities, angular momenta) at once.
     """
 
 
     @staticmethod
-    def rotate_X(stellar_data_tmp, glx_unit_vector):
+    def get_rotation_X(unit_vector):
+        """
+        Get the rotation matrix which rotates first about the z-axis to set y=0 and then about the y-axis to set z=0 for the given vector.
+        :param unit_vector: unit vector which is rotated along the x-axis.
+        :return: Ryz
+        """
+        ra = np.arctan2(unit_vector[1], unit_vector[0])
+        el = np.arcsin(unit_vector[2])
+
+        Rz = np.array([[np.cos(ra), np.sin(ra), 0], [-np.sin(ra), np.cos(ra), 0], [0, 0, 1]])
+        Ry = np.array([[np.cos(el), 0, np.sin(el)], [0, 1, 0], [-np.sin(el), 0, np.cos(el)]])
+        Ryz = np.matmul(Ry, Rz)
+        return Ryz
+
+
+    @staticmethod
+    def get_rotation_Jz(angular_momentum):
+        """
+        Get the rotation matrix which rotates the given vector along the z-axis.
+        :param angular_momentum: vector which is rotated along the z-axis.
+        :return: transform
+        """
+        a = np.asarray(angular_momentum, dtype=np.float64) / np.linalg.norm(angular_momentum)
+        b = np.array([0.0, 0.0, 1.0])
+        v = np.cross(a, b)
+        s = np.linalg.norm(v)
+        c = np.dot(a, b)
+        if s == 0:  # The vector is already along the z-axis (or opposite to it).
+            return np.eye(3) if c > 0 else np.diag([1.0, -1.0, -1.0])
+        vx = np.array([[0, -v[2], v[1]], [v[2], 0, -v[0]], [-v[1], v[0], 0]])
+        transform = np.eye(3) + vx + np.matmul(vx, vx) * ((1 - c) / s ** 2)
+        return transform
+
+
+    @staticmethod
+    def apply_rotation(rotation, columns, in_place=False, dtype=None):
+        """
+        Rotate vector columns with a single matrix product each.
+        :param rotation: 3x3 rotation matrix.
+        :param columns: list of (N, 3) arrays.
+        :param in_place: overwrite the columns with their rotated values instead of allocating new arrays (the columns must be arrays of dtype).
+        :param dtype: dtype of the rotated columns (e.g., np.float32 to halve the memory), default: the dtype of each column.
+        :return: list of rotated columns
+        """
+        rotated_columns = []
+        for column in columns:
+            converted_column = np.asarray(column) if dtype is None else np.asarray(column, dtype=dtype)
+            if in_place is True and converted_column is not column:
+                raise ValueError('Cannot rotate in place a column that is not an array of dtype ' + str(converted_column.dtype))
+            column = converted_column
+            rotation_T = rotation.T.astype(column.dtype)
+            rotated_columns.append(np.matmul(column, rotation_T, out=column) if in_place is True else np.matmul(column, rotation_T))
+        return rotated_columns
+
+
+    @staticmethod
+    def rotate_X(stellar_data_tmp, glx_unit_vector, prc_angular_momentum=None):
         """
         Rotate first about z-axis to set y=0 and then about the y-axis to set z=0
         :param stellar_data_tmp: from read_add_attributes.py.
         :param glx_unit_vector: from mask_galaxies
+        :param prc_angular_momentum: angular momentum of each particle (e.g., from GalaxyView), calculated if not provided.
         :return: stellar_data_tmp['Coordinates'], stellar_data_tmp['Velocity'], prc_unit_vector, glx_unit_vector
         """
         # Calculate the rotation matrices and combine them #
-        ra = np.arctan2(glx_unit_vector[1], glx_unit_vector[0])
-        el = np.arcsin(glx_unit_vector[2])
-
-        Rz = np.array([[np.cos(ra), np.sin(ra), 0], [-np.sin(ra), np.cos(ra), 0], [0, 0, 1]])
-        Ry = np.array([[np.cos(el), 0, np.sin(el)], [0, 1, 0], [-np.sin(el), 0, np.cos(el)]])
-        Ryz = np.matmul(Ry, Rz)
+        Ryz = RotateCoordinates.get_rotation_X(glx_unit_vector)
 
         # Rotate the coordinates and velocities of stellar particles #
-        coordinates = np.matmul(Ryz, stellar_data_tmp['Coordinates'][..., None]).squeeze()
-        velocities = np.matmul(Ryz, stellar_data_tmp['Velocity'][..., None]).squeeze()
+        if prc_angular_momentum is None:
+            prc_angular_momentum = stellar_data_tmp['Mass'][:, np.newaxis] * np.cross(stellar_data_tmp['Coordinates'],
+                                                                                      stellar_data_tmp['Velocity'])  # In Msun kpc km s^-1.
+        coordinates, velocities, prc_angular_momentum = RotateCoordinates.apply_rotation(Ryz, [stellar_data_tmp['Coordinates'],
+                                                                                               stellar_data_tmp['Velocity'], prc_angular_momentum])
 
-        # Recalculate the angular momentum for each particle and for the galaxy and the unit vector parallel to the galactic angular momentum vector #
-        prc_angular_momentum = stellar_data_tmp['Mass'][:, np.newaxis] * np.cross(coordinates, velocities)  # In Msun kpc km s^-1.
+        # Calculate the rotated angular momentum for the galaxy and the unit vectors parallel to the angular momentum vectors #
         glx_angular_momentum = np.sum(prc_angular_momentum, axis=0)  # In Msun kpc km s^-1.
         glx_unit_vector = glx_angular_momentum / np.linalg.norm(glx_angular_momentum)
         prc_unit_vector = prc_angular_momentum / np.linalg.norm(prc_angular_momentum, axis=1)[:, np.newaxis]
@@ -62,11 +118,7 @@ class RotateCoordinates:
         densities = np.bincount(indices, minlength=hp.npix)  # Count number of data points in each HEALPix grid cell.
 
         # Perform a top-hat smoothing on the densities #
-        smoothed_densities = np.zeros(hp.npix)
-        # Loop over all grid cells #
-        for i in range(hp.npix):
-            mask = hlp.query_disc(nside, hlp.pix2vec(nside, i), np.pi / 6.0)  # Do a 30degree cone search around each grid cell.
-            smoothed_densities[i] = np.mean(densities[mask])  # Average the densities of the ones inside and assign this value to the grid cell.
+        smoothed_densities = healpix_tools.smooth(densities, nside)  # Average the densities within a 30degree cone around each grid cell.
 
         # Find location of density maximum and plot its positions and the ra (lon) and el (lat) of the galactic angular momentum #
         index_densest = np.argmax(smoothed_densities)
@@ -74,52 +126,38 @@ class RotateCoordinates:
         lat_densest = (hp.healpix_to_lonlat([index_densest])[1].value + np.pi / 2) % (2 * np.pi) - np.pi / 2
 
         # Calculate the rotation matrices and combine them #
-        ra = np.float(lon_densest)
-        el = np.float(lat_densest)
         print(densities[index_densest])
-        # ra = np.arctan2(glx_unit_vector[1], glx_unit_vector[0])
-        # el = np.arcsin(glx_unit_vector[2])
-
-        Rz = np.array([[np.cos(ra), np.sin(ra), 0], [-np.sin(ra), np.cos(ra), 0], [0, 0, 1]])
-        Ry = np.array([[np.cos(el), 0, np.sin(el)], [0, 1, 0], [-np.sin(el), 0, np.cos(el)]])
-        Ryz = np.matmul(Ry, Rz)
+        densest_unit_vector = np.array([np.cos(lat_densest[0]) * np.cos(lon_densest[0]), np.cos(lat_densest[0]) * np.sin(lon_densest[0]),
+                                        np.sin(lat_densest[0])])
+        Ryz = RotateCoordinates.get_rotation_X(densest_unit_vector)
 
-        prc_unit_vector = np.matmul(Ryz, prc_unit_vector[..., None]).squeeze()
+        prc_unit_vector, = RotateCoordinates.apply_rotation(Ryz, [prc_unit_vector])
         glx_unit_vector = np.matmul(Ryz, glx_unit_vector)
 
         return prc_unit_vector, glx_unit_vector
 
 
     @staticmethod
-    def rotate_Jz(stellar_data_tmp):
+    def rotate_Jz(stellar_data_tmp, prc_angular_momentum=None):
         """
         Rotate a galaxy such that its angular momentum is along the z axis.
         :param stellar_data_tmp: from read_add_attributes.py.
+        :param prc_angular_momentum: angular momentum of each particle (e.g., from GalaxyView), calculated if not provided.
         :return: coordinates, velocities, prc_angular_momentum, glx_angular_momentum
         """
-
         # Calculate the angular momentum of the galaxy #
-        prc_angular_momentum = stellar_data_tmp['Mass'][:, np.newaxis] * np.cross(stellar_data_tmp['Coordinates'],
-                                                                                  stellar_data_tmp['Velocity'])  # In Msun kpc km s^-1.
+        if prc_angular_momentum is None:
+            prc_angular_momentum = stellar_data_tmp['Mass'][:, np.newaxis] * np.cross(stellar_data_tmp['Coordinates'],
+                                                                                      stellar_data_tmp['Velocity'])  # In Msun kpc km s^-1.
         glx_angular_momentum = np.sum(prc_angular_momentum, axis=0)  # In Msun kpc km s^-1.
 
-        # Define the rotation matrices #
-        a = np.matrix([glx_angular_momentum[0], glx_angular_momentum[1], glx_angular_momentum[2]]) / np.linalg.norm(
-            [glx_angular_momentum[0], glx_angular_momentum[1], glx_angular_momentum[2]])
-        b = np.matrix([0, 0, 1])
-        v = np.cross(a, b)
-        s = np.linalg.norm(v)
-        c = np.dot(a, b.T)
-        vx = np.matrix([[0, -v[0, 2], v[0, 1]], [v[0, 2], 0, -v[0, 0]], [-v[0, 1], v[0, 0], 0]])
-        transform = np.eye(3, 3) + vx + (vx * vx) * ((1 - c[0, 0]) / s ** 2)
-
-        # Rotate the coordinates and velocities #
-        coordinates = np.array([np.matmul(transform, stellar_data_tmp['Coordinates'][i].T) for i in range(0, len(stellar_data_tmp['Coordinates']))])[
-                      :, 0]
-        velocities = np.array([np.matmul(transform, stellar_data_tmp['Velocity'][i].T) for i in range(0, len(stellar_data_tmp['Velocity']))])[:, 0]
+        # Rotate the coordinates, velocities and angular momenta #
+        transform = RotateCoordinates.get_rotation_Jz(glx_angular_momentum)
+        coordinates, velocities, prc_angular_momentum = RotateCoordinates.apply_rotation(transform, [stellar_data_tmp['Coordinates'],
+                                                                                                     stellar_data_tmp['Velocity'],
+                                                                                                     prc_angular_momentum])
 
         # Calculate the rotated angular momentum of the galaxy #
-        prc_angular_momentum = stellar_data_tmp['Mass'][:, np.newaxis] * np.cross(coordinates, velocities)  # In Msun kpc km s^-1.
         glx_angular_momentum = np.sum(prc_angular_momentum, axis=0)  # In Msun kpc km s^-1.
 
         return coordinates, velocities, prc_angular_momentum, glx_angular_momentum
@@ -135,30 +173,41 @@ class RotateCoordinates:
         # Select on particles that belong to the component #
         component_data = {}
         for attribute in ['Coordinates', 'Mass', 'Velocity']:
-            component_data[attribute] = np.copy(stellar_data_tmp[attribute])[mask]
+            component_data[attribute] = stellar_data_tmp[attribute][mask]
 
         # Calculate the angular momentum of the component #
         prc_angular_momentum = component_data['Mass'][:, np.newaxis] * np.cross(component_data['Coordinates'],
                                                                                 component_data['Velocity'])  # In Msun kpc km s^-1.
         component_angular_momentum = np.sum(prc_angular_momentum, axis=0)  # In Msun kpc km s^-1.
 
-        # Define the rotation matrices #
-        a = np.matrix([component_angular_momentum[0], component_angular_momentum[1], component_angular_momentum[2]]) / np.linalg.norm(
-            [component_angular_momentum[0], component_angular_momentum[1], component_angular_momentum[2]])
-        b = np.matrix([0, 0, 1])
-        v = np.cross(a, b)
-        s = np.linalg.norm(v)
-        c = np.dot(a, b.T)
-        vx = np.matrix([[0, -v[0, 2], v[0, 1]], [v[0, 2], 0, -v[0, 0]], [-v[0, 1], v[0, 0], 0]])
-        transform = np.eye(3, 3) + vx + (vx * vx) * ((1 - c[0, 0]) / s ** 2)
-
         # Rotate the coordinates and velocities #
-        coordinates = np.array([np.matmul(transform, component_data['Coordinates'][i].T) for i in range(0, len(component_data['Coordinates']))])[:, 0]
-        velocities = np.array([np.matmul(transform, component_data['Velocity'][i].T) for i in range(0, len(component_data['Velocity']))])[:, 0]
+        transform = RotateCoordinates.get_rotation_Jz(component_angular_momentum)
+        coordinates, velocities = RotateCoordinates.apply_rotation(transform, [component_data['Coordinates'], component_data['Velocity']])
 
         return coordinates, velocities, component_data
 
 
+def binned_statistics(x_data, y_data, x, edges):
+    """
+    Calculate the mean x and the median and 1-sigma lines of y in bins with a single sort.
+    :param x_data: x-axis data.
+    :param y_data: y-axis data.
+    :param x: x-axis data used for the binning (e.g., log10(x_data)).
+    :param edges: edges of the bins, a point belongs to a bin if edges[i] <= x < edges[i + 1].
+    :return: x_value, median, shigh, slow, counts
+    """
+    n_bins = len(edges) - 1
+    bins = np.searchsorted(edges, x, side='right') - 1
+    bins[(bins < 0) | (bins >= n_bins)] = n_bins  # Points outside the bins.
+
+    counts = np.bincount(bins, minlength=n_bins + 1)[:n_bins]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        x_value = np.bincount(bins, weights=x_data, minlength=n_bins + 1)[:n_bins] / counts
+    slow, median, shigh = quantile_tools.segmented_quantiles(y_data, bins, n_bins, [0.1587, 0.5, 0.8413]).T
+
+    return x_value, median, shigh, slow, counts
+
+
 def median_1sigma(x_data, y_data, delta, log):
     """
     Calculate the median and 1-sigma lines.
@@ -168,27 +217,15 @@ def median_1sigma(x_data, y_data, delta, log):
     :param log: boolean.
     :return: x_value, median, shigh, slow
     """
-    # Initialise arrays #
     if log is True:
         x = np.log10(x_data)
     else:
         x = x_data
-    n_bins = int((max(x) - min(x)) / delta)
-    x_value = np.empty(n_bins)
-    median = np.empty(n_bins)
-    slow = np.empty(n_bins)
-    shigh = np.empty(n_bins)
-    x_low = min(x)
-
-    # Loop over all bins and calculate the median and 1-sigma lines #
-    for i in range(n_bins):
-        index, = np.where((x >= x_low) & (x < x_low + delta))
-        x_value[i] = np.mean(x_data[index])
-        if len(index) > 0:
-            median[i] = np.nanmedian(y_data[index])
-        slow[i] = np.nanpercentile(y_data[index], 15.87)
-        shigh[i] = np.nanpercentile(y_data[index], 84.13)
-        x_low += delta
+    n_bins = int((np.max(x) - np.min(x)) / delta)
+    edges = np.cumsum(np.hstack([np.min(x), np.full(n_bins, delta)]))  # As adding delta to the lower edge for each bin.
+
+    # Calculate the median and 1-sigma lines in all bins #
+    x_value, median, shigh, slow, counts = binned_statistics(x_data, y_data, x, edges)
 
     return x_value, median, shigh, slow
 
@@ -209,21 +246,11 @@ def binned_median_1sigma(x_data, y_data, bin_type, n_bins, log=False):
         else:
             x = x_data
 
-        # Declare arrays to store the data #
-        n_bins = np.quantile(np.sort(x), np.linspace(0, 1, n_bins + 1))
-        slow = np.zeros(len(n_bins))
-        shigh = np.zeros(len(n_bins))
-        median = np.zeros(len(n_bins))
-        x_value = np.zeros(len(n_bins))
-
-        # Loop over all bins and calculate the median and 1-sigma lines #
-        for i in range(len(n_bins) - 1):
-            index, = np.where((x >= n_bins[i]) & (x < n_bins[i + 1]))
-            x_value[i] = np.mean(x_data[index])
-            if len(index) > 0:
-                median[i] = np.nanmedian(y_data[index])
-                slow[i] = np.nanpercentile(y_data[index], 15.87)
-                shigh[i] = np.nanpercentile(y_data[index], 84.13)
+        # Calculate the median and 1-sigma lines in all bins (the last element corresponds to the upper edge) #
+        edges = np.quantile(np.sort(x), np.linspace(0, 1, n_bins + 1))
+        x_value, median, shigh, slow, counts = binned_statistics(x_data, y_data, x, edges)
+        median, shigh, slow = [np.where(counts > 0, array, 0) for array in [median, shigh, slow]]
+        x_value, median, shigh, slow = [np.hstack([array, 0]) for array in [x_value, median, shigh, slow]]
 
         return x_value, median, shigh, slow
 
@@ -232,24 +259,12 @@ def binned_median_1sigma(x_data, y_data, bin_type, n_bins, log=False):
             x = np.log10(x_data)
         else:
             x = x_data
-        x_low = min(x)
-
-        # Declare arrays to store the data #
-        bin_width = (max(x) - min(x)) / n_bins
-        slow = np.zeros(n_bins)
-        shigh = np.zeros(n_bins)
-        median = np.zeros(n_bins)
-        x_value = np.zeros(n_bins)
-
-        # Loop over all bins and calculate the median and 1-sigma lines #
-        for i in range(n_bins):
-            index, = np.where((x >= x_low) & (x < x_low + bin_width))
-            x_value[i] = np.mean(x_data[index])
-            if len(index) > 0:
-                median[i] = np.nanmedian(y_data[index])
-                slow[i] = np.nanpercentile(y_data[index], 15.87)
-                shigh[i] = np.nanpercentile(y_data[index], 84.13)
-            x_low += bin_width
+
+        # Calculate the median and 1-sigma lines in all bins #
+        bin_width = (np.max(x) - np.min(x)) / n_bins
+        edges = np.cumsum(np.hstack([np.min(x), np.full(n_bins, bin_width)]))  # As adding bin_width to the lower edge for each bin.
+        x_value, median, shigh, slow, counts = binned_statistics(x_data, y_data, x, edges)
+        median, shigh, slow = [np.where(counts > 0, array, 0) for array in [median, shigh, slow]]
 
         return x_value, median, shigh, slow
 
@@ -0,0 +1,145 @@
+import numpy as np
+
+small_set = 64  # Number of candidates below which weighted_quantile stops selecting and sorts them.
+
+
+def get_weights(values, weights):
+    """
+    Drop the NaN values and their weights.
+    :param values: input array.
+    :param weights: positive weights (default: ones).
+    :return: values, weights
+    """
+    values = np.asarray(values, dtype=np.float64).ravel()
+    weights = np.ones(len(values)) if weights is None else np.asarray(weights, dtype=np.float64).ravel()
+    mask = ~np.isnan(values)
+    return values[mask], weights[mask]
+
+
+def weighted_quantile(values, weights=None, q=0.5):
+    """
+    Calculate a weighted quantile in O(n) with repeated selection (introselect via np.partition) instead of sorting. The quantile is the
+    linear interpolation of the values at the middle of their cumulative weights (i.e., as MorphoKinematic.weighted_median).
+    :param values: input array.
+    :param weights: positive weights (default: ones).
+    :param q: quantile in [0, 1].
+    :return: quantile
+    """
+    values, weights = get_weights(values, weights)
+    if len(values) == 0:
+        return np.nan
+
+    target = q * np.sum(weights)
+    lower, upper = (np.min(values), 0.0), (np.max(values), np.sum(weights))  # (value, middle of the cumulative weight) of the neighbours.
+    offset = 0.0  # Weight of the particles which are known to be below the candidates.
+
+    # Select a window of candidates around the rank where the target is expected until it falls in a small set #
+    while len(values) > small_set:
+        total_weight = np.sum(weights)
+        rank = int((target - offset) / total_weight * len(values)) if total_weight > 0 else len(values) // 2
+        window = int(np.sqrt(len(values)))
+        ranks = [min(max(rank - window, 0), len(values) - 1), min(max(rank + window, 0), len(values) - 1)]
+        pivot_low, pivot_high = np.partition(values, ranks)[ranks]
+        below, above = values < pivot_low, values > pivot_high
+        middle = ~(below | above)
+        weight_below, weight_middle = np.sum(weights[below]), np.sum(weights[middle])
+
+        if target < offset + weight_below:
+            upper = (pivot_low, offset + weight_below + weights[values == pivot_low][0] / 2)
+            values, weights = values[below], weights[below]
+        elif target > offset + weight_below + weight_middle:
+            lower = (pivot_high, offset + weight_below + weight_middle - weights[values == pivot_high][-1] / 2)
+            offset += weight_below + weight_middle
+            values, weights = values[above], weights[above]
+        elif np.all(middle):
+            break
+        else:  # The target falls within the window.
+            if np.any(below):
+                index = len(values) - 1 - np.argmax(np.where(below, values, -np.inf)[::-1])  # The last of the equal values in the sort.
+                lower = (values[index], offset + weight_below - weights[index] / 2)
+            if np.any(above):
+                index = np.argmin(np.where(above, values, np.inf))  # The first of the equal values in the sort.
+                upper = (values[index], offset + weight_below + weight_middle + weights[index] / 2)
+            offset += weight_below
+            values, weights = values[middle], weights[middle]
+
+    # Sort the remaining candidates and interpolate between the neighbours of the target #
+    sort = np.argsort(values, kind='stable')
+    middles = offset + np.cumsum(weights[sort]) - weights[sort] / 2
+    return float(np.interp(target, np.hstack([lower[1], middles, upper[1]]), np.hstack([lower[0], values[sort], upper[0]])))
+
+
+def weighted_quantiles(values, weights=None, qs=(0.5,)):
+    """
+    Calculate several weighted quantiles (as weighted_quantile) with a single sort.
+    :param values: input array.
+    :param weights: positive weights (default: ones).
+    :param qs: list of quantiles in [0, 1].
+    :return: quantiles
+    """
+    values, weights = get_weights(values, weights)
+    if len(values) == 0:
+        return np.full(len(qs), np.nan)
+
+    sort = np.argsort(values, kind='stable')
+    cumulative_weights = np.cumsum(weights[sort])
+    middles = np.hstack([0, cumulative_weights - weights[sort] / 2, cumulative_weights[-1]])
+    sorted_values = np.hstack([values[sort][0], values[sort], values[sort][-1]])
+    return np.interp(np.asarray(qs) * cumulative_weights[-1], middles, sorted_values)
+
+
+def segmented_quantiles(values, groups, n_groups, qs=(0.5,), weights=None):
+    """
+    Calculate quantiles of many groups (e.g., bins) at once with a single sort. Without weights the quantiles follow np.percentile (i.e.,
+    linear interpolation between the closest ranks), with weights they follow weighted_quantile.
+    :param values: input array.
+    :param groups: group index (in [0, n_groups)) of each value. Values with a group index out of range are ignored.
+    :param n_groups: number of groups.
+    :param qs: list of quantiles in [0, 1].
+    :param weights: positive weights (default: None).
+    :return: quantiles (one row per group and one column per quantile, NaN for empty groups)
+    """
+    values, groups = np.asarray(values, dtype=np.float64).ravel(), np.asarray(groups).ravel()
+    mask = ~np.isnan(values) & (groups >= 0) & (groups < n_groups)
+    weights = None if weights is None else np.asarray(weights, dtype=np.float64).ravel()[mask]
+    values, groups = values[mask], groups[mask]
+    qs = np.asarray(qs, dtype=np.float64)
+    quantiles = np.full((n_groups, len(qs)), np.nan)
+
+    # Sort by value and then (stably, with a radix sort for small integer types) by group and find where each group starts #
+    sort = np.argsort(values, kind=None if weights is None else 'stable')  # The order of equal values only matters with weights.
+    sort = sort[np.argsort(groups[sort].astype(np.min_scalar_type(n_groups)), kind='stable')]
+    values, groups = values[sort], groups[sort]
+    counts = np.bincount(groups, minlength=n_groups)
+    starts = np.hstack([0, np.cumsum(counts)[:-1]])
+    filled, = np.where(counts > 0)
+    if len(filled) == 0:
+        return quantiles
+
+    if weights is None:
+        # Interpolate between the closest ranks of each group #
+        ranks = starts[filled, np.newaxis] + qs[np.newaxis, :] * (counts[filled, np.newaxis] - 1)
+        low = np.floor(ranks).astype(np.int64)
+        high = np.minimum(low + 1, (starts + counts - 1)[filled, np.newaxis])
+        quantiles[filled] = values[low] + (ranks - low) * (values[high] - values[low])
+        return quantiles
+
+    # Interpolate between the values at the middle of the cumulative weights (which increase across groups) #
+    weights = weights[sort]
+    cumulative_weights = np.cumsum(weights)
+    middles = cumulative_weights - weights / 2
+    group_starts = np.hstack([0, cumulative_weights])[starts[filled]]
+    group_ends = cumulative_weights[(starts + counts - 1)[filled]]
+    targets = group_starts[:, np.newaxis] + qs[np.newaxis, :] * (group_ends - group_starts)[:, np.newaxis]
+
+    first, last = starts[filled, np.newaxis], (starts + counts - 1)[filled, np.newaxis]
+    index = np.clip(np.searchsorted(middles, targets, side='right'), first, last + 1)
+    has_low, has_high = index > first, index <= last
+    x_low = np.where(has_low, middles[np.maximum(index - 1, 0)], group_starts[:, np.newaxis])
+    y_low = np.where(has_low, values[np.maximum(index - 1, 0)], values[first])
+    x_high = np.where(has_high, middles[np.minimum(index, len(values) - 1)], group_ends[:, np.newaxis])
+    y_high = np.where(has_high, values[np.minimum(index, len(values) - 1)], values[last])
+    with np.errstate(invalid='ignore', divide='ignore'):
+        fraction = np.where(x_high > x_low, (targets - x_low) / (x_high - x_low), 0.0)
+    quantiles[filled] = y_low + fraction * (y_high - y_low)
+    return quantiles
@@ -1,18 +1,25 @@
+import os
 import re
 import sys
 import time
 import h5py
+import zlib
+import traceback
 
 import numpy as np
 import healpy as hlp
 import astropy.units as u
-import eagle_IO.eagle_IO.eagle_IO as E
 
 from scipy.special import gamma
-from astropy_healpix import HEALPix
 from scipy.optimize import curve_fit
-from plot_tools import RotateCoordinates
+from snapshot_tools import StreamingReader, SubfindCatalogue, SubhaloParticleReader
+from particle_store import GalaxyStore, GroupIndex, periodic_wrap
+from galaxy_catalogue import GalaxyCatalogue, ScalarCatalogue, concatenate_catalogues
+from job_tools import CompletionManifest, QuarantineLog, TimingLog, WalltimeGuard, build_manifest, get_costs, get_incomplete_galaxies, \
+    get_job_galaxies, get_quarantined_galaxies, load_timings, partition, partition_parts, run_pool
 from morpho_kinematics import MorphoKinematic
+from galaxy_view import GalaxyView
+from healpix_tools import find_peaks, get_smoothing_operator
 
 date = time.strftime('%d_%m_%y_%H%M')  # Date.
 start_global_time = time.time()  # Start the global time.
@@ -22,102 +29,260 @@ class ReadAttributes:
     """
     For each galaxy: read in and save its attribute(s).
     """
+    # Particle attributes to read for each particle type #
+    particle_attributes = {'4':['BirthDensity', 'Coordinates', 'GroupNumber', 'InitialMass', 'Mass', 'Metallicity', 'ParticleBindingEnergy',
+                                'StellarFormationTime', 'SubGroupNumber', 'Velocity'],
+                           '0':['Coordinates', 'GroupNumber', 'Mass', 'StarFormationRate', 'SubGroupNumber', 'Velocity'],
+                           '5':['BH_Mass', 'BH_TimeLastMerger', 'Coordinates', 'GroupNumber', 'SubGroupNumber', 'Velocity'],
+                           '1':['Coordinates', 'GroupNumber', 'SubGroupNumber', 'Velocity']}
 
 
-    def __init__(self, simulation_path, tag):
+    def __init__(self, simulation_path, tag, streaming=False, memory_budget=8e9, n_processes=1, retry=False, add_attributes=False, verify=False):
         """
         A constructor method for the class.
         :param simulation_path: simulation directory.
         :param tag: redshift directory.
+        :param streaming: stream the particle files one at a time instead of reading the particles of all galaxies of this job at once.
+        :param memory_budget: maximum size (in bytes) of the in-memory particle buckets in streaming mode.
+        :param n_processes: number of worker processes which mask and save the galaxies of this job (not used in streaming mode).
+        :param retry: process only the (incomplete) galaxies of this job which were quarantined by a previous run.
+        :param add_attributes: also calculate the AddAttributes quantities of each galaxy in memory and save them with its particles.
+        :param verify: re-read the galaxies completed by a previous run and process again those whose outputs do not match their checksums.
         """
-        p = 1  # Counter.
-        # Extract particle and subhalo attributes and convert them to astronomical units #
-        self.box_data, self.stellar_data, self.gaseous_data, self.blackhole_data, self.dark_matter_data, self.subhalo_data, self.FOF_data = \
-            self.read_attributes(
-            simulation_path, tag)
-        print('Read data for ' + re.split('Planck1/|/PE', simulation_path)[1] + ' in %.4s s' % (time.time() - start_global_time))
-        print('–––––––––––––––––––––––––––––––––––––––––––––')
+        self.add_attributes = add_attributes
+        if add_attributes is True:
+            self.add_completion_manifest = CompletionManifest(data_path + 'completion_manifest/', AddAttributes.get_stage())
+            self.add_quarantine_log = QuarantineLog(data_path + 'quarantine/', 'add')
+            get_smoothing_operator(2 ** 4, np.pi / 6.0, data_path + 'healpix_operators/')  # Load (or build) it once, before the workers fork.
+
+        # Extract subhalo attributes and convert them to astronomical units #
+        self.box_data, self.subhalo_data, self.FOF_data = self.read_attributes(simulation_path, tag)
+        self.dark_matter_particle_mass = self.dark_matter_mass(simulation_path, tag) * u.g.to(u.Msun)  # All dark matter particles share it.
 
         self.subhalo_data_tmp = self.mask_haloes()  # Mask haloes: select haloes with masses within 30 kpc aperture higher than 5e9 Msun.
 
-        # Split the group and subgroup numbers into 50 groups and submit an array job #
-        job_number = int(sys.argv[2]) - 1
-        group_numbers = np.array_split(list(self.subhalo_data_tmp['GroupNumber']), 50)
-        subgroup_numbers = np.array_split(list(self.subhalo_data_tmp['SubGroupNumber']), 50)
+        # Get the galaxies of this array task (or MPI rank) from the cost-balanced job manifest #
+        job_number, group_numbers, subgroup_numbers = get_job_galaxies(data_path + 'job_manifest.hdf5', self.subhalo_data_tmp, n_jobs)
+
+        # Save the global tables once and remove the part files failed runs left in the galaxy store #
+        self.galaxy_store = GalaxyStore(data_path + 'galaxy_store/', compression=compression)
+        self.galaxy_store.write_global(self.box_data, self.FOF_data)
+        self.completion_manifest = CompletionManifest(data_path + 'completion_manifest/', 'read')
+        self.galaxy_store.remove_parts(lambda:[output_file for output_file, checksum in self.completion_manifest.load().values()])
+
+        # Skip the galaxies a previous run has completed, so a restart never re-reads the box for them #
+        group_numbers, subgroup_numbers = get_incomplete_galaxies(self.completion_manifest, group_numbers, subgroup_numbers,
+                                                                  self.galaxy_store.get_checksum, verify=verify)
+        self.quarantine_log = QuarantineLog(data_path + 'quarantine/', 'read')
+        if retry is True:
+            group_numbers, subgroup_numbers = get_quarantined_galaxies(self.quarantine_log, group_numbers, subgroup_numbers)
+        if len(group_numbers) == 0:
+            print('All galaxies of job ' + str(job_number) + ' have been completed')
+            return
+
+        # Name the part files of this run uniquely, so they never overwrite the completed part files of a previous run #
+        part_name = 'part_' + str(job_number) + '_' + str(int(start_global_time))
+        self.walltime_guard = WalltimeGuard(walltime, start_global_time)
+
+        if streaming is True:
+            # Stream the particle files and get each galaxy as soon as all its particles have been read #
+            streaming_reader = StreamingReader(simulation_path, tag, group_numbers, subgroup_numbers, self.particle_attributes,
+                                               data_path + 'spill_files/', memory_budget=memory_budget)
+            self.save_galaxies(part_name, self.stream_galaxies(simulation_path, tag, streaming_reader))
+        else:
+            # Extract the particle attributes of the galaxies of this job and convert them to astronomical units #
+            self.stellar_data, self.gaseous_data, self.blackhole_data, self.dark_matter_data = self.read_particle_attributes(
+                simulation_path, tag, group_numbers, subgroup_numbers)
+            print('Read data for ' + re.split('Planck1/|/PE', simulation_path)[1] + ' in %.4s s' % (time.time() - start_global_time))
+            print('–––––––––––––––––––––––––––––––––––––––––––––')
 
-        for group_number, subgroup_number in zip(group_numbers[job_number],
-                                                 subgroup_numbers[job_number]):  # Loop over all masked haloes and sub-haloes.
-            start_local_time = time.time()  # Start the local time.
+            # Sort the particles by (GroupNumber, SubGroupNumber) once so each galaxy is a contiguous slice #
+            self.stellar_index = GroupIndex(self.stellar_data)
+            self.gaseous_index = GroupIndex(self.gaseous_data)
+            self.blackhole_index = GroupIndex(self.blackhole_data)
+            self.dark_matter_index = GroupIndex(self.dark_matter_data)
+
+            # Let each (forked) worker process save its share of the galaxies in its own part files. The workers only read the particle arrays, so
+            # they share the pages of this process (copy-on-write) instead of copying them #
+            if n_processes > 1:
+                # Balance the workers by the cost of their galaxies (the SUBFIND order is mass-descending, so contiguous slices are not balanced) #
+                keys = GroupIndex.group_keys(self.subhalo_data_tmp['GroupNumber'], self.subhalo_data_tmp['SubGroupNumber'])
+                sort = np.argsort(keys, kind='stable')
+                rows = sort[np.searchsorted(keys[sort], GroupIndex.group_keys(group_numbers, subgroup_numbers))]
+                costs = get_costs(np.sum(self.subhalo_data_tmp['SubLengthType'][rows], axis=1), group_numbers, subgroup_numbers,
+                                  timings=load_timings(data_path + 'timings/'))
+                worker_numbers = partition(costs, n_processes)
+                tasks = [(part_name + '_' + str(i), group_numbers[worker_numbers == i], subgroup_numbers[worker_numbers == i]) for i in
+                         range(n_processes)]
+            else:
+                tasks = [(part_name, group_numbers, subgroup_numbers)]
+            run_pool(self.save_job_galaxies, tasks, n_processes)
 
-            # Mask galaxies and normalise data #
-            stellar_data_tmp, gaseous_data_tmp, blackhole_data_tmp, dark_matter_data_tmp, subhalo_data_tmp = self.mask_galaxies(group_number,
-                                                                                                                                subgroup_number)
+        print('Finished ReadAttributes for ' + re.split('Planck1/|/PE', simulation_path)[1] + '_' + str(tag) + ' in %.4s s' % (
+            time.time() - start_global_time))
+        print('–––––––––––––––––––––––––––––––––––––––––––––')
 
-            # Save data in numpy array #
-            np.save(data_path + 'box_data', self.box_data)
-            np.save(data_path + 'FOF_data_tmps/FOF_data_tmp_' + str(group_number), self.FOF_data)
-            np.save(data_path + 'subhalo_data_tmps/subhalo_data_tmp_' + str(group_number) + '_' + str(subgroup_number), subhalo_data_tmp)
-            np.save(data_path + 'stellar_data_tmps/stellar_data_tmp_' + str(group_number) + '_' + str(subgroup_number), stellar_data_tmp)
-            np.save(data_path + 'gaseous_data_tmps/gaseous_data_tmp_' + str(group_number) + '_' + str(subgroup_number), gaseous_data_tmp)
-            np.save(data_path + 'blackhole_data_tmps/blackhole_data_tmp_' + str(group_number) + '_' + str(subgroup_number), blackhole_data_tmp)
-            np.save(data_path + 'dark_matter_data_tmps/dark_matter_data_tmp_' + str(group_number) + '_' + str(subgroup_number), dark_matter_data_tmp)
+
+    def save_job_galaxies(self, part_name, group_numbers, subgroup_numbers):
+        """
+        Mask and save the galaxies with the given group and subgroup numbers using the group-sorted particle arrays.
+        :param part_name: name of the part file of the galaxy store.
+        :param group_numbers: group numbers of the galaxies.
+        :param subgroup_numbers: subgroup numbers of the galaxies.
+        :return: None
+        """
+        galaxies = ((group_number, subgroup_number) + self.get_galaxy(group_number, subgroup_number) for group_number, subgroup_number in
+                    zip(group_numbers, subgroup_numbers))
+        self.save_galaxies(part_name, galaxies)
+        return None
+
+
+    def save_galaxies(self, part_name, galaxies):
+        """
+        Mask galaxies, normalise their data and save them in a part file of the galaxy store.
+        :param part_name: name of the part file of the galaxy store.
+        :param galaxies: iterable of (group_number, subgroup_number, stellar_data, gaseous_data, blackhole_data, dark_matter_data).
+        :return: None
+        """
+        p, chunk = 1, 0  # Counters.
+        galaxy_store = GalaxyStore(data_path + 'galaxy_store/', compression=compression)  # Each (worker) process buffers its own galaxies.
+        timing_log = TimingLog(data_path + 'timings/read_' + part_name + '.hdf5')  # Used to balance the jobs of later runs.
+        scalar_catalogue = ScalarCatalogue(data_path + 'scalar_catalogues/' + part_name + '.hdf5')  # Rows of the fused pipeline for AppendAttributes.
+
+        # Record the galaxies (and the attributes of the fused pipeline) of each part file as completed just before it appears in the store #
+        def record_completed(part_file, group_numbers, subgroup_numbers, checksums, attributes_checksums):
+            scalar_catalogue.write()
+            self.completion_manifest.add(part_name, group_numbers, subgroup_numbers, part_file, checksums)
+            added_mask = [attributes_checksum is not None for attributes_checksum in attributes_checksums]
+            if any(added_mask):
+                self.add_completion_manifest.add(part_name, np.asarray(group_numbers)[added_mask], np.asarray(subgroup_numbers)[added_mask],
+                                                 part_file, np.asarray(attributes_checksums)[added_mask])
+
+        start_local_time = time.time()  # Start the local time.
+        for group_number, subgroup_number, stellar_data, gaseous_data, blackhole_data, dark_matter_data in galaxies:  # Loop over all masked
+            # haloes and sub-haloes.
+
+            # Mask galaxies and normalise data (a galaxy which raises an exception is quarantined and the loop continues) #
+            try:
+                stellar_data_tmp, gaseous_data_tmp, blackhole_data_tmp, dark_matter_data_tmp, subhalo_data_tmp = self.mask_galaxies(
+                    group_number, subgroup_number, stellar_data, gaseous_data, blackhole_data, dark_matter_data)
+            except Exception:
+                self.quarantine_log.add(part_name, group_number, subgroup_number, traceback.format_exc())
+                print('Quarantined halo ' + str(group_number) + '_' + str(subgroup_number) + ':\n' + traceback.format_exc())
+                print('–––––––––––––––––––––––––––––––––––––––––––––')
+                start_local_time = time.time()  # Start the local time.
+                continue
+
+            # In the fused pipeline, calculate the AddAttributes quantities in memory so the particles are written (and never read back) once #
+            attributes = None
+            if self.add_attributes is True:
+                try:
+                    stellar_attributes, gaseous_attributes = AddAttributes.calculate_attributes(dict(stellar_data_tmp), dict(gaseous_data_tmp),
+                                                                                                dark_matter_data_tmp)
+                    attributes = {'stellar':{attribute:stellar_attributes[attribute] for attribute in stellar_attributes.keys() if
+                                             attribute not in stellar_data_tmp},
+                                  'gaseous':{attribute:gaseous_attributes[attribute] for attribute in gaseous_attributes.keys() if
+                                             attribute not in gaseous_data_tmp},
+                                  'versions':{computation:version for computation, (inputs, version) in AddAttributes.computations.items()}}
+                    scalar_catalogue.add(group_number, subgroup_number,
+                                         AppendAttributes.get_scalars(group_number, subgroup_number, subhalo_data_tmp, stellar_attributes,
+                                                                      gaseous_attributes, blackhole_data_tmp, dark_matter_data_tmp))
+                except Exception:  # Save the particles anyway; AddAttributes can retry the quarantined galaxy from the store.
+                    self.add_quarantine_log.add(part_name, group_number, subgroup_number, traceback.format_exc())
+                    print('Quarantined halo ' + str(group_number) + '_' + str(subgroup_number) + ':\n' + traceback.format_exc())
+
+            # Buffer the data in the galaxy store and save them every flush_size galaxies, so a failed job loses at most one part file #
+            galaxy_store.add_galaxy(group_number, subgroup_number, subhalo_data_tmp, stellar_data_tmp, gaseous_data_tmp, blackhole_data_tmp,
+                                    dark_matter_data_tmp, attributes=attributes)
+            if len(galaxy_store.galaxies) == flush_size:
+                galaxy_store.flush(part_name + '_' + str(chunk), on_write=record_completed)
+                chunk += 1
+            timing_log.add(group_number, subgroup_number, time.time() - start_local_time)
+            self.walltime_guard.record(time.time() - start_local_time)
 
             print('Masked and saved data for halo ' + str(group_number) + '_' + str(subgroup_number) + ' in %.4s s' % (
                 time.time() - start_local_time) + ' (' + str(round(100 * p / len(set(self.subhalo_data_tmp['GroupNumber'])), 1)) + '%)')
             print('–––––––––––––––––––––––––––––––––––––––––––––')
             p += 1
+            start_local_time = time.time()  # Start the local time.
 
-        print('Finished ReadAttributes for ' + re.split('Planck1/|/PE', simulation_path)[1] + '_' + str(tag) + ' in %.4s s' % (
-            time.time() - start_global_time))
-        print('–––––––––––––––––––––––––––––––––––––––––––––')
+            # Stop cleanly (i.e., save the completed galaxies) before the walltime #
+            if self.walltime_guard.is_time_up():
+                print('Stopping before the walltime: the remaining galaxies will be processed by the next run')
+                break
+        galaxy_store.flush(part_name + '_' + str(chunk), on_write=record_completed)
+        timing_log.write()
+        return None
 
 
     def read_attributes(self, simulation_path, tag):
         """
-        Extract particle and subhalo attributes and convert them to astronomical units.
+        Extract box, subhalo and FOF attributes and convert them to astronomical units.
         :param simulation_path: simulation directory.
         :param tag: redshift directory.
-        :return: stellar_data, gaseous_data, blackhole_data, dark_matter_data, subhalo_data, FOF_data
+        :return: box_data, subhalo_data, FOF_data
         """
-        # Load particle data in h-free physical CGS units #
-        box_data, stellar_data, gaseous_data, blackhole_data, dark_matter_data = {}, {}, {}, {}, {}
-
-        file_type = 'SUBFIND'
-        for attribute in ['HubbleParam', 'BoxSize']:
-            box_data[attribute] = E.read_header(file_type, simulation_path, tag, attribute)
-
-        file_type = 'PARTDATA'
-        particle_type = '4'
-        for attribute in ['BirthDensity', 'Coordinates', 'GroupNumber', 'InitialMass', 'Mass', 'Metallicity', 'ParticleBindingEnergy',
-                          'StellarFormationTime', 'SubGroupNumber', 'Velocity']:
-            stellar_data[attribute] = E.read_array(file_type, simulation_path, tag, '/PartType' + particle_type + '/' + attribute, numThreads=8)
-
-        particle_type = '0'
-        for attribute in ['Coordinates', 'GroupNumber', 'Mass', 'StarFormationRate', 'SubGroupNumber', 'Velocity']:
-            gaseous_data[attribute] = E.read_array(file_type, simulation_path, tag, '/PartType' + particle_type + '/' + attribute, numThreads=8)
-
-        particle_type = '5'
-        for attribute in ['BH_Mass', 'BH_TimeLastMerger', 'Coordinates', 'GroupNumber', 'SubGroupNumber', 'Velocity']:
-            blackhole_data[attribute] = E.read_array(file_type, simulation_path, tag, '/PartType' + particle_type + '/' + attribute, numThreads=8)
-
-        particle_type = '1'
-        for attribute in ['Coordinates', 'GroupNumber', 'SubGroupNumber', 'Velocity']:
-            dark_matter_data[attribute] = E.read_array(file_type, simulation_path, tag, '/PartType' + particle_type + '/' + attribute, numThreads=8)
-
-        # Load subhalo data in h-free physical CGS units #
-        subhalo_data = {}
-        file_type = 'SUBFIND'
-        for attribute in ['ApertureMeasurements/Mass/030kpc', 'CentreOfPotential', 'GroupNumber', 'IDMostBound', 'InitialMassWeightedStellarAge',
-                          'SubGroupNumber']:
-            subhalo_data[attribute] = E.read_array(file_type, simulation_path, tag, '/Subhalo/' + attribute, numThreads=8)
-
-        # Load FOF data in h-free physical CGS units #
-        FOF_data = {}
-        file_type = 'SUBFIND'
-        for attribute in ['Group_M_Crit200', 'Group_R_Crit200', 'FirstSubhaloID']:
-            FOF_data[attribute] = E.read_array(file_type, simulation_path, tag, '/FOF/' + attribute, numThreads=8)
+        # Load box, subhalo and FOF data in h-free physical CGS units from the cached SUBFIND catalogue #
+        catalogue = SubfindCatalogue(simulation_path, tag, data_path + 'catalogue_cache/')
+        box_data = catalogue.read_header(['HubbleParam', 'BoxSize'])
+        subhalo_data = catalogue.read_subhalo(['ApertureMeasurements/Mass/030kpc', 'CentreOfPotential', 'GroupNumber', 'IDMostBound',
+                                               'InitialMassWeightedStellarAge', 'SubGroupNumber', 'SubLengthType'])
+        FOF_data = catalogue.read_FOF(['Group_M_Crit200', 'Group_R_Crit200', 'FirstSubhaloID', 'GroupLengthType'])
 
         # Convert attributes to astronomical units #
+        subhalo_data['CentreOfPotential'] *= u.cm.to(u.kpc)
+        subhalo_data['ApertureMeasurements/Mass/030kpc'] *= u.g.to(u.Msun)
+
+        FOF_data['Group_M_Crit200'] *= u.g.to(u.Msun)
+        FOF_data['Group_R_Crit200'] *= u.cm.to(u.kpc)
+
+        return box_data, subhalo_data, FOF_data
+
+
+    def read_particle_attributes(self, simulation_path, tag, group_numbers, subgroup_numbers):
+        """
+        Extract particle attributes and convert them to astronomical units. Only the particles of the given subhaloes are read.
+        :param simulation_path: simulation directory.
+        :param tag: redshift directory.
+        :param group_numbers: group numbers of the subhaloes of this job.
+        :param subgroup_numbers: subgroup numbers of the subhaloes of this job.
+        :return: stellar_data, gaseous_data, blackhole_data, dark_matter_data
+        """
+        # Use the SUBFIND particle lengths to read only the particle ranges of the given subhaloes #
+        particle_reader = SubhaloParticleReader(simulation_path, tag, self.subhalo_data, self.FOF_data, group_numbers, subgroup_numbers)
+
+        # Load particle data in h-free physical CGS units #
+        particle_data = {}
+        for particle_type, attributes in self.particle_attributes.items():
+            particle_data[particle_type] = {}
+            for attribute in attributes:
+                particle_data[particle_type][attribute] = particle_reader.read_dataset(particle_type, attribute)
+
+        return self.convert_particle_attributes(simulation_path, tag, particle_data)
+
+
+    def stream_galaxies(self, simulation_path, tag, streaming_reader):
+        """
+        Get the particle attributes of each galaxy of this job from a StreamingReader and convert them to astronomical units.
+        :param simulation_path: simulation directory.
+        :param tag: redshift directory.
+        :param streaming_reader: from snapshot_tools.py.
+        :return: generator of (group_number, subgroup_number, stellar_data, gaseous_data, blackhole_data, dark_matter_data)
+        """
+        for group_number, subgroup_number, particle_data in streaming_reader.stream_galaxies():
+            yield (group_number, subgroup_number) + self.convert_particle_attributes(simulation_path, tag, particle_data)
+
+
+    def convert_particle_attributes(self, simulation_path, tag, particle_data):
+        """
+        Convert particle attributes from h-free physical CGS units to astronomical units.
+        :param simulation_path: simulation directory.
+        :param tag: redshift directory.
+        :param particle_data: dictionary of particle_type: data.
+        :return: stellar_data, gaseous_data, blackhole_data, dark_matter_data
+        """
+        stellar_data, gaseous_data, blackhole_data, dark_matter_data = particle_data['4'], particle_data['0'], particle_data['5'], particle_data['1']
+
         stellar_data['Mass'] *= u.g.to(u.Msun)
         stellar_data['Velocity'] *= u.cm.to(u.km)  # s^-1.
         stellar_data['InitialMass'] *= u.g.to(u.Msun)
@@ -135,15 +300,9 @@ class ReadAttributes:
 
         dark_matter_data['Coordinates'] *= u.cm.to(u.kpc)
         dark_matter_data['Velocity'] *= u.cm.to(u.km)  # s^-1.
-        dark_matter_data['Mass'] = self.dark_matter_mass(simulation_path, tag) * u.g.to(u.Msun)
-
-        subhalo_data['CentreOfPotential'] *= u.cm.to(u.kpc)
-        subhalo_data['ApertureMeasurements/Mass/030kpc'] *= u.g.to(u.Msun)
+        dark_matter_data['Mass'] = self.dark_matter_particle_mass  # A scalar column instead of an array of identical values.
 
-        FOF_data['Group_M_Crit200'] *= u.g.to(u.Msun)
-        FOF_data['Group_R_Crit200'] *= u.cm.to(u.kpc)
-
-        return box_data, stellar_data, gaseous_data, blackhole_data, dark_matter_data, subhalo_data, FOF_data
+        return stellar_data, gaseous_data, blackhole_data, dark_matter_data
 
 
     def mask_haloes(self):
@@ -154,58 +313,63 @@ class ReadAttributes:
         # Mask the halo data #
         halo_mask = np.where(self.subhalo_data['ApertureMeasurements/Mass/030kpc'][:, 4] > 5e9)
 
-        # Mask the temporary dictionary for each galaxy #
+        # Mask the temporary dictionary for each galaxy (fancy indexing already returns a copy) #
         subhalo_data_tmp = {}
         for attribute in self.subhalo_data.keys():
-            subhalo_data_tmp[attribute] = np.copy(self.subhalo_data[attribute])[halo_mask]
+            subhalo_data_tmp[attribute] = self.subhalo_data[attribute][halo_mask]
 
         return subhalo_data_tmp
 
 
-    def mask_galaxies(self, group_number, subgroup_number):
+    def get_galaxy(self, group_number, subgroup_number):
+        """
+        Get the particles of a galaxy as contiguous slices (i.e., views) of the group-sorted particle arrays.
+        :param group_number: from read_add_attributes.py.
+        :param subgroup_number: from read_add_attributes.py.
+        :return: stellar_data, gaseous_data, blackhole_data, dark_matter_data
+        """
+        galaxy_data = []
+        for data, index in zip([self.stellar_data, self.gaseous_data, self.blackhole_data, self.dark_matter_data],
+                               [self.stellar_index, self.gaseous_index, self.blackhole_index, self.dark_matter_index]):
+            data_slice = index.get_slice(group_number, subgroup_number)
+            galaxy_data.append({attribute:data[attribute][data_slice] if np.ndim(data[attribute]) > 0 else data[attribute] for attribute in data})
+
+        return tuple(galaxy_data)
+
+
+    def mask_galaxies(self, group_number, subgroup_number, stellar_data, gaseous_data, blackhole_data, dark_matter_data):
         """
         Mask galaxies and normalise data.
         :param group_number: from read_add_attributes.py.
         :param subgroup_number: from read_add_attributes.py.
-        :return: stellar_data_tmp, glx_unit_vector
+        :param stellar_data: stellar particles of the galaxy.
+        :param gaseous_data: gaseous particles of the galaxy.
+        :param blackhole_data: black hole particles of the galaxy.
+        :param dark_matter_data: dark matter particles of the galaxy.
+        :return: stellar_data_tmp, gaseous_data_tmp, blackhole_data_tmp, dark_matter_data_tmp, subhalo_data_tmp
         """
         # Select the corresponding halo in order to get its centre of potential #
         halo_mask, = np.where((self.subhalo_data_tmp['GroupNumber'] == group_number) & (self.subhalo_data_tmp['SubGroupNumber'] == subgroup_number))
 
-        # Periodically wrap coordinates around centre #
+        # Periodically wrap the coordinates of the galaxy's particles around its centre and mask those inside a 30kpc sphere #
         box_side = self.box_data['BoxSize'] * 1e3 / self.box_data['HubbleParam']
-        self.stellar_data['Coordinates'] = np.mod(
-            self.stellar_data['Coordinates'] - self.subhalo_data_tmp['CentreOfPotential'][halo_mask] + 0.5 * box_side, box_side) + \
-                                           self.subhalo_data_tmp['CentreOfPotential'][halo_mask] - 0.5 * box_side
-
-        # Mask the data to select galaxies with a given GroupNumber and SubGroupNumber and particles inside a 30kpc sphere #
-        stellar_mask = np.where((self.stellar_data['GroupNumber'] == group_number) & (self.stellar_data['SubGroupNumber'] == subgroup_number) & (
-            np.linalg.norm(self.stellar_data['Coordinates'] - self.subhalo_data_tmp['CentreOfPotential'][halo_mask], axis=1) <= 30.0))
-
-        gaseous_mask = np.where((self.gaseous_data['GroupNumber'] == group_number) & (self.gaseous_data['SubGroupNumber'] == subgroup_number) & (
-            np.linalg.norm(self.gaseous_data['Coordinates'] - self.subhalo_data_tmp['CentreOfPotential'][halo_mask], axis=1) <= 30.0))
-
-        blackhole_mask = np.where(
-            (self.blackhole_data['GroupNumber'] == group_number) & (self.blackhole_data['SubGroupNumber'] == subgroup_number) & (
-                np.linalg.norm(self.blackhole_data['Coordinates'] - self.subhalo_data_tmp['CentreOfPotential'][halo_mask], axis=1) <= 30.0))
-
-        dark_matter_mask = np.where(
-            (self.dark_matter_data['GroupNumber'] == group_number) & (self.dark_matter_data['SubGroupNumber'] == subgroup_number) & (
-                np.linalg.norm(self.dark_matter_data['Coordinates'] - self.subhalo_data_tmp['CentreOfPotential'][halo_mask], axis=1) <= 30.0))
-
-        # Mask the temporary dictionary for each galaxy #
+        centre = self.subhalo_data_tmp['CentreOfPotential'][halo_mask]
         subhalo_data_tmp, stellar_data_tmp, gaseous_data_tmp, blackhole_data_tmp, dark_matter_data_tmp = {}, {}, {}, {}, {}
-
         for attribute in self.subhalo_data_tmp.keys():
-            subhalo_data_tmp[attribute] = np.copy(self.subhalo_data_tmp[attribute])[halo_mask]
-        for attribute in self.stellar_data.keys():
-            stellar_data_tmp[attribute] = np.copy(self.stellar_data[attribute])[stellar_mask]
-        for attribute in self.gaseous_data.keys():
-            gaseous_data_tmp[attribute] = np.copy(self.gaseous_data[attribute])[gaseous_mask]
-        for attribute in self.blackhole_data.keys():
-            blackhole_data_tmp[attribute] = np.copy(self.blackhole_data[attribute])[blackhole_mask]
-        for attribute in self.dark_matter_data.keys():
-            dark_matter_data_tmp[attribute] = np.copy(self.dark_matter_data[attribute])[dark_matter_mask]
+            subhalo_data_tmp[attribute] = self.subhalo_data_tmp[attribute][halo_mask]
+
+        for data, data_tmp in zip([stellar_data, gaseous_data, blackhole_data, dark_matter_data],
+                                  [stellar_data_tmp, gaseous_data_tmp, blackhole_data_tmp, dark_matter_data_tmp]):
+            coordinates = periodic_wrap(data['Coordinates'], centre, box_side)
+            mask, = np.where(np.linalg.norm(coordinates - centre, axis=1) <= 30.0)
+
+            # Mask the temporary dictionary for each galaxy (the input arrays are never modified) #
+            for attribute in data.keys():
+                if np.ndim(data[attribute]) == 0:  # Materialise scalar (constant-mass) columns for the galaxy only.
+                    data_tmp[attribute] = np.full(len(mask), data[attribute])
+                else:
+                    data_tmp[attribute] = data[attribute][mask]
+            data_tmp['Coordinates'] = coordinates[mask]
 
         # Normalise the coordinates and velocities wrt the centre of potential of the subhalo #
         for data in [stellar_data_tmp, gaseous_data_tmp, dark_matter_data_tmp]:
@@ -225,15 +389,16 @@ class ReadAttributes:
     @staticmethod
     def dark_matter_mass(simulation_path, tag):
         """
-        Create a mass array for dark matter particles. As all dark matter particles share the same mass, there exists no PartType1/Mass dataset in
-        the snapshot files.
+        Calculate the mass of dark matter particles. As all dark matter particles share the same mass, there exists no PartType1/Mass dataset in
+        the snapshot files, so it is returned as a scalar instead of an array of identical values.
+        :param simulation_path: simulation directory.
+        :param tag: redshift directory.
         :return: particle_mass
         """
         # Read the required attributes from the header and get conversion factors from gaseous particles #
         f = h5py.File(simulation_path + 'snapshot_' + tag + '/snap_027_z000p101.0.hdf5', 'r')
         a = f['Header'].attrs.get('Time')
         h = f['Header'].attrs.get('HubbleParam')
-        n_particles = f['Header'].attrs.get('NumPart_Total')[1]
         dark_matter_mass = f['Header'].attrs.get('MassTable')[1]
 
         cgs = f['PartType0/Mass'].attrs.get('CGSConversionFactor')
@@ -241,78 +406,235 @@ class ReadAttributes:
         hexp = f['PartType0/Mass'].attrs.get('h-scale-exponent')
         f.close()
 
-        # Create an array of length equal to the number of dark matter particles and convert to h-free physical CGS units #
-        particle_masses = np.ones(n_particles, dtype='f8') * dark_matter_mass
-        particle_masses *= cgs * (a ** aexp) * (h ** hexp)
+        # Convert to h-free physical CGS units #
+        particle_mass = dark_matter_mass * cgs * (a ** aexp) * (h ** hexp)
 
-        return particle_masses
+        return particle_mass
 
 
 class AddAttributes:
     """
     For each galaxy: load its stellar_data_tmp dictionary and add the new attribute(s).
     """
+    # Computations of AddAttributes.calculate_attributes as name: (inputs, version). Computations are declared after their inputs; increase the
+    # version of a computation when its code changes, so its outputs (and the outputs of the computations which depend on it) are recalculated #
+    computations = {'concentration_index':([], 1), 'kappa_corotation':([], 1), 'delta_r':([], 1), 'beta_components':([], 1),
+                    'decomposition_IT20':([], 2), 'kinematic_diagnostics':([], 1), 'profile_fitting':([], 1), 'angular_momenta':([], 1),
+                    'peaks':([], 1), 'component_attributes':(['beta_components', 'decomposition_IT20'], 1),
+                    'decomposition_IT20_cr':(['decomposition_IT20', 'component_attributes'], 2)}
 
 
-    def __init__(self, simulation_path, tag):
+    def __init__(self, simulation_path, tag, n_processes=1, retry=False, verify=False):
         """
         A constructor method for the class.
         :param simulation_path: simulation directory.
         :param tag: redshift directory.
+        :param n_processes: number of worker processes which add the attributes of the galaxies of this job.
+        :param retry: process only the (incomplete) galaxies of this job which were quarantined by a previous run.
+        :param verify: re-read the attributes completed by a previous run and add again those which do not match their checksums.
         """
-        # Extract particle and subhalo attributes and convert them to astronomical units #
-        self.subhalo_data = self.read_attributes(simulation_path, tag)
+        # Mask haloes: select haloes with masses within 30 kpc aperture higher than 5e9 Msun and convert their attributes to astronomical units #
+        self.subhalo_data_tmp = self.mask_haloes(simulation_path, tag)
         print('Read data for ' + re.split('Planck1/|/PE', simulation_path)[1] + ' in %.4s s' % (time.time() - start_global_time))
         print('–––––––––––––––––––––––––––––––––––––––––––––')
 
-        self.subhalo_data_tmp = self.mask_haloes()  # Mask haloes: select haloes with masses within 30 kpc aperture higher than 5e9 Msun.
+        # Report the galaxies the job manifest assigns to this job which are not in the galaxy store, e.g., those the read stage quarantined or
+        # left for its next run #
+        job_number, group_numbers, subgroup_numbers = get_job_galaxies(data_path + 'job_manifest.hdf5', self.subhalo_data_tmp, n_jobs)
+        galaxy_store = GalaxyStore(data_path + 'galaxy_store/')
+        index = galaxy_store.get_index()
+        missing_haloes = [str(group_number) + '_' + str(subgroup_number) for group_number, subgroup_number in zip(group_numbers, subgroup_numbers)
+                          if (int(group_number), int(subgroup_number)) not in index]
+        if len(missing_haloes) > 0:
+            print('Skipping ' + str(len(missing_haloes)) + ' galaxies of job ' + str(job_number) + ' which are not in the galaxy store: ' + ', '.join(
+                missing_haloes))
+            print('–––––––––––––––––––––––––––––––––––––––––––––')
 
-        # Split the group and subgroup numbers into 50 groups and submit an array job #
-        job_number = int(sys.argv[2]) - 1
-        group_numbers = np.array_split(list(self.subhalo_data_tmp['GroupNumber']), 50)
-        subgroup_numbers = np.array_split(list(self.subhalo_data_tmp['SubGroupNumber']), 50)
+        # Get the galaxies of the part files of this job. The part files (not the galaxies) are partitioned among the jobs, so each part file is
+        # only written by one job even if the manifest was rebuilt after the read stage #
+        stored_mask = np.array([(int(group_number), int(subgroup_number)) in index for group_number, subgroup_number in
+                                zip(self.subhalo_data_tmp['GroupNumber'], self.subhalo_data_tmp['SubGroupNumber'])], dtype=bool)
+        group_numbers = self.subhalo_data_tmp['GroupNumber'][stored_mask]
+        subgroup_numbers = self.subhalo_data_tmp['SubGroupNumber'][stored_mask]
+        part_files = np.array([index[(int(group_number), int(subgroup_number))][0] for group_number, subgroup_number in
+                               zip(group_numbers, subgroup_numbers)], dtype=str)
+        job_mask = partition_parts(part_files, np.sum(self.subhalo_data_tmp['SubLengthType'][stored_mask], axis=1), n_jobs) == job_number
+        group_numbers, subgroup_numbers = group_numbers[job_mask], subgroup_numbers[job_mask]
+
+        # Skip the galaxies whose attributes a previous run has completed with the current versions of the computations #
+        self.completion_manifest = CompletionManifest(data_path + 'completion_manifest/', self.get_stage())
+        group_numbers, subgroup_numbers = get_incomplete_galaxies(self.completion_manifest, group_numbers, subgroup_numbers,
+                                                                  galaxy_store.get_attributes_checksum, verify=verify)
+        self.quarantine_log = QuarantineLog(data_path + 'quarantine/', 'add')
+        if retry is True:
+            group_numbers, subgroup_numbers = get_quarantined_galaxies(self.quarantine_log, group_numbers, subgroup_numbers)
+        self.walltime_guard = WalltimeGuard(walltime, start_global_time)
+
+        # Group the galaxies of this job by the part file which holds them, so that each part file is only written by one worker process #
+        part_files = np.array([index[(int(group_number), int(subgroup_number))][0] for group_number, subgroup_number in
+                               zip(group_numbers, subgroup_numbers)], dtype=str)
+        tasks = [(group_numbers[part_files == part_file], subgroup_numbers[part_files == part_file], part_file) for part_file in
+                 np.unique(part_files)]
+        get_smoothing_operator(2 ** 4, np.pi / 6.0, data_path + 'healpix_operators/')  # Load (or build) it once, before the workers fork.
+        run_pool(self.add_attributes, tasks, n_processes)
+
+        print('Finished AddAttributes for ' + re.split('Planck1/|/PE', simulation_path)[1] + '_' + str(tag) + ' in %.4s s' % (
+            time.time() - start_global_time))
+        print('–––––––––––––––––––––––––––––––––––––––––––––')
+
+
+    def add_attributes(self, group_numbers, subgroup_numbers, part_file):
+        """
+        Load the galaxies with the given group and subgroup numbers, calculate their new attributes and save them in the galaxy store. A galaxy
+        which raises an exception is quarantined (with its traceback) and the loop continues with the next one.
+        :param group_numbers: group numbers of the galaxies.
+        :param subgroup_numbers: subgroup numbers of the galaxies.
+        :param part_file: part file of the galaxy store which holds the galaxies.
+        :return: None
+        """
+        part_name = os.path.basename(part_file)[:-len('.hdf5')]
+        galaxy_store = GalaxyStore(data_path + 'galaxy_store/', compression=compression)  # Each (worker) process opens its own store.
+        timing_log = TimingLog(data_path + 'timings/add_' + part_name + '.hdf5')  # Used to balance the jobs of later runs.
+        scalar_catalogue = ScalarCatalogue(data_path + 'scalar_catalogues/' + part_name + '.hdf5')  # Rows for AppendAttributes.
+        n_buffered = 0  # Number of galaxies whose attributes are buffered in the galaxy store.
+
+        # Save the rows of the scalar catalogue and then record the galaxies as completed just before their attributes appear in the store, so a
+        # completed galaxy always has a row #
+        def record_completed(part_file, group_numbers, subgroup_numbers, attributes_checksums):
+            scalar_catalogue.write()
+            self.completion_manifest.add(part_name, group_numbers, subgroup_numbers, part_file, attributes_checksums)
 
         # Loop over all masked haloes and sub-haloes #
-        for group_number, subgroup_number in zip(group_numbers[job_number], subgroup_numbers[job_number]):
-            # Load the data #
+        for group_number, subgroup_number in zip(group_numbers, subgroup_numbers):
             start_local_time = time.time()  # Start the local time.
+            try:
+                # Load the data, calculate the new attributes and buffer them in the galaxy store #
+                subhalo_data_tmp = galaxy_store.load_galaxy(group_number, subgroup_number, 'subhalo')
+                stellar_data_tmp = galaxy_store.load_galaxy(group_number, subgroup_number, 'stellar')
+                gaseous_data_tmp = galaxy_store.load_galaxy(group_number, subgroup_number, 'gaseous')
+                blackhole_data_tmp = galaxy_store.load_galaxy(group_number, subgroup_number, 'blackhole')
+                dark_matter_data_tmp = galaxy_store.load_galaxy(group_number, subgroup_number, 'dark_matter')
+
+                # Calculate only the missing or stale computations and buffer only their outputs (i.e., the values which were replaced) #
+                versions = galaxy_store.load_versions(group_number, subgroup_number)
+                stale_computations = self.get_stale_computations(versions)
+                stellar_attributes, gaseous_attributes = self.calculate_attributes(dict(stellar_data_tmp), dict(gaseous_data_tmp),
+                                                                                   dark_matter_data_tmp, stale_computations)
+                scalars = AppendAttributes.get_scalars(group_number, subgroup_number, subhalo_data_tmp, stellar_attributes, gaseous_attributes,
+                                                       blackhole_data_tmp, dark_matter_data_tmp)
+                for data_tmp, attributes, particle_type in [(stellar_data_tmp, stellar_attributes, 'stellar'),
+                                                            (gaseous_data_tmp, gaseous_attributes, 'gaseous')]:
+                    galaxy_store.save_attributes(group_number, subgroup_number, particle_type,
+                                                 {attribute:attributes[attribute] for attribute in attributes.keys() if
+                                                  attributes[attribute] is not data_tmp.get(attribute)})
+                versions.update({computation:self.computations[computation][1] for computation in stale_computations})
+                galaxy_store.save_attributes(group_number, subgroup_number, 'versions', versions)
+                scalar_catalogue.add(group_number, subgroup_number, scalars)
+            except Exception:
+                self.quarantine_log.add(part_name, group_number, subgroup_number, traceback.format_exc())
+                print('Quarantined halo ' + str(group_number) + '_' + str(subgroup_number) + ':\n' + traceback.format_exc())
+                print('–––––––––––––––––––––––––––––––––––––––––––––')
+                continue
+
+            # Save the buffered attributes every flush_size galaxies, so a failed job loses at most flush_size galaxies #
+            n_buffered += 1
+            if n_buffered == flush_size:
+                galaxy_store.flush_attributes(on_write=record_completed)
+                n_buffered = 0
+            timing_log.add(group_number, subgroup_number, time.time() - start_local_time)
+            self.walltime_guard.record(time.time() - start_local_time)
 
-            stellar_data_tmp = np.load(data_path + 'stellar_data_tmps/stellar_data_tmp_' + str(group_number) + '_' + str(subgroup_number) + '.npy',
-                                       allow_pickle=True)
-            stellar_data_tmp = stellar_data_tmp.item()
-            gaseous_data_tmp = np.load(data_path + 'gaseous_data_tmps/gaseous_data_tmp_' + str(group_number) + '_' + str(subgroup_number) + '.npy',
-                                       allow_pickle=True)
-            gaseous_data_tmp = gaseous_data_tmp.item()
-            dark_matter_data_tmp = np.load(
-                data_path + 'dark_matter_data_tmps/dark_matter_data_tmp_' + str(group_number) + '_' + str(subgroup_number) + '.npy',
-                allow_pickle=True)
-            dark_matter_data_tmp = dark_matter_data_tmp.item()
+            print(
+                'Masked and saved data for halo ' + str(group_number) + '_' + str(subgroup_number) + ' in %.4s s' % (time.time() - start_local_time))
+            print('–––––––––––––––––––––––––––––––––––––––––––––')
 
-            # Calculate galactic attributes #
-            stellar_data_tmp['c'] = self.concentration_index(stellar_data_tmp)
-            stellar_data_tmp['kappa_corotation'] = self.kappa_corotation(stellar_data_tmp)
-            stellar_data_tmp['delta_r'] = self.delta_r(stellar_data_tmp, gaseous_data_tmp, dark_matter_data_tmp)
-            stellar_data_tmp['velocity_sqred'], stellar_data_tmp['velocity_r_sqred'] = self.beta_components(stellar_data_tmp)
-            stellar_data_tmp['disc_mask_IT20'], stellar_data_tmp['spheroid_mask_IT20'], stellar_data_tmp['delta_theta'] = self.decomposition_IT20(
-                stellar_data_tmp)
-            stellar_data_tmp['disc_fraction'], stellar_data_tmp['circularity'], stellar_data_tmp['rotational_over_dispersion'], stellar_data_tmp[
-                'rotational_velocity'], stellar_data_tmp['sigma_0'], stellar_data_tmp['delta'], stellar_data_tmp['sigma_0_re'], stellar_data_tmp[
-                'rotational_velocity_re'] = self.kinematic_diagnostics(stellar_data_tmp)
-            stellar_data_tmp['n'], stellar_data_tmp['R_d'], stellar_data_tmp['R_eff'], stellar_data_tmp['disk_fraction_profile'], stellar_data_tmp[
-                'fitting_flag'] = self.profile_fitting(stellar_data_tmp)
-            prc_stellar_angular_momentum = stellar_data_tmp['Mass'][:, np.newaxis] * np.cross(stellar_data_tmp['Coordinates'],
-                                                                                              stellar_data_tmp['Velocity'])  # In Msun kpc km s^-1.
-            stellar_data_tmp['glx_stellar_angular_momentum'] = np.sum(prc_stellar_angular_momentum, axis=0)
+            # Stop cleanly (i.e., between two galaxies) before the walltime #
+            if self.walltime_guard.is_time_up():
+                print('Stopping before the walltime: the remaining galaxies will be processed by the next run')
+                break
+        galaxy_store.flush_attributes(on_write=record_completed)
+        timing_log.write()
+        return None
+
+
+    @staticmethod
+    def get_stale_computations(versions):
+        """
+        Find the computations whose outputs are missing or were calculated by an older version of their code, together with the ones which
+        depend on them.
+        :param versions: dictionary of computation: version of the outputs saved for a galaxy.
+        :return: stale_computations
+        """
+        stale_computations = []
+        for computation, (inputs, version) in AddAttributes.computations.items():  # Computations are declared after their inputs.
+            if versions.get(computation) != version or any(input in stale_computations for input in inputs):
+                stale_computations.append(computation)
+        return stale_computations
+
+
+    @staticmethod
+    def get_stage():
+        """
+        Get the name of the completion stage of the current versions of the computations, so that a new version makes AddAttributes revisit every
+        galaxy (and calculate only its stale computations).
+        :return: stage
+        """
+        versions = sorted((computation, version) for computation, (inputs, version) in AddAttributes.computations.items())
+        return 'add_' + format(zlib.crc32(str(versions).encode()), '08x')
+
+
+    @staticmethod
+    def calculate_attributes(stellar_data_tmp, gaseous_data_tmp, dark_matter_data_tmp, computations=None):
+        """
+        Calculate the galactic and component attributes of a galaxy.
+        :param stellar_data_tmp: from GalaxyStore.load_galaxy or ReadAttributes.mask_galaxies.
+        :param gaseous_data_tmp: from GalaxyStore.load_galaxy or ReadAttributes.mask_galaxies.
+        :param dark_matter_data_tmp: from GalaxyStore.load_galaxy or ReadAttributes.mask_galaxies.
+        :param computations: names of the computations to calculate (default: all). The outputs of their inputs which are not calculated have to
+        be in the data already (e.g., loaded from the galaxy store).
+        :return: stellar_data_tmp, gaseous_data_tmp
+        """
+        computations = AddAttributes.computations.keys() if computations is None else computations
+        stellar_view = GalaxyView(stellar_data_tmp)  # Derived quantities shared by all kernels.
+
+        # Calculate galactic attributes #
+        if 'concentration_index' in computations:
+            stellar_data_tmp['c'] = AddAttributes.concentration_index(stellar_view)
+        if 'kappa_corotation' in computations:
+            stellar_data_tmp['kappa_corotation'] = AddAttributes.kappa_corotation(stellar_view)
+        if 'delta_r' in computations:
+            stellar_data_tmp['delta_r'] = AddAttributes.delta_r(stellar_view, gaseous_data_tmp, dark_matter_data_tmp)
+        if 'beta_components' in computations:
+            stellar_data_tmp['velocity_sqred'], stellar_data_tmp['velocity_r_sqred'] = AddAttributes.beta_components(stellar_view)
+        if 'decomposition_IT20' in computations:
+            stellar_data_tmp['disc_mask_IT20'], stellar_data_tmp['spheroid_mask_IT20'], stellar_data_tmp['disc_mask_IT20_cr_all'], stellar_data_tmp[
+                'spheroid_mask_IT20_cr_all'], stellar_data_tmp['delta_theta'], stellar_data_tmp[
+                'angular_theta_from_densest'] = AddAttributes.decomposition_IT20(stellar_view)
             stellar_data_tmp['disc_fraction_IT20'] = np.sum(stellar_data_tmp['Mass'][stellar_data_tmp['disc_mask_IT20']]) / np.sum(
                 stellar_data_tmp['Mass'])
-
-            gaseous_data_tmp['star_forming_mask'] = np.where(gaseous_data_tmp['StarFormationRate'] > 0.0)
-            gaseous_data_tmp['non_star_forming_mask'] = np.where(gaseous_data_tmp['StarFormationRate'] == 0.0)
+            stellar_data_tmp['disc_fraction_IT20_cr_all'] = np.sum(stellar_data_tmp['Mass'][stellar_data_tmp['disc_mask_IT20_cr_all']]) / np.sum(
+                stellar_data_tmp['Mass'])
+        if 'kinematic_diagnostics' in computations:
+            stellar_data_tmp['disc_fraction'], stellar_data_tmp['circularity'], stellar_data_tmp['rotational_over_dispersion'], stellar_data_tmp[
+                'rotational_velocity'], stellar_data_tmp['sigma_0'], stellar_data_tmp['delta'], stellar_data_tmp['sigma_0_re'], stellar_data_tmp[
+                'rotational_velocity_re'] = AddAttributes.kinematic_diagnostics(stellar_view)
+        if 'profile_fitting' in computations:
+            stellar_data_tmp['n'], stellar_data_tmp['R_d'], stellar_data_tmp['R_eff'], stellar_data_tmp['disk_fraction_profile'], \
+            stellar_data_tmp['fitting_flag'] = AddAttributes.profile_fitting(stellar_view)
+        if 'peaks' in computations:
+            stellar_data_tmp['peak_unit_vectors'], stellar_data_tmp['peak_significances'], stellar_data_tmp['peak_masses'], stellar_data_tmp[
+                'peak_index'] = AddAttributes.peak_decomposition(stellar_view)
+        if 'angular_momenta' in computations:
+            stellar_data_tmp['glx_stellar_angular_momentum'] = stellar_view.glx_angular_momentum  # In Msun kpc km s^-1.
+
+            gaseous_data_tmp['star_forming_mask'], = np.where(gaseous_data_tmp['StarFormationRate'] > 0.0)
+            gaseous_data_tmp['non_star_forming_mask'], = np.where(gaseous_data_tmp['StarFormationRate'] == 0.0)
             prc_gaseous_angular_momentum = gaseous_data_tmp['Mass'][:, np.newaxis] * np.cross(gaseous_data_tmp['Coordinates'],
                                                                                               gaseous_data_tmp['Velocity'])  # In Msun kpc km s^-1.
             gaseous_data_tmp['glx_gaseous_angular_momentum'] = np.sum(prc_gaseous_angular_momentum, axis=0)
 
-            # Calculate component attributes #
+        # Calculate component attributes #
+        if 'component_attributes' in computations:
             for i, mask in enumerate([stellar_data_tmp['disc_mask_IT20'], stellar_data_tmp['spheroid_mask_IT20']]):
                 component_masses = stellar_data_tmp['Mass'][mask]
                 component_mass = np.sum(stellar_data_tmp['Mass'][mask])
@@ -325,18 +647,18 @@ class AddAttributes:
                 component_energies = stellar_data_tmp['ParticleBindingEnergy'][mask]
                 component_velocity_r_sqred = stellar_data_tmp['velocity_r_sqred'][mask]
                 component_birth_stellar_formation_time = stellar_data_tmp['StellarFormationTime'][mask]
-                component_stellar_angular_momentum = np.sum(prc_stellar_angular_momentum[mask], axis=0)
+                component_stellar_angular_momentum = np.sum(stellar_view.prc_angular_momentum[mask], axis=0)
+                component_s_angular_momenta = stellar_view.prc_specific_angular_momentum[mask]
 
                 metals = np.divide(component_metals * component_masses, component_mass)
                 kappa, disc_fraction, circularity, rotational_over_dispersion, vrots, rotational_velocity, sigma_0, \
                 delta = MorphoKinematic.kinematic_diagnostics(
-                    component_coordinates, component_masses, component_velocities, component_energies)
-                prc_spherical_radius = np.sqrt(np.sum(component_coordinates ** 2, axis=1))
-                spacial_mask, = np.where(prc_spherical_radius < MorphoKinematic.r_mass(stellar_data_tmp, 0.5))
+                    component_coordinates, component_masses, component_velocities, component_energies, component_s_angular_momenta)
+                spacial_mask, = np.where(stellar_view.prc_spherical_radius[mask] < stellar_view.r_mass(0.5))
                 kappa_re, disc_fraction_re, circularity_re, rotational_over_dispersion_re, vrots_re, rotational_velocity_re, sigma_0_re, \
                 delta_re = MorphoKinematic.kinematic_diagnostics(
                     component_coordinates[spacial_mask], component_masses[spacial_mask], component_velocities[spacial_mask],
-                    component_energies[spacial_mask])
+                    component_energies[spacial_mask], component_s_angular_momenta[spacial_mask])
 
                 if i == 0:
                     stellar_data_tmp['disc_delta'] = delta  # In km s^-1.
@@ -367,206 +689,132 @@ class AddAttributes:
                     stellar_data_tmp['spheroid_weighted_a'] = np.average(component_birth_stellar_formation_time, weights=component_birth_mass,
                                                                          axis=0)  # Expansion factor at birth.
 
-            # Calculate galactic attributes #
-            stellar_data_tmp['disc_mask_IT20_cr_strict'], stellar_data_tmp['spheroid_mask_IT20_cr_strict'], stellar_data_tmp[
-                'disc_mask_IT20_cr_all'], \
-            stellar_data_tmp['spheroid_mask_IT20_cr_all'] = self.decomposition_IT20_cr(stellar_data_tmp)
-
+        # Calculate galactic attributes #
+        if 'decomposition_IT20_cr' in computations:
+            stellar_data_tmp['disc_mask_IT20_cr_strict'], stellar_data_tmp['spheroid_mask_IT20_cr_strict'] = AddAttributes.decomposition_IT20_cr(
+                stellar_view)
             stellar_data_tmp['disc_fraction_IT20_cr_strict'] = np.sum(
                 stellar_data_tmp['Mass'][stellar_data_tmp['disc_mask_IT20_cr_strict']]) / np.sum(stellar_data_tmp['Mass'])
-            stellar_data_tmp['disc_fraction_IT20_cr_all'] = np.sum(stellar_data_tmp['Mass'][stellar_data_tmp['disc_mask_IT20_cr_all']]) / np.sum(
-                stellar_data_tmp['Mass'])
-
-            # Save data in numpy array #
-            np.save(data_path + 'stellar_data_tmps/stellar_data_tmp_' + str(group_number) + '_' + str(subgroup_number), stellar_data_tmp)
-            np.save(data_path + 'gaseous_data_tmps/gaseous_data_tmp_' + str(group_number) + '_' + str(subgroup_number), gaseous_data_tmp)
 
-            print(
-                'Masked and saved data for halo ' + str(group_number) + '_' + str(subgroup_number) + ' in %.4s s' % (time.time() - start_local_time))
-            print('–––––––––––––––––––––––––––––––––––––––––––––')
-
-        print('Finished AddAttributes for ' + re.split('Planck1/|/PE', simulation_path)[1] + '_' + str(tag) + ' in %.4s s' % (
-            time.time() - start_global_time))
-        print('–––––––––––––––––––––––––––––––––––––––––––––')
+        return stellar_data_tmp, gaseous_data_tmp
 
 
     @staticmethod
-    def read_attributes(simulation_path, tag):
+    def mask_haloes(simulation_path, tag):
         """
-        Extract subhalo attributes and convert them to astronomical units.
+        Mask haloes: select haloes with masses within 30 kpc aperture higher than 5e9 Msun from the cached SUBFIND catalogue and convert their
+        attributes to astronomical units.
         :param simulation_path: simulation directory.
         :param tag: redshift directory.
-        :return: subhalo_data
-        """
-        # Load subhalo data in h-free physical CGS units #
-        subhalo_data = {}
-        file_type = 'SUBFIND'
-        for attribute in ['ApertureMeasurements/Mass/030kpc', 'GroupNumber', 'SubGroupNumber']:
-            subhalo_data[attribute] = E.read_array(file_type, simulation_path, tag, '/Subhalo/' + attribute, numThreads=8)
-
-        subhalo_data['ApertureMeasurements/Mass/030kpc'] *= u.g.to(u.Msun)
-
-        return subhalo_data
-
-
-    def mask_haloes(self):
-        """
-        Mask haloes: select haloes with masses within 30 kpc aperture higher than 5e9 Msun.
         :return: subhalo_data_tmp
         """
-        # Mask the halo data #
-        halo_mask = np.where(self.subhalo_data['ApertureMeasurements/Mass/030kpc'][:, 4] > 5e9)
+        catalogue = SubfindCatalogue(simulation_path, tag, data_path + 'catalogue_cache/')
+        subhalo_data_tmp = catalogue.select_subhaloes(['ApertureMeasurements/Mass/030kpc', 'GroupNumber', 'SubGroupNumber', 'SubLengthType'],
+                                                      lambda subhalo_data:subhalo_data['ApertureMeasurements/Mass/030kpc'][:, 4] * u.g.to(
+                                                          u.Msun) > 5e9)
 
-        # Mask the temporary dictionary for each galaxy #
-        subhalo_data_tmp = {}
-        for attribute in self.subhalo_data.keys():
-            subhalo_data_tmp[attribute] = np.copy(self.subhalo_data[attribute])[halo_mask]
+        # Convert attributes to astronomical units #
+        subhalo_data_tmp['ApertureMeasurements/Mass/030kpc'] *= u.g.to(u.Msun)
 
         return subhalo_data_tmp
 
 
     @staticmethod
-    def decomposition_IT20(stellar_data_tmp):
+    def decomposition_IT20(stellar_view):
         """
-        Find the particles that belong to the disc and spheroid based on the IT20 method.
-        :param stellar_data_tmp: from read_add_attributes.py.
-        :return: disc_mask_IT20, spheroid_mask_IT20, delta_theta
+        Find the particles that belong to the disc and spheroid based on the IT20 method, without and with the particles which counter-rotate wrt
+        the densest grid cell (i.e., Delta Theta>150 degrees). All variants share the rotated angular momenta, the HEALPix map and the densest grid
+        cell of the stellar_view.
+        :param stellar_view: GalaxyView of stellar_data_tmp.
+        :return: disc_mask_IT20, spheroid_mask_IT20, disc_mask_IT20_cr_all, spheroid_mask_IT20_cr_all, delta_theta, angular_theta_from_densest
         """
-        # Calculate the angular momentum for each particle and for the galaxy and the unit vector parallel to the galactic angular momentum vector #
-        prc_angular_momentum = stellar_data_tmp['Mass'][:, np.newaxis] * np.cross(stellar_data_tmp['Coordinates'],
-                                                                                  stellar_data_tmp['Velocity'])  # In Msun kpc km s^-1.
-        glx_stellar_angular_momentum = np.sum(prc_angular_momentum, axis=0)
-        glx_unit_vector = glx_stellar_angular_momentum / np.linalg.norm(glx_stellar_angular_momentum)
+        # Get the angular distance of each particle from the densest grid cell of the HEALPix map #
+        angular_theta_from_densest = stellar_view.angular_theta_from_densest  # In radians.
 
-        # Rotate coordinates and velocities of stellar particles wrt galactic angular momentum #
-        coordinates, velocities, prc_unit_vector, glx_unit_vector = RotateCoordinates.rotate_X(stellar_data_tmp, glx_unit_vector)
-
-        # Calculate the ra and el of the (unit vector of) angular momentum for each particle #
-        ra = np.degrees(np.arctan2(prc_unit_vector[:, 1], prc_unit_vector[:, 0]))
-        el = np.degrees(np.arcsin(prc_unit_vector[:, 2]))
-
-        # Plot a HEALPix histogram #
-        nside = 2 ** 4  # Define the resolution of the grid (number of divisions along the side of a base-resolution grid cell).
-        hp = HEALPix(nside=nside)  # Initialise the HEALPix pixelisation class.
-        indices = hp.lonlat_to_healpix(ra * u.deg, el * u.deg)  # Create a list of HEALPix indices from particles' ra and el.
-        densities = np.bincount(indices, minlength=hp.npix)  # Count number of data points in each HEALPix grid cell.
-
-        # Perform a top-hat smoothing on the densities #
-        smoothed_densities = np.zeros(hp.npix)
-        # Loop over all grid cells #
-        for i in range(hp.npix):
-            mask = hlp.query_disc(nside, hlp.pix2vec(nside, i), np.pi / 6.0)  # Do a 30degree cone search around each grid cell.
-            smoothed_densities[i] = np.mean(densities[mask])  # Average the densities of the ones inside and assign this value to the grid cell.
-
-        # Find location of density maximum #
-        index_densest = np.argmax(smoothed_densities)
-        lon_densest = (hp.healpix_to_lonlat([index_densest])[0].value + np.pi) % (2 * np.pi) - np.pi
-        lat_densest = (hp.healpix_to_lonlat([index_densest])[1].value + np.pi / 2) % (2 * np.pi) - np.pi / 2
-
-        # Calculate the disc mass fraction as the mass within 30 degrees from the densest grid cell #
-        angular_theta_from_densest = np.arccos(
-            np.sin(lat_densest) * np.sin(np.arcsin(prc_unit_vector[:, 2])) + np.cos(lat_densest) * np.cos(np.arcsin(prc_unit_vector[:, 2])) * np.cos(
-                lon_densest - np.arctan2(prc_unit_vector[:, 1], prc_unit_vector[:, 0])))  # In radians.
-        disc_mask_IT20, = np.where(angular_theta_from_densest < (np.pi / 6.0))
-        spheroid_mask_IT20, = np.where(angular_theta_from_densest > (np.pi / 6.0))
-
-        # Calculate the angle between the densest grid cell and the angular momentum vector of the galaxy #
-        position_of_X = np.vstack([np.arctan2(glx_unit_vector[1], glx_unit_vector[0]), np.arcsin(glx_unit_vector[2])]).T
-        angular_theta_from_X = np.arccos(
-            np.sin(position_of_X[0, 1]) * np.sin(lat_densest) + np.cos(position_of_X[0, 1]) * np.cos(lat_densest) * np.cos(
-                position_of_X[0, 0] - lon_densest))  # In radians.
-        delta_theta = np.degrees(angular_theta_from_X)  # In degrees.
-
-        return disc_mask_IT20, spheroid_mask_IT20, delta_theta
+        # Calculate the disc mass fraction as the mass within disc_angle (i.e., 30 degrees) from the densest grid cell #
+        disc_angle = MorphoKinematic.disc_angle
+        disc_mask_IT20, = np.where(angular_theta_from_densest < disc_angle)
+        spheroid_mask_IT20, = np.where(angular_theta_from_densest > disc_angle)
+
+        # Assign to the disc particles with angular_theta_from_densest>180deg-disc_angle (i.e., 150 degrees) as well #
+        disc_mask_IT20_cr_all, = np.where((angular_theta_from_densest < disc_angle) | (angular_theta_from_densest > np.pi - disc_angle))
+        spheroid_mask_IT20_cr_all, = np.where((angular_theta_from_densest > disc_angle) & (angular_theta_from_densest < np.pi - disc_angle))
+
+        # Calculate the angle between the densest grid cell and the (rotated) angular momentum vector of the galaxy #
+        glx_unit_vector = stellar_view.rotated_X[3]
+        delta_theta = np.degrees(np.arccos(np.clip(np.dot(glx_unit_vector, stellar_view.densest_unit_vector), -1.0, 1.0)))  # In degrees.
+
+        return disc_mask_IT20, spheroid_mask_IT20, disc_mask_IT20_cr_all, spheroid_mask_IT20_cr_all, delta_theta, angular_theta_from_densest
 
 
     @staticmethod
-    def decomposition_IT20_cr(stellar_data_tmp):
+    def decomposition_IT20_cr(stellar_view):
         """
         Find the particles that belong to the disc and spheroid based on the IT20 method and assign to the disc also particles with Delta Theta>150
-        degrees in galaxies with counter rotating components (150<angle<210) and in all
-        :param stellar_data_tmp: from read_add_attributes.py.
-        :return: disc_mask_IT20_cr_strict, spheroid_mask_IT20_cr_strict, disc_mask_IT20_cr_all, spheroid_mask_IT20_cr_all
+        degrees only in galaxies with counter rotating components (150<angle<210).
+        :param stellar_view: GalaxyView of stellar_data_tmp (with the outputs of decomposition_IT20 and of the component attributes).
+        :return: disc_mask_IT20_cr_strict, spheroid_mask_IT20_cr_strict
         """
-        # Calculate the angular momentum for each particle and for the galaxy and the unit vector parallel to the galactic angular momentum vector #
-        prc_angular_momentum = stellar_data_tmp['Mass'][:, np.newaxis] * np.cross(stellar_data_tmp['Coordinates'],
-                                                                                  stellar_data_tmp['Velocity'])  # In Msun kpc km s^-1.
-        glx_stellar_angular_momentum = np.sum(prc_angular_momentum, axis=0)
-        glx_unit_vector = glx_stellar_angular_momentum / np.linalg.norm(glx_stellar_angular_momentum)
-
-        # Rotate coordinates and velocities of stellar particles wrt galactic angular momentum #
-        coordinates, velocities, prc_unit_vector, glx_unit_vector = RotateCoordinates.rotate_X(stellar_data_tmp, glx_unit_vector)
-
-        # Calculate the ra and el of the (unit vector of) angular momentum for each particle #
-        ra = np.degrees(np.arctan2(prc_unit_vector[:, 1], prc_unit_vector[:, 0]))
-        el = np.degrees(np.arcsin(prc_unit_vector[:, 2]))
-
-        # Plot a HEALPix histogram #
-        nside = 2 ** 4  # Define the resolution of the grid (number of divisions along the side of a base-resolution grid cell).
-        hp = HEALPix(nside=nside)  # Initialise the HEALPix pixelisation class.
-        indices = hp.lonlat_to_healpix(ra * u.deg, el * u.deg)  # Create a list of HEALPix indices from particles' ra and el.
-        densities = np.bincount(indices, minlength=hp.npix)  # Count number of data points in each HEALPix grid cell.
-
-        # Perform a top-hat smoothing on the densities #
-        smoothed_densities = np.zeros(hp.npix)
-        # Loop over all grid cells #
-        for i in range(hp.npix):
-            mask = hlp.query_disc(nside, hlp.pix2vec(nside, i), np.pi / 6.0)  # Do a 30degree cone search around each grid cell.
-            smoothed_densities[i] = np.mean(densities[mask])  # Average the densities of the ones inside and assign this value to the grid cell.
-
-        # Find location of density maximum #
-        index_densest = np.argmax(smoothed_densities)
-        lon_densest = (hp.healpix_to_lonlat([index_densest])[0].value + np.pi) % (2 * np.pi) - np.pi
-        lat_densest = (hp.healpix_to_lonlat([index_densest])[1].value + np.pi / 2) % (2 * np.pi) - np.pi / 2
-
-        # Calculate the disc mass fraction as the mass within 30 degrees from the densest grid cell #
-        angular_theta_from_densest = np.arccos(
-            np.sin(lat_densest) * np.sin(np.arcsin(prc_unit_vector[:, 2])) + np.cos(lat_densest) * np.cos(np.arcsin(prc_unit_vector[:, 2])) * np.cos(
-                lon_densest - np.arctan2(prc_unit_vector[:, 1], prc_unit_vector[:, 0])))  # In radians.
-
         # Calculate the cosine of the angle between disc and spheroid components #
         cos_angle_components = np.divide(
-            np.sum(stellar_data_tmp['disc_stellar_angular_momentum'] * stellar_data_tmp['spheroid_stellar_angular_momentum']),
-            np.linalg.norm(stellar_data_tmp['disc_stellar_angular_momentum']) * np.linalg.norm(
-                stellar_data_tmp['spheroid_stellar_angular_momentum']))  # In radians.
+            np.sum(stellar_view['disc_stellar_angular_momentum'] * stellar_view['spheroid_stellar_angular_momentum']),
+            np.linalg.norm(stellar_view['disc_stellar_angular_momentum']) * np.linalg.norm(
+                stellar_view['spheroid_stellar_angular_momentum']))  # In radians.
 
         # If the components are counter-rotating (cos_angle_components<cos(150)) then assign to the disc particles with
         # angular_theta_from_densest>150deg as well #
         if cos_angle_components < np.cos(17 * (np.pi / 18.0)):
-            disc_mask_IT20_cr_strict, = np.where((angular_theta_from_densest < (np.pi / 6.0)) | (angular_theta_from_densest > 5 * (np.pi / 6.0)))
-            spheroid_mask_IT20_cr_strict, = np.where((angular_theta_from_densest > (np.pi / 6.0)) | (angular_theta_from_densest < 5 * (np.pi / 6.0)))
+            return stellar_view['disc_mask_IT20_cr_all'], stellar_view['spheroid_mask_IT20_cr_all']
         else:
-            disc_mask_IT20_cr_strict, = np.where(angular_theta_from_densest < (np.pi / 6.0))
-            spheroid_mask_IT20_cr_strict, = np.where(angular_theta_from_densest > (np.pi / 6.0))
+            return stellar_view['disc_mask_IT20'], stellar_view['spheroid_mask_IT20']
 
-        # Assign to the disc particles with angular_theta_from_densest>150deg as well #
-        disc_mask_IT20_cr_all, = np.where((angular_theta_from_densest < (np.pi / 6.0)) | (angular_theta_from_densest > 5 * (np.pi / 6.0)))
-        spheroid_mask_IT20_cr_all, = np.where((angular_theta_from_densest > (np.pi / 6.0)) | (angular_theta_from_densest < 5 * (np.pi / 6.0)))
 
-        return disc_mask_IT20_cr_strict, spheroid_mask_IT20_cr_strict, disc_mask_IT20_cr_all, spheroid_mask_IT20_cr_all
+    @staticmethod
+    def peak_decomposition(stellar_view):
+        """
+        Find all significant peaks of the smoothed HEALPix map of the (rotated) angular momentum unit vectors of the particles (e.g., a
+        counter-rotating disc or a warp besides the densest grid cell) and assign each particle to the nearest peak.
+        :param stellar_view: GalaxyView of stellar_data_tmp.
+        :return: peak_unit_vectors, peak_significances, peak_masses, peak_index
+        """
+        # Find the peaks (the first one is the densest grid cell if it is significant) #
+        nside = 2 ** 4  # Resolution of the grid of the stellar_view.
+        peak_indices, peak_significances = find_peaks(stellar_view.densities, nside, smoothed_densities=stellar_view.smoothed_densities)
+        peak_unit_vectors = np.array(hlp.pix2vec(nside, peak_indices)).T.reshape(-1, 3)  # In the frame of stellar_view.rotated_X.
+
+        # Assign each particle to the peak with the smallest angular distance (-1 if there are no significant peaks) and sum their masses #
+        if len(peak_indices) > 0:
+            peak_index = np.argmax(np.dot(stellar_view.rotated_X[2], peak_unit_vectors.T), axis=1)
+        else:
+            peak_index = np.full(len(stellar_view['Mass']), -1)
+        peak_masses = np.bincount(peak_index[peak_index >= 0], weights=stellar_view['Mass'][peak_index >= 0], minlength=len(peak_indices))
+
+        return peak_unit_vectors, peak_significances, peak_masses, peak_index
 
 
     @staticmethod
-    def concentration_index(stellar_data_tmp):
+    def concentration_index(stellar_view):
         """
         Calculate the concentration index R90/R50 or 5*log10(R80/R20).
-        :param stellar_data_tmp: from read_add_attributes.py.
+        :param stellar_view: GalaxyView of stellar_data_tmp.
         :return: c
         """
-        c = MorphoKinematic.r_mass(stellar_data_tmp, 0.9) / MorphoKinematic.r_mass(stellar_data_tmp, 0.5)
-        # c = 5 * np.log10(MorphoKinematic.r_mass(stellar_data_tmp, 0.8) / MorphoKinematic.r_mass(stellar_data_tmp, 0.2))
+        r_90, r_50 = stellar_view.r_mass([0.9, 0.5])
+        c = r_90 / r_50
+        # r_20, r_80 = stellar_view.r_mass([0.2, 0.8])
+        # c = 5 * np.log10(r_80 / r_20)
         return c
 
 
     @staticmethod
-    def kappa_corotation(stellar_data_tmp):
+    def kappa_corotation(stellar_view):
         """
         Calculate the fraction of a particle's kinetic energy that's invested in corotation.
-        :param stellar_data_tmp: from read_add_attributes.py.
+        :param stellar_view: GalaxyView of stellar_data_tmp.
         :return: kappa_corotation
         """
         # Rotate the galaxy and calculate the unit vector pointing along the glx_stellar_angular_momentum direction.
-        coordinates, velocities, prc_angular_momentum, glx_stellar_angular_momentum = RotateCoordinates.rotate_Jz(stellar_data_tmp)
+        coordinates, velocities, prc_angular_momentum, glx_stellar_angular_momentum = stellar_view.rotated_Jz
         prc_spc_angular_momentum = np.cross(coordinates, velocities)  # In kpc km s^-1.
         glx_unit_vector = glx_stellar_angular_momentum / np.linalg.norm(glx_stellar_angular_momentum)
         spc_angular_momentum_z = np.sum(glx_unit_vector * prc_spc_angular_momentum, axis=1)  # In kpc km s^-1.
@@ -574,55 +822,54 @@ class AddAttributes:
 
         corotation_mask, = np.where(spc_angular_momentum_z > 0)
         specific_angular_velocity = spc_angular_momentum_z[corotation_mask] / prc_cylindrical_distance[corotation_mask]  # In km s^-1.
-        kinetic_energy = np.sum(stellar_data_tmp['Mass'] * np.linalg.norm(velocities, axis=1) ** 2)  # In Msun km^2 s^-2.
-        angular_kinetic_energy = np.sum(stellar_data_tmp['Mass'][corotation_mask] * specific_angular_velocity ** 2)  # In Msun km^2 s^-2.
+        kinetic_energy = np.sum(stellar_view['Mass'] * np.linalg.norm(velocities, axis=1) ** 2)  # In Msun km^2 s^-2.
+        angular_kinetic_energy = np.sum(stellar_view['Mass'][corotation_mask] * specific_angular_velocity ** 2)  # In Msun km^2 s^-2.
         kappa_corotation = angular_kinetic_energy / kinetic_energy
 
         return kappa_corotation
 
 
     @staticmethod
-    def kinematic_diagnostics(stellar_data_tmp):
+    def kinematic_diagnostics(stellar_view):
         """
         Calculate the disc fraction and the rotational over dispersion velocity ratio.
-        :param stellar_data_tmp: from read_add_attributes.py.
+        :param stellar_view: GalaxyView of stellar_data_tmp.
         :return: disc_fraction, rotational_over_dispersion, rotational_velocity, sigma_0, delta
         """
         kappa, disc_fraction, circularity, rotational_over_dispersion, vrots, rotational_velocity, sigma_0, \
-        delta = MorphoKinematic.kinematic_diagnostics(
-            stellar_data_tmp['Coordinates'], stellar_data_tmp['Mass'], stellar_data_tmp['Velocity'], stellar_data_tmp['ParticleBindingEnergy'])
+        delta = MorphoKinematic.kinematic_diagnostics(stellar_view['Coordinates'], stellar_view['Mass'], stellar_view['Velocity'],
+                                                      stellar_view['ParticleBindingEnergy'], stellar_view.prc_specific_angular_momentum)
 
         # Calculate kinematic diagnostics within half-mass radius #
-        prc_spherical_radius = np.sqrt(np.sum(stellar_data_tmp['Coordinates'] ** 2, axis=1))
-        spacial_mask, = np.where(prc_spherical_radius < MorphoKinematic.r_mass(stellar_data_tmp, 0.5))
+        spacial_mask, = np.where(stellar_view.prc_spherical_radius < stellar_view.r_mass(0.5))
         kappa_re, disc_fraction_re, circularity_re, rotational_over_dispersion_re, vrots_re, rotational_velocity_re, sigma_0_re, \
         delta_re = MorphoKinematic.kinematic_diagnostics(
-            stellar_data_tmp['Coordinates'][spacial_mask], stellar_data_tmp['Mass'][spacial_mask], stellar_data_tmp['Velocity'][spacial_mask],
-            stellar_data_tmp['ParticleBindingEnergy'][spacial_mask])
+            stellar_view['Coordinates'][spacial_mask], stellar_view['Mass'][spacial_mask], stellar_view['Velocity'][spacial_mask],
+            stellar_view['ParticleBindingEnergy'][spacial_mask], stellar_view.prc_specific_angular_momentum[spacial_mask])
 
         return disc_fraction, circularity, rotational_over_dispersion, rotational_velocity, sigma_0, delta, sigma_0_re, rotational_velocity_re
 
 
     @staticmethod
-    def beta_components(stellar_data_tmp):
+    def beta_components(stellar_view):
         """
         Calculate the components of the anisotropy parameter beta.
-        :param stellar_data_tmp: from read_add_attributes.py.
+        :param stellar_view: GalaxyView of stellar_data_tmp.
         :return: velocity_sqred, velocity_r_sqred
         """
         # Calculate u^2 and u_r^2 #
-        velocity_sqred = np.sum(stellar_data_tmp['Velocity'] * stellar_data_tmp['Velocity'], axis=1)
-        velocity_r_sqred = np.divide(np.sum(stellar_data_tmp['Velocity'] * stellar_data_tmp['Coordinates'], axis=1) ** 2,
-                                     np.sum(stellar_data_tmp['Coordinates'] * stellar_data_tmp['Coordinates'], axis=1))
+        velocity_sqred = np.sum(stellar_view['Velocity'] * stellar_view['Velocity'], axis=1)
+        velocity_r_sqred = np.divide(np.sum(stellar_view['Velocity'] * stellar_view['Coordinates'], axis=1) ** 2,
+                                     stellar_view.prc_spherical_radius ** 2)
 
         return velocity_sqred, velocity_r_sqred
 
 
     @staticmethod
-    def profile_fitting(stellar_data_tmp):
+    def profile_fitting(stellar_view):
         """
         Calculate the Sersic index.
-        :param stellar_data_tmp: from read_add_attributes.py.
+        :param stellar_view: GalaxyView of stellar_data_tmp.
         :return: n, R_d, R_eff, disk_fraction_profile
         """
 
@@ -681,12 +928,12 @@ class AddAttributes:
 
 
         # Rotate coordinates and velocities of stellar particles wrt galactic angular momentum #
-        coordinates, velocities, prc_angular_momentum, glx_angular_momentum = RotateCoordinates.rotate_Jz(stellar_data_tmp)
+        coordinates, velocities, prc_angular_momentum, glx_angular_momentum = stellar_view.rotated_Jz
 
         cylindrical_distance = np.sqrt(coordinates[:, 0] ** 2 + coordinates[:, 1] ** 2)  # Radius of each particle.
         vertical_mask, = np.where(abs(coordinates[:, 2]) < 5)  # Vertical cut in kpc.
 
-        mass, edges = np.histogram(cylindrical_distance[vertical_mask], bins=50, range=(0, 30), weights=stellar_data_tmp['Mass'][vertical_mask])
+        mass, edges = np.histogram(cylindrical_distance[vertical_mask], bins=50, range=(0, 30), weights=stellar_view['Mass'][vertical_mask])
         centers = 0.5 * (edges[1:] + edges[:-1])
         surface = np.pi * (edges[1:] ** 2 - edges[:-1] ** 2)
         sden = mass / surface
@@ -722,27 +969,27 @@ class AddAttributes:
 
 
     @staticmethod
-    def delta_r(stellar_data_tmp, gaseous_data_tmp, dark_matter_data_tmp):
+    def delta_r(stellar_view, gaseous_data_tmp, dark_matter_data_tmp):
         """
         Calculate the distance between the centre of mass and the centre of potential (accounted for in mask_galaxies) normalised wrt the half-mass
         radius.
-        :param stellar_data_tmp: from read_add_attributes.py.
+        :param stellar_view: GalaxyView of stellar_data_tmp.
         :param gaseous_data_tmp: from read_add_attributes.py.
         :param dark_matter_data_tmp: from read_add_attributes.py.
         :return: delta_r
         """
-        prc_masses = np.hstack([stellar_data_tmp['Mass'], gaseous_data_tmp['Mass'], dark_matter_data_tmp['Mass']])
-        prc_coordinates = np.vstack([stellar_data_tmp['Coordinates'], gaseous_data_tmp['Coordinates'], dark_matter_data_tmp['Coordinates']])
+        prc_masses = np.hstack([stellar_view['Mass'], gaseous_data_tmp['Mass'], dark_matter_data_tmp['Mass']])
+        prc_coordinates = np.vstack([stellar_view['Coordinates'], gaseous_data_tmp['Coordinates'], dark_matter_data_tmp['Coordinates']])
         CoM = np.divide(np.sum(prc_masses[:, np.newaxis] * prc_coordinates, axis=0), np.sum(prc_masses, axis=0))
 
-        delta_r = np.linalg.norm(CoM) / MorphoKinematic.r_mass(stellar_data_tmp, 0.5)
+        delta_r = np.linalg.norm(CoM) / stellar_view.r_mass(0.5)
 
         return delta_r
 
 
 class AppendAttributes:
     """
-    For each galaxy: load its stellar_data_tmp dictionary and append the attribute(s).
+    For each galaxy: load its row of the scalar catalogues and append the attribute(s).
     """
 
 
@@ -752,187 +999,22 @@ class AppendAttributes:
         :param simulation_path: simulation directory.
         :param tag: redshift directory.
         """
-        # Initialise arrays to store the data #
-        group_numbers, subgroup_numbers, CoPs = [], [], []
-        glx_stellar_angular_momenta, glx_stellar_masses, glx_concentration_indices, glx_kappas_corotation, glx_disc_fractions_IT20, \
-        glx_disc_fractions, glx_circularities, glx_rotationals_over_dispersions, glx_Sersic_indices, glx_scale_lengths, glx_effective_radii, \
-        glx_disk_fraction_profiles, glx_n_particles, glx_fitting_flags, glx_delta_thetas, glx_delta_rs, glx_deltas, glx_sigma_0s, glx_rotationals, \
-        glx_as, glx_CoP_flags, glx_sigma_0s_re, glx_rotationals_re, glx_disc_fractions_IT20_cr_all, glx_disc_fractions_IT20_cr_strict = [], [], [],\
-                                                                                                                                        [], [], [],\
-                                                                                                                                        [], [], [],\
-                                                                                                                                        [], [], [],\
-                                                                                                                                        [], [], [],\
-                                                                                                                                        [], [], [],\
-                                                                                                                                        [], [], [],\
-                                                                                                                                        [], [], [], []
-        glx_gaseous_angular_momenta, glx_gaseous_masses, glx_star_formings, glx_non_star_formings, glx_star_formation_rates = [], [], [], [], []
-        bh_masses = []
-        dark_matter_masses = []
-        disc_metallicities, spheroid_metallicities, disc_betas, spheroid_betas, disc_rotationals, spheroid_rotationals, disc_sigma_0s, \
-        spheroid_sigma_0s, disc_birth_densities, spheroid_birth_densities, disc_deltas, spheroid_deltas, disc_as, spheroid_as, \
-        disc_stellar_angular_momenta, spheroid_stellar_angular_momenta, disc_weighted_as, spheroid_weighted_as, disc_sigma_0s_re, \
-        spheroid_sigma_0s_re = [], [], [], [], [], [], [], [], [], [], [], [], [], [], [], [], [], [], [], []
-
-        # Extract particle and subhalo attributes and convert them to astronomical units #
-        self.subhalo_data = self.read_attributes(simulation_path, tag)
+        # Mask haloes: select haloes with masses within 30 kpc aperture higher than 5e9 Msun and convert their attributes to astronomical units #
+        self.subhalo_data_tmp = self.mask_haloes(simulation_path, tag)
         print('Read data for ' + re.split('Planck1/|/PE', simulation_path)[1] + ' in %.4s s' % (time.time() - start_global_time))
         print('–––––––––––––––––––––––––––––––––––––––––––––')
 
-        self.subhalo_data_tmp = self.mask_haloes()  # Mask haloes: select haloes with masses within 30 kpc aperture higher than 5e9 Msun.
-        for group_number, subgroup_number in zip(list(self.subhalo_data_tmp['GroupNumber']),
-                                                 list(self.subhalo_data_tmp['SubGroupNumber'])):  # Loop over all masked haloes and sub-haloes.
-            start_local_time = time.time()  # Start the local time.
-
-            # Load the data #
-            subhalo_data_tmp = np.load(data_path + 'subhalo_data_tmps/subhalo_data_tmp_' + str(group_number) + '_' + str(subgroup_number) + '.npy',
-                                       allow_pickle=True)
-            subhalo_data_tmp = subhalo_data_tmp.item()
-            stellar_data_tmp = np.load(data_path + 'stellar_data_tmps/stellar_data_tmp_' + str(group_number) + '_' + str(subgroup_number) + '.npy',
-                                       allow_pickle=True)
-            stellar_data_tmp = stellar_data_tmp.item()
-            gaseous_data_tmp = np.load(data_path + 'gaseous_data_tmps/gaseous_data_tmp_' + str(group_number) + '_' + str(subgroup_number) + '.npy',
-                                       allow_pickle=True)
-            gaseous_data_tmp = gaseous_data_tmp.item()
-            blackhole_data_tmp = np.load(
-                data_path + 'blackhole_data_tmps/blackhole_data_tmp_' + str(group_number) + '_' + str(subgroup_number) + '.npy', allow_pickle=True)
-            blackhole_data_tmp = blackhole_data_tmp.item()
-            dark_matter_data_tmp = np.load(
-                data_path + 'dark_matter_data_tmps/dark_matter_data_tmp_' + str(group_number) + '_' + str(subgroup_number) + '.npy',
-                allow_pickle=True)
-            dark_matter_data_tmp = dark_matter_data_tmp.item()
-
-            # Append (sub)halo attributes into single arrays #
-            group_numbers.append(group_number)
-            subgroup_numbers.append(subgroup_number)
-            CoPs.append(subhalo_data_tmp['CentreOfPotential'])
-
-            # Append galactic attributes into single arrays #
-            glx_deltas.append(stellar_data_tmp['delta'])
-            glx_delta_rs.append(stellar_data_tmp['delta_r'])
-            glx_sigma_0s.append(stellar_data_tmp['sigma_0'])
-            glx_Sersic_indices.append(stellar_data_tmp['n'])
-            glx_scale_lengths.append(stellar_data_tmp['R_d'])
-            glx_n_particles.append(len(stellar_data_tmp['Mass']))
-            glx_effective_radii.append(stellar_data_tmp['R_eff'])
-            glx_sigma_0s_re.append(stellar_data_tmp['sigma_0_re'])
-            glx_concentration_indices.append(stellar_data_tmp['c'])
-            glx_delta_thetas.append(stellar_data_tmp['delta_theta'])
-            glx_fitting_flags.append(stellar_data_tmp['fitting_flag'])
-            glx_stellar_masses.append(np.sum(stellar_data_tmp['Mass']))
-            glx_disc_fractions.append(stellar_data_tmp['disc_fraction'])
-            glx_rotationals.append(stellar_data_tmp['rotational_velocity'])
-            glx_as.append(np.mean(stellar_data_tmp['StellarFormationTime']))
-            glx_circularities.append(np.mean(stellar_data_tmp['circularity']))
-            glx_kappas_corotation.append(stellar_data_tmp['kappa_corotation'])
-            glx_rotationals_re.append(stellar_data_tmp['rotational_velocity_re'])
-            glx_disc_fractions_IT20.append(stellar_data_tmp['disc_fraction_IT20'])
-            glx_disk_fraction_profiles.append(stellar_data_tmp['disk_fraction_profile'])
-            glx_disc_fractions_IT20_cr_all.append(stellar_data_tmp['disc_fraction_IT20_cr_all'])
-            glx_stellar_angular_momenta.append(stellar_data_tmp['glx_stellar_angular_momentum'])
-            glx_rotationals_over_dispersions.append(stellar_data_tmp['rotational_over_dispersion'])
-            glx_disc_fractions_IT20_cr_strict.append(stellar_data_tmp['disc_fraction_IT20_cr_strict'])
-
-            glx_gaseous_masses.append(np.sum(gaseous_data_tmp['Mass']))
-            glx_star_formation_rates.append(np.sum(gaseous_data_tmp['StarFormationRate']))
-            glx_gaseous_angular_momenta.append(gaseous_data_tmp['glx_gaseous_angular_momentum'])
-            glx_star_formings.append(np.sum(gaseous_data_tmp['Mass'][gaseous_data_tmp['star_forming_mask']]))
-            glx_non_star_formings.append(np.sum(gaseous_data_tmp['Mass'][gaseous_data_tmp['non_star_forming_mask']]))
-
-            bh_masses.append(np.sum(blackhole_data_tmp['BH_Mass'], axis=0))
-
-            dark_matter_masses.append(np.sum(dark_matter_data_tmp['Mass']))
-
-            # Append component attributes into single arrays #
-            disc_as.append(stellar_data_tmp['disc_a'])
-            spheroid_as.append(stellar_data_tmp['spheroid_a'])
-            disc_betas.append(stellar_data_tmp['disc_beta'])
-            disc_betas.append(stellar_data_tmp['disc_beta'])
-            spheroid_betas.append(stellar_data_tmp['spheroid_beta'])
-            disc_deltas.append(stellar_data_tmp['disc_delta'])
-            spheroid_deltas.append(stellar_data_tmp['spheroid_delta'])
-            disc_sigma_0s.append(stellar_data_tmp['disc_sigma_0'])
-            spheroid_sigma_0s.append(stellar_data_tmp['spheroid_sigma_0'])
-            disc_sigma_0s_re.append(stellar_data_tmp['disc_sigma_0_re'])
-            disc_rotationals.append(stellar_data_tmp['disc_rotational'])
-            disc_weighted_as.append(stellar_data_tmp['disc_weighted_a'])
-            spheroid_sigma_0s_re.append(stellar_data_tmp['spheroid_sigma_0_re'])
-            spheroid_rotationals.append(stellar_data_tmp['spheroid_rotational'])
-            spheroid_weighted_as.append(stellar_data_tmp['spheroid_weighted_a'])
-            disc_metallicities.append(stellar_data_tmp['disc_metallicity'])
-            spheroid_metallicities.append(stellar_data_tmp['spheroid_metallicity'])
-            disc_birth_densities.append(stellar_data_tmp['disc_birth_density'])
-            spheroid_birth_densities.append(stellar_data_tmp['spheroid_birth_density'])
-            disc_stellar_angular_momenta.append(stellar_data_tmp['disc_stellar_angular_momentum'])
-            spheroid_stellar_angular_momenta.append(stellar_data_tmp['spheroid_stellar_angular_momentum'])
-
-            print(
-                'Masked and saved data for halo ' + str(group_number) + '_' + str(subgroup_number) + ' in %.4s s' % (time.time() - start_local_time))
+        # Concatenate the scalar catalogues AddAttributes saved for each shard (one row per galaxy) in the order of the masked haloes #
+        columns, missing = concatenate_catalogues(data_path + 'scalar_catalogues/', self.subhalo_data_tmp['GroupNumber'],
+                                                  self.subhalo_data_tmp['SubGroupNumber'])
+        if len(missing) > 0:
+            print('No scalar catalogue row for ' + str(len(missing)) + ' haloes (e.g., ' + str(missing[0][0]) + '_' + str(missing[0][1]) + ')')
             print('–––––––––––––––––––––––––––––––––––––––––––––')
 
-        # Save data in numpy array #
-        # box_data_tmp = np.load(data_path + 'box_data.npy')
-        # box_data_tmp = box_data_tmp.item()
-        # CoP_flags = self.CoP_flags(CoPs, box_data_tmp, glx_stellar_masses)
-        # np.save(data_path + 'CoPs', CoPs)
-        # np.save(data_path + 'CoP_flags', CoP_flags)
-        np.save(data_path + 'group_numbers', group_numbers)
-        np.save(data_path + 'subgroup_numbers', subgroup_numbers)
-
-        np.save(data_path + 'glx_as', glx_as)
-        np.save(data_path + 'glx_deltas', glx_deltas)
-        np.save(data_path + 'glx_delta_rs', glx_delta_rs)
-        np.save(data_path + 'glx_sigma_0s', glx_sigma_0s)
-        np.save(data_path + 'glx_sigma_0s_re', glx_sigma_0s_re)
-        np.save(data_path + 'glx_rotationals', glx_rotationals)
-        np.save(data_path + 'glx_n_particles', glx_n_particles)
-        np.save(data_path + 'glx_delta_thetas', glx_delta_thetas)
-        np.save(data_path + 'glx_fitting_flags', glx_fitting_flags)
-        np.save(data_path + 'glx_scale_lengths', glx_scale_lengths)
-        np.save(data_path + 'glx_circularities', glx_circularities)
-        np.save(data_path + 'glx_stellar_masses', glx_stellar_masses)
-        np.save(data_path + 'glx_disc_fractions', glx_disc_fractions)
-        np.save(data_path + 'glx_Sersic_indices', glx_Sersic_indices)
-        np.save(data_path + 'glx_rotationals_re', glx_rotationals_re)
-        np.save(data_path + 'glx_effective_radii', glx_effective_radii)
-        np.save(data_path + 'glx_kappas_corotation', glx_kappas_corotation)
-        np.save(data_path + 'glx_disc_fractions_IT20', glx_disc_fractions_IT20)
-        np.save(data_path + 'glx_concentration_indices', glx_concentration_indices)
-        np.save(data_path + 'glx_disk_fraction_profiles', glx_disk_fraction_profiles)
-        np.save(data_path + 'glx_stellar_angular_momenta', glx_stellar_angular_momenta)
-        np.save(data_path + 'glx_disc_fractions_IT20_cr_all', glx_disc_fractions_IT20_cr_all)
-        np.save(data_path + 'glx_rotationals_over_dispersions', glx_rotationals_over_dispersions)
-        np.save(data_path + 'glx_disc_fractions_IT20_cr_strict', glx_disc_fractions_IT20_cr_strict)
-
-        np.save(data_path + 'glx_star_forming', glx_star_formings)
-        np.save(data_path + 'glx_gaseous_masses', glx_gaseous_masses)
-        np.save(data_path + 'glx_non_star_forming', glx_non_star_formings)
-        np.save(data_path + 'glx_star_formation_rates', glx_star_formation_rates)
-        np.save(data_path + 'glx_gaseous_angular_momenta', glx_gaseous_angular_momenta)
-
-        np.save(data_path + 'bh_masses', bh_masses)
-
-        np.save(data_path + 'dark_matter_masses', dark_matter_masses)
-
-        np.save(data_path + 'disc_as', disc_as)
-        np.save(data_path + 'spheroid_as', spheroid_as)
-        np.save(data_path + 'disc_betas', disc_betas)
-        np.save(data_path + 'spheroid_betas', spheroid_betas)
-        np.save(data_path + 'disc_deltas', disc_deltas)
-        np.save(data_path + 'spheroid_deltas', spheroid_deltas)
-        np.save(data_path + 'disc_sigma_0s', disc_sigma_0s)
-        np.save(data_path + 'spheroid_sigma_0s', spheroid_sigma_0s)
-        np.save(data_path + 'disc_sigma_0s_re', disc_sigma_0s_re)
-        np.save(data_path + 'disc_rotationals', disc_rotationals)
-        np.save(data_path + 'disc_weighted_as', disc_weighted_as)
-        np.save(data_path + 'spheroid_sigma_0s_re', spheroid_sigma_0s_re)
-        np.save(data_path + 'spheroid_rotationals', spheroid_rotationals)
-        np.save(data_path + 'spheroid_weighted_as', spheroid_weighted_as)
-        np.save(data_path + 'disc_metallicities', disc_metallicities)
-        np.save(data_path + 'spheroid_metallicities', spheroid_metallicities)
-        np.save(data_path + 'disc_birth_densities', disc_birth_densities)
-        np.save(data_path + 'spheroid_birth_densities', spheroid_birth_densities)
-        np.save(data_path + 'disc_stellar_angular_momenta', disc_stellar_angular_momenta)
-        np.save(data_path + 'spheroid_stellar_angular_momenta', spheroid_stellar_angular_momenta)
+        # Save data in the galaxy catalogue #
+        # box_data_tmp, FOF_data_tmp = GalaxyStore(data_path + 'galaxy_store/').load_global()
+        # columns['CoP_flags'] = self.CoP_flags(columns['CoPs'], box_data_tmp, columns['glx_stellar_masses'])
+        GalaxyCatalogue.write(data_path + 'galaxy_catalogue.hdf5', columns)
 
         print('Finished AppendAttributes for ' + re.split('Planck1/|/PE', simulation_path)[1] + '_' + str(tag) + ' in %.4s s' % (
             time.time() - start_global_time))
@@ -940,37 +1022,122 @@ class AppendAttributes:
 
 
     @staticmethod
-    def read_attributes(simulation_path, tag):
+    def disc_fraction_sweep(group_numbers, subgroup_numbers, angles):
         """
-        Extract subhalo attributes and convert them to astronomical units.
-        :param simulation_path: simulation directory.
-        :param tag: redshift directory.
-        :return: subhalo_data
+        Calculate the IT20 disc-to-total ratios of many galaxies for many cut angles from the angular distances decomposition_IT20 saved in the
+        galaxy store (i.e., without rerunning AddAttributes). Each galaxy costs one sort, whatever the number of angles.
+        :param group_numbers: group numbers of the galaxies.
+        :param subgroup_numbers: subgroup numbers of the galaxies.
+        :param angles: cut angles in radians.
+        :return: disc_fractions, corrected_disc_fractions (one row per galaxy and one column per angle)
         """
-        # Load subhalo data in h-free physical CGS units #
-        subhalo_data = {}
-        file_type = 'SUBFIND'
-        for attribute in ['ApertureMeasurements/Mass/030kpc', 'GroupNumber', 'SubGroupNumber']:
-            subhalo_data[attribute] = E.read_array(file_type, simulation_path, tag, '/Subhalo/' + attribute, numThreads=8)
+        galaxy_store = GalaxyStore(data_path + 'galaxy_store/')
+        disc_fractions = np.empty((len(group_numbers), len(angles)))
+        corrected_disc_fractions = np.empty((len(group_numbers), len(angles)))
+        for i, (group_number, subgroup_number) in enumerate(zip(group_numbers, subgroup_numbers)):
+            stellar_data_tmp = galaxy_store.load_lazy_galaxy(group_number, subgroup_number, 'stellar')
+            disc_fractions[i], corrected_disc_fractions[i] = MorphoKinematic.disc_fraction_sweep(stellar_data_tmp['angular_theta_from_densest'],
+                                                                                                 stellar_data_tmp['Mass'], angles)
+        return disc_fractions, corrected_disc_fractions
 
-        # Convert attributes to astronomical units #
-        subhalo_data['ApertureMeasurements/Mass/030kpc'] *= u.g.to(u.Msun)
 
-        return subhalo_data
+    @staticmethod
+    def get_scalars(group_number, subgroup_number, subhalo_data_tmp, stellar_data_tmp, gaseous_data_tmp, blackhole_data_tmp, dark_matter_data_tmp):
+        """
+        Get the attributes of a galaxy which AppendAttributes saves (i.e., a row of the scalar catalogue), keyed by the name of their output file.
+        :param group_number: from read_add_attributes.py.
+        :param subgroup_number: from read_add_attributes.py.
+        :param subhalo_data_tmp: subhalo attributes of the galaxy.
+        :param stellar_data_tmp: stellar particles of the galaxy, including the attributes from AddAttributes.calculate_attributes.
+        :param gaseous_data_tmp: gaseous particles of the galaxy, including the attributes from AddAttributes.calculate_attributes.
+        :param blackhole_data_tmp: black hole particles of the galaxy.
+        :param dark_matter_data_tmp: dark matter particles of the galaxy.
+        :return: scalars
+        """
+        scalars = {}
+
+        # (Sub)halo attributes #
+        scalars['group_numbers'] = group_number
+        scalars['subgroup_numbers'] = subgroup_number
+        scalars['CoPs'] = subhalo_data_tmp['CentreOfPotential']
+
+        # Galactic attributes #
+        scalars['glx_deltas'] = stellar_data_tmp['delta']
+        scalars['glx_delta_rs'] = stellar_data_tmp['delta_r']
+        scalars['glx_sigma_0s'] = stellar_data_tmp['sigma_0']
+        scalars['glx_Sersic_indices'] = stellar_data_tmp['n']
+        scalars['glx_scale_lengths'] = stellar_data_tmp['R_d']
+        scalars['glx_n_particles'] = len(stellar_data_tmp['Mass'])
+        scalars['glx_effective_radii'] = stellar_data_tmp['R_eff']
+        scalars['glx_sigma_0s_re'] = stellar_data_tmp['sigma_0_re']
+        scalars['glx_concentration_indices'] = stellar_data_tmp['c']
+        scalars['glx_delta_thetas'] = stellar_data_tmp['delta_theta']
+        scalars['glx_fitting_flags'] = stellar_data_tmp['fitting_flag']
+        scalars['glx_stellar_masses'] = np.sum(stellar_data_tmp['Mass'])
+        scalars['glx_disc_fractions'] = stellar_data_tmp['disc_fraction']
+        scalars['glx_rotationals'] = stellar_data_tmp['rotational_velocity']
+        scalars['glx_as'] = np.mean(stellar_data_tmp['StellarFormationTime'])
+        scalars['glx_circularities'] = np.mean(stellar_data_tmp['circularity'])
+        scalars['glx_kappas_corotation'] = stellar_data_tmp['kappa_corotation']
+        scalars['glx_rotationals_re'] = stellar_data_tmp['rotational_velocity_re']
+        scalars['glx_disc_fractions_IT20'] = stellar_data_tmp['disc_fraction_IT20']
+        scalars['glx_disk_fraction_profiles'] = stellar_data_tmp['disk_fraction_profile']
+        scalars['glx_disc_fractions_IT20_cr_all'] = stellar_data_tmp['disc_fraction_IT20_cr_all']
+        scalars['glx_stellar_angular_momenta'] = stellar_data_tmp['glx_stellar_angular_momentum']
+        scalars['glx_rotationals_over_dispersions'] = stellar_data_tmp['rotational_over_dispersion']
+        scalars['glx_disc_fractions_IT20_cr_strict'] = stellar_data_tmp['disc_fraction_IT20_cr_strict']
+
+        scalars['glx_gaseous_masses'] = np.sum(gaseous_data_tmp['Mass'])
+        scalars['glx_star_formation_rates'] = np.sum(gaseous_data_tmp['StarFormationRate'])
+        scalars['glx_gaseous_angular_momenta'] = gaseous_data_tmp['glx_gaseous_angular_momentum']
+        scalars['glx_star_forming'] = np.sum(gaseous_data_tmp['Mass'][gaseous_data_tmp['star_forming_mask']])
+        scalars['glx_non_star_forming'] = np.sum(gaseous_data_tmp['Mass'][gaseous_data_tmp['non_star_forming_mask']])
+
+        scalars['bh_masses'] = np.sum(blackhole_data_tmp['BH_Mass'], axis=0)
+
+        scalars['dark_matter_masses'] = np.sum(dark_matter_data_tmp['Mass'])
+
+        # Component attributes #
+        scalars['disc_as'] = stellar_data_tmp['disc_a']
+        scalars['spheroid_as'] = stellar_data_tmp['spheroid_a']
+        scalars['disc_betas'] = stellar_data_tmp['disc_beta']
+        scalars['spheroid_betas'] = stellar_data_tmp['spheroid_beta']
+        scalars['disc_deltas'] = stellar_data_tmp['disc_delta']
+        scalars['spheroid_deltas'] = stellar_data_tmp['spheroid_delta']
+        scalars['disc_sigma_0s'] = stellar_data_tmp['disc_sigma_0']
+        scalars['spheroid_sigma_0s'] = stellar_data_tmp['spheroid_sigma_0']
+        scalars['disc_sigma_0s_re'] = stellar_data_tmp['disc_sigma_0_re']
+        scalars['disc_rotationals'] = stellar_data_tmp['disc_rotational']
+        scalars['disc_weighted_as'] = stellar_data_tmp['disc_weighted_a']
+        scalars['spheroid_sigma_0s_re'] = stellar_data_tmp['spheroid_sigma_0_re']
+        scalars['spheroid_rotationals'] = stellar_data_tmp['spheroid_rotational']
+        scalars['spheroid_weighted_as'] = stellar_data_tmp['spheroid_weighted_a']
+        scalars['disc_metallicities'] = stellar_data_tmp['disc_metallicity']
+        scalars['spheroid_metallicities'] = stellar_data_tmp['spheroid_metallicity']
+        scalars['disc_birth_densities'] = stellar_data_tmp['disc_birth_density']
+        scalars['spheroid_birth_densities'] = stellar_data_tmp['spheroid_birth_density']
+        scalars['disc_stellar_angular_momenta'] = stellar_data_tmp['disc_stellar_angular_momentum']
+        scalars['spheroid_stellar_angular_momenta'] = stellar_data_tmp['spheroid_stellar_angular_momentum']
+
+        return scalars
 
 
-    def mask_haloes(self):
+    @staticmethod
+    def mask_haloes(simulation_path, tag):
         """
-        Mask haloes: select haloes with masses within 30 kpc aperture higher than 5e9 Msun.
+        Mask haloes: select haloes with masses within 30 kpc aperture higher than 5e9 Msun from the cached SUBFIND catalogue and convert their
+        attributes to astronomical units.
+        :param simulation_path: simulation directory.
+        :param tag: redshift directory.
         :return: subhalo_data_tmp
         """
-        # Mask the halo data #
-        halo_mask = np.where(self.subhalo_data['ApertureMeasurements/Mass/030kpc'][:, 4] > 5e9)
+        catalogue = SubfindCatalogue(simulation_path, tag, data_path + 'catalogue_cache/')
+        subhalo_data_tmp = catalogue.select_subhaloes(['ApertureMeasurements/Mass/030kpc', 'GroupNumber', 'SubGroupNumber', 'SubLengthType'],
+                                                      lambda subhalo_data:subhalo_data['ApertureMeasurements/Mass/030kpc'][:, 4] * u.g.to(
+                                                          u.Msun) > 5e9)
 
-        # Mask the temporary dictionary for each galaxy #
-        subhalo_data_tmp = {}
-        for attribute in self.subhalo_data.keys():
-            subhalo_data_tmp[attribute] = np.copy(self.subhalo_data[attribute])[halo_mask]
+        # Convert attributes to astronomical units #
+        subhalo_data_tmp['ApertureMeasurements/Mass/030kpc'] *= u.g.to(u.Msun)
 
         return subhalo_data_tmp
 
@@ -1024,12 +1191,39 @@ if __name__ == '__main__':
     tag = '027_z000p101'
     simulation_path = '/cosma7/data/Eagle/ScienceRuns/Planck1/L0100N1504/PE/REFERENCE/data/'  # Path to EAGLE data.
     data_path = '/cosma7/data/dp004/dc-irod1/EAGLE/python/data/'  # Path to save/load data.
-    if str(sys.argv[1]) == '-rd':
+    compression = None  # Compression filter of the galaxy store ('gzip', 'lzf' or None).
+    n_processes = int(os.environ.get('SLURM_CPUS_PER_TASK', 1))  # Number of worker processes per array task.
+    n_jobs = 50  # Number of array tasks (or MPI ranks) the galaxies are partitioned into.
+    flush_size = 100  # Number of galaxies saved in each part file of the galaxy store.
+    walltime = 23.5 * 3600  # Time (in seconds) after which a job stops cleanly, i.e., a margin below the SLURM time limit.
+    if str(sys.argv[1]) == '-pm':
+        print('Partitioning galaxies into jobs')
+        build_manifest(data_path + 'job_manifest.hdf5', AddAttributes.mask_haloes(simulation_path, tag), n_jobs,
+                       timings=load_timings(data_path + 'timings/'))
+    elif str(sys.argv[1]) == '-rd':
         print('Reading attributes')
-        x = ReadAttributes(simulation_path, tag)
+        x = ReadAttributes(simulation_path, tag, n_processes=n_processes)
+    elif str(sys.argv[1]) == '-rs':
+        print('Reading attributes in streaming mode')
+        x = ReadAttributes(simulation_path, tag, streaming=True)
+    elif str(sys.argv[1]) == '-rf':
+        print('Reading and adding attributes')
+        x = ReadAttributes(simulation_path, tag, n_processes=n_processes, add_attributes=True)
+    elif str(sys.argv[1]) == '-rq':
+        print('Reading attributes of quarantined galaxies')
+        x = ReadAttributes(simulation_path, tag, n_processes=n_processes, retry=True)
+    elif str(sys.argv[1]) == '-rv':
+        print('Reading attributes after verifying the completed galaxies')
+        x = ReadAttributes(simulation_path, tag, n_processes=n_processes, verify=True)
     elif str(sys.argv[1]) == '-ad':
         print('Adding attributes')
-        x = AddAttributes(simulation_path, tag)
+        x = AddAttributes(simulation_path, tag, n_processes=n_processes)
+    elif str(sys.argv[1]) == '-aq':
+        print('Adding attributes of quarantined galaxies')
+        x = AddAttributes(simulation_path, tag, n_processes=n_processes, retry=True)
+    elif str(sys.argv[1]) == '-av':
+        print('Adding attributes after verifying the completed galaxies')
+        x = AddAttributes(simulation_path, tag, n_processes=n_processes, verify=True)
     elif str(sys.argv[1]) == '-ap':
         print('Appending attributes')
         x = AppendAttributes(simulation_path, tag)
@@ -15,6 +15,8 @@ import matplotlib.style as style
 
 from astropy_healpix import HEALPix
 from plot_tools import RotateCoordinates
+from particle_store import GalaxyStore
+from galaxy_catalogue import GalaxyCatalogue
 
 style.use("classic")
 plt.rcParams.update({'font.family':'serif'})
@@ -39,7 +41,8 @@ class SampleRAEl:
         figure, axes = plt.subplots(nrows=10, ncols=10, figsize=(20, 20), subplot_kw={'projection':'mollweide'})
 
         # Select a random sample from all group numbers #
-        group_numbers = np.load(data_path + '/group_numbers.npy')
+        catalogue = GalaxyCatalogue(data_path + 'galaxy_catalogue.hdf5')
+        group_numbers = catalogue.load('group_numbers')
         group_numbers_sample = random.sample(list(group_numbers), 100)
 
         for i, axis in enumerate(axes.flatten()):
@@ -49,9 +52,7 @@ class SampleRAEl:
             subgroup_number = 0
 
             # Load the data #
-            stellar_data_tmp = np.load(data_path + 'stellar_data_tmps/stellar_data_tmp_' + str(group_number) + '_' + str(subgroup_number) + '.npy',
-                                       allow_pickle=True)
-            stellar_data_tmp = stellar_data_tmp.item()
+            stellar_data_tmp = galaxy_store.load_lazy_galaxy(group_number, subgroup_number, 'stellar')
             print('Loaded data for halo ' + str(group_number) + '_' + str(subgroup_number) + ' in %.4s s' % (time.time() - start_local_time))
             print('–––––––––––––––––––––––––––––––––––––––––––––')
 
@@ -123,6 +124,7 @@ if __name__ == '__main__':
     simulation_path = '/cosma7/data/Eagle/ScienceRuns/Planck1/L0100N1504/PE/REFERENCE/data/'  # Path to EAGLE data.
     plots_path = '/cosma7/data/dp004/dc-irod1/EAGLE/python/plots/'  # Path to save plots.
     data_path = '/cosma7/data/dp004/dc-irod1/EAGLE/python/data/'  # Path to save/load data.
+    galaxy_store = GalaxyStore(data_path + 'galaxy_store/')  # Store of per-galaxy particle data.
     if not os.path.exists(plots_path):
         os.makedirs(plots_path)
     x = SampleRAEl(simulation_path, tag)
@@ -8,7 +8,7 @@ import plot_tools
 matplotlib.use('Agg')
 
 import numpy as np
-import healpy as hlp
+import healpix_tools
 import matplotlib.cbook
 import astropy.units as u
 import matplotlib.pyplot as plt
@@ -18,6 +18,7 @@ from scipy.special import gamma
 from astropy_healpix import HEALPix
 from scipy.optimize import curve_fit
 from plot_tools import RotateCoordinates
+from particle_store import GalaxyStore
 
 style.use("classic")
 plt.rcParams.update({'font.family':'serif'})
@@ -50,9 +51,7 @@ class SampleSurfaceDensityProfiles:
                 start_local_time = time.time()  # Start the local time.
 
                 # Load the data #
-                stellar_data_tmp = np.load(
-                    data_path + 'stellar_data_tmps/stellar_data_tmp_' + str(group_number) + '_' + str(subgroup_number) + '.npy', allow_pickle=True)
-                stellar_data_tmp = stellar_data_tmp.item()
+                stellar_data_tmp = galaxy_store.load_lazy_galaxy(group_number, subgroup_number, 'stellar')
                 print('Loaded data for halo ' + str(group_number) + '_' + str(subgroup_number) + ' in %.4s s' % (time.time() - start_local_time))
                 print('–––––––––––––––––––––––––––––––––––––––––––––')
 
@@ -154,11 +153,7 @@ class SampleSurfaceDensityProfiles:
         densities = np.bincount(indices, minlength=hp.npix)  # Count number of data points in each HEALPix grid cell.
 
         # Perform a top-hat smoothing on the densities #
-        smoothed_densities = np.zeros(hp.npix)
-        # Loop over all grid cells #
-        for i in range(hp.npix):
-            mask = hlp.query_disc(nside, hlp.pix2vec(nside, i), np.pi / 6.0)  # Do a 30degree cone search around each grid cell.
-            smoothed_densities[i] = np.mean(densities[mask])  # Average the densities of the ones inside and assign this value to the grid cell.
+        smoothed_densities = healpix_tools.smooth(densities, nside)  # Average the densities within a 30degree cone around each grid cell.
 
         # Find the location of the density maximum #
         index_densest = np.argmax(smoothed_densities)
@@ -249,6 +244,7 @@ if __name__ == '__main__':
     simulation_path = '/cosma7/data/Eagle/ScienceRuns/Planck1/L0100N1504/PE/REFERENCE/data/'  # Path to EAGLE data.
     plots_path = '/cosma7/data/dp004/dc-irod1/EAGLE/python/plots/'  # Path to save plots.
     data_path = '/cosma7/data/dp004/dc-irod1/EAGLE/python/data/'  # Path to save/load data.
+    galaxy_store = GalaxyStore(data_path + 'galaxy_store/')  # Store of per-galaxy particle data.
     if not os.path.exists(plots_path):
         os.makedirs(plots_path)
     x = SampleSurfaceDensityProfiles(simulation_path, tag)
@@ -0,0 +1,472 @@
+import os
+import re
+import glob
+import h5py
+
+import numpy as np
+import eagle_IO.eagle_IO.eagle_IO as E
+
+from file_tools import atomic_write
+from particle_store import GroupIndex
+
+
+def get_particle_files(simulation_path, tag):
+    """
+    Get the eagle_subfind_particles files of a snapshot sorted by their file number.
+    :param simulation_path: simulation directory.
+    :param tag: redshift directory.
+    :return: file_names
+    """
+    file_names = sorted(glob.glob(simulation_path + 'particledata_' + tag + '/eagle_subfind_particles_' + tag + '.*.hdf5'),
+                        key=lambda file_name:int(re.split(r'\.', file_name)[-2]))
+    return file_names
+
+
+def get_conversion_factor(dataset, a, h):
+    """
+    Get the factor that converts a particle dataset to h-free physical CGS units.
+    :param dataset: HDF5 dataset.
+    :param a: expansion factor.
+    :param h: Hubble parameter.
+    :return: factor
+    """
+    factor = dataset.attrs.get('CGSConversionFactor') * a ** dataset.attrs.get('aexp-scale-exponent') * h ** dataset.attrs.get('h-scale-exponent')
+    return factor
+
+
+class SubhaloParticleReader:
+    """
+    Read only the particles of selected subhaloes from the eagle_subfind_particles files. The particles of each type are stored group by group
+    and subhalo by subhalo, so the SUBFIND per-type group and subhalo lengths give the (contiguous) particle range of each selected subhalo.
+    """
+
+
+    def __init__(self, simulation_path, tag, subhalo_data, FOF_data, group_numbers, subgroup_numbers):
+        """
+        A constructor method for the class.
+        :param simulation_path: simulation directory.
+        :param tag: redshift directory.
+        :param subhalo_data: SUBFIND subhalo data with 'GroupNumber', 'SubGroupNumber' and 'SubLengthType'.
+        :param FOF_data: SUBFIND FOF data with 'GroupLengthType'.
+        :param group_numbers: group numbers of the selected subhaloes.
+        :param subgroup_numbers: subgroup numbers of the selected subhaloes.
+        """
+        self.file_names = get_particle_files(simulation_path, tag)
+        self.subhalo_data = subhalo_data
+        self.FOF_data = FOF_data
+
+        # Find the rows of the selected subhaloes in the (group- and subgroup-sorted) SUBFIND table #
+        keys = GroupIndex.group_keys(subhalo_data['GroupNumber'], subhalo_data['SubGroupNumber'])
+        self.rows = np.searchsorted(keys, GroupIndex.group_keys(group_numbers, subgroup_numbers))
+
+        # Read the header attributes required for the unit conversion and the number of particles in each file #
+        with h5py.File(self.file_names[0], 'r') as f:
+            self.a = f['Header'].attrs.get('ExpansionFactor')
+            self.h = f['Header'].attrs.get('HubbleParam')
+        self.n_particles_file = []
+        for file_name in self.file_names:
+            with h5py.File(file_name, 'r') as f:
+                self.n_particles_file.append(f['Header'].attrs.get('NumPart_ThisFile'))
+        self.n_particles_file = np.array(self.n_particles_file, dtype=np.int64)
+
+        self.ranges = {}  # Dictionary of particle_type: (starts, lengths), built on first read.
+
+
+    def get_ranges(self, particle_type):
+        """
+        Calculate the start and length of each selected subhalo in the particle arrays (concatenated over all files) of a given type.
+        :param particle_type: particle type ('0', '1', '4' or '5').
+        :return: starts, lengths
+        """
+        if particle_type in self.ranges:
+            return self.ranges[particle_type]
+        type_index = int(particle_type)
+
+        # Calculate the offset of each group from the lengths of the preceding groups, so no full-length particle column is read #
+        group_numbers = np.asarray(self.subhalo_data['GroupNumber'], dtype=np.int64)
+        group_lengths = np.asarray(self.FOF_data['GroupLengthType'][:, type_index], dtype=np.int64)
+        group_offsets = (np.cumsum(group_lengths) - group_lengths)[group_numbers - 1]  # The FOF table is ordered by GroupNumber, which starts from 1.
+
+        # Calculate the offset of each subhalo within its group from the lengths of the preceding subhaloes of the same group #
+        subhalo_lengths = np.asarray(self.subhalo_data['SubLengthType'][:, type_index], dtype=np.int64)
+        cumulative_lengths = np.cumsum(subhalo_lengths) - subhalo_lengths
+        first_subhalo = np.searchsorted(group_numbers, group_numbers, side='left')
+        subhalo_offsets = group_offsets + cumulative_lengths - cumulative_lengths[first_subhalo]
+
+        self.ranges[particle_type] = subhalo_offsets[self.rows], subhalo_lengths[self.rows]
+        return self.ranges[particle_type]
+
+
+    def read_dataset(self, particle_type, attribute):
+        """
+        Read a particle dataset for the selected subhaloes only and convert it to h-free physical CGS units.
+        :param particle_type: particle type ('0', '1', '4' or '5').
+        :param attribute: name of the dataset.
+        :return: data
+        """
+        starts, lengths = self.get_ranges(particle_type)
+        return self.read_ranges(particle_type, attribute, starts, lengths)
+
+
+    def read_ranges(self, particle_type, attribute, starts, lengths):
+        """
+        Read a list of particle ranges (in the arrays concatenated over all files) and join them in the given order.
+        :param particle_type: particle type ('0', '1', '4' or '5').
+        :param attribute: name of the dataset.
+        :param starts: start of each range.
+        :param lengths: length of each range.
+        :return: data
+        """
+        starts, lengths = np.asarray(starts, dtype=np.int64), np.asarray(lengths, dtype=np.int64)
+        file_offsets = np.concatenate([[0], np.cumsum(self.n_particles_file[:, int(particle_type)])])
+        dataset = '/PartType' + particle_type + '/' + attribute
+
+        # Loop over all files and read the part of each range that lies in the file #
+        pieces, ranges, factor = [], [], None
+        for i, file_name in enumerate(self.file_names):
+            file_start, file_stop = file_offsets[i], file_offsets[i + 1]
+            if file_start == file_stop:
+                continue
+            with h5py.File(file_name, 'r') as f:
+                if factor is None:
+                    factor = get_conversion_factor(f[dataset], self.a, self.h)
+                    pieces.append(f[dataset][0:0])  # Keep an empty piece so the shape and type are defined even if nothing is read.
+                    ranges.append(-1)
+                for j in np.nonzero((starts < file_stop) & (starts + lengths > file_start))[0]:
+                    start, stop = max(starts[j], file_start), min(starts[j] + lengths[j], file_stop)
+                    pieces.append(f[dataset][start - file_start:stop - file_start])
+                    ranges.append(j)
+
+        # Join the pieces in the order of the input ranges (the pieces of a range that spans several files are read in file order) #
+        order = np.argsort(ranges, kind='stable')
+        data = np.concatenate([pieces[i] for i in order])
+
+        if np.issubdtype(data.dtype, np.floating):
+            data = data * factor
+        return data
+
+
+class StreamingReader:
+    """
+    Stream the eagle_subfind_particles files one at a time and route the particles of the selected subhaloes into per-galaxy buckets. When the
+    buckets exceed a memory budget they are sorted by (GroupNumber, SubGroupNumber) and spilled to disk (external-sort style), and each galaxy is
+    finalised as soon as all its particles have been read.
+    """
+
+
+    def __init__(self, simulation_path, tag, group_numbers, subgroup_numbers, particle_attributes, spill_path, memory_budget=4e9):
+        """
+        A constructor method for the class.
+        :param simulation_path: simulation directory.
+        :param tag: redshift directory.
+        :param group_numbers: group numbers of the selected subhaloes.
+        :param subgroup_numbers: subgroup numbers of the selected subhaloes.
+        :param particle_attributes: dictionary of particle_type: list of attributes to read.
+        :param spill_path: directory of the spill files.
+        :param memory_budget: maximum size (in bytes) of the in-memory buckets.
+        """
+        self.file_names = get_particle_files(simulation_path, tag)
+        self.keys = np.unique(GroupIndex.group_keys(group_numbers, subgroup_numbers))
+        self.particle_attributes = particle_attributes
+        self.spill_path = spill_path
+        self.memory_budget = memory_budget
+
+        self.buckets = {particle_type:[] for particle_type in particle_attributes.keys()}  # Lists of (keys, data) chunks.
+        self.templates = {}  # Dictionary of particle_type: empty columns, used for galaxies without particles of a type.
+        self.bucket_bytes = 0
+        self.spills = []  # List of (spill_file, {particle_type: (unique_keys, offsets, lengths)}).
+        self.n_finalised = 0  # Number of selected galaxies finalised so far.
+        if not os.path.exists(spill_path):
+            os.makedirs(spill_path, exist_ok=True)
+
+
+    def stream_galaxies(self):
+        """
+        Read the particle files one at a time and yield each selected galaxy once all its particles have been read.
+        :return: generator of (group_number, subgroup_number, galaxy_data), where galaxy_data is a dictionary of particle_type: data in h-free
+        physical CGS units.
+        """
+        # The particles of each type are sorted by group, so groups before the last one of each file are complete for that type. A type without
+        # particles in a file has none before that file's first group, so it is advanced to the first group the other types have in the file #
+        last_groups = {particle_type:-np.inf for particle_type in self.particle_attributes.keys()}
+
+        try:
+            for file_name in self.file_names:
+                with h5py.File(file_name, 'r') as f:
+                    a, h = f['Header'].attrs.get('ExpansionFactor'), f['Header'].attrs.get('HubbleParam')
+                    empty_types, first_groups = [], []
+                    for particle_type, attributes in self.particle_attributes.items():
+                        if f['Header'].attrs.get('NumPart_ThisFile')[int(particle_type)] == 0:
+                            empty_types.append(particle_type)
+                            continue
+                        if particle_type not in self.templates:
+                            self.templates[particle_type] = {attribute:f['PartType' + particle_type + '/' + attribute][0:0] for attribute in
+                                                             attributes}
+                        group_numbers = f['PartType' + particle_type + '/GroupNumber'][...]
+                        keys = GroupIndex.group_keys(group_numbers, f['PartType' + particle_type + '/SubGroupNumber'][...])
+                        last_groups[particle_type] = group_numbers[-1]
+                        first_groups.append(group_numbers[0])
+
+                        # Route the particles of the selected subhaloes into the buckets #
+                        mask, = np.where(np.isin(keys, self.keys))
+                        if len(mask) == 0:
+                            continue
+                        data = {}
+                        for attribute in attributes:
+                            dataset = f['PartType' + particle_type + '/' + attribute]
+                            data[attribute] = dataset[...][mask]
+                            if np.issubdtype(data[attribute].dtype, np.floating):
+                                data[attribute] = data[attribute] * get_conversion_factor(dataset, a, h)
+                        self.buckets[particle_type].append((keys[mask], data))
+                        self.bucket_bytes += keys[mask].nbytes + sum(column.nbytes for column in data.values())
+
+                    if len(first_groups) > 0:
+                        for particle_type in empty_types:
+                            last_groups[particle_type] = max(last_groups[particle_type], min(first_groups))
+
+                if self.bucket_bytes > self.memory_budget:
+                    self.spill()
+
+                # Finalise the galaxies whose groups are complete for all particle types #
+                complete_group = min(last_groups.values())
+                if np.isfinite(complete_group):
+                    for galaxy in self.finalise(GroupIndex.group_keys(complete_group, 0)):
+                        yield galaxy
+
+            for galaxy in self.finalise(np.iinfo(np.int64).max):
+                yield galaxy
+        finally:
+            # Remove the spill files (also if the caller stops early, e.g., before its walltime) #
+            for spill_file, spill_index in self.spills:
+                os.remove(spill_file)
+            self.spills = []
+
+
+    def get_buckets(self, particle_type):
+        """
+        Concatenate the in-memory chunks of a particle type and sort them by (GroupNumber, SubGroupNumber).
+        :param particle_type: particle type ('0', '1', '4' or '5').
+        :return: keys, data
+        """
+        chunks = self.buckets[particle_type]
+        if len(chunks) == 0:
+            return np.array([], dtype=np.int64), None
+        keys = np.concatenate([chunk[0] for chunk in chunks])
+        sort = np.argsort(keys, kind='stable')
+        data = {attribute:np.concatenate([chunk[1][attribute] for chunk in chunks])[sort] for attribute in chunks[0][1].keys()}
+        return keys[sort], data
+
+
+    def spill(self):
+        """
+        Sort the in-memory buckets and write them to a new spill file.
+        :return: None
+        """
+        spill_file = self.spill_path + 'spill_' + str(os.getpid()) + '_' + str(len(self.spills)) + '.hdf5'
+        spill_index = {}
+        with h5py.File(spill_file, 'w') as f:
+            for particle_type in self.particle_attributes.keys():
+                keys, data = self.get_buckets(particle_type)
+                if data is None:
+                    continue
+                f.create_dataset(particle_type + '/keys', data=keys)
+                for attribute in data.keys():
+                    f.create_dataset(particle_type + '/' + attribute, data=data[attribute])
+                spill_index[particle_type] = np.unique(keys, return_index=True, return_counts=True)
+
+        self.spills.append((spill_file, spill_index))
+        self.buckets = {particle_type:[] for particle_type in self.particle_attributes.keys()}
+        self.bucket_bytes = 0
+        return None
+
+
+    def finalise(self, key_limit):
+        """
+        Gather the particles of the not yet finalised galaxies with keys below a limit from the buckets and the spill files.
+        :param key_limit: galaxies with keys below this are complete.
+        :return: generator of (group_number, subgroup_number, galaxy_data)
+        """
+        n_complete = np.searchsorted(self.keys, key_limit, side='left')
+        if n_complete <= self.n_finalised:
+            return
+        batch_keys = self.keys[self.n_finalised:n_complete]
+
+        batch = {}
+        for particle_type in self.particle_attributes.keys():
+            pieces = []
+
+            # Read the (contiguous) range of the batch from each spill file (in the order they were written) #
+            for spill_file, spill_index in self.spills:
+                if particle_type not in spill_index:
+                    continue
+                unique_keys, offsets, lengths = spill_index[particle_type]
+                first, last = np.searchsorted(unique_keys, [batch_keys[0], key_limit], side='left')
+                if first == last:
+                    continue
+                start, stop = offsets[first], offsets[last - 1] + lengths[last - 1]
+                with h5py.File(spill_file, 'r') as f:
+                    pieces.append((f[particle_type + '/keys'][start:stop], {attribute:f[particle_type + '/' + attribute][start:stop] for attribute in
+                                                                             self.particle_attributes[particle_type]}))
+
+            # Take the complete particles out of the in-memory buckets (read after the spilled ones) and keep the rest #
+            keys, data = self.get_buckets(particle_type)
+            if data is not None:
+                split = np.searchsorted(keys, key_limit, side='left')
+                pieces.append((keys[:split], {attribute:column[:split] for attribute, column in data.items()}))
+                self.buckets[particle_type] = [(keys[split:], {attribute:column[split:] for attribute, column in data.items()})]
+
+            # Merge the pieces and split them per galaxy #
+            if len(pieces) > 0:
+                keys = np.concatenate([piece[0] for piece in pieces])
+                sort = np.argsort(keys, kind='stable')
+                data = {attribute:np.concatenate([piece[1][attribute] for piece in pieces])[sort] for attribute in pieces[0][1].keys()}
+                batch[particle_type] = (keys[sort], data)
+        self.bucket_bytes = sum(chunk[0].nbytes + sum(column.nbytes for column in chunk[1].values()) for chunks in self.buckets.values() for chunk in
+                                chunks)
+
+        for key in batch_keys:
+            galaxy_data = {}
+            for particle_type in self.particle_attributes.keys():
+                if particle_type in batch:
+                    keys, data = batch[particle_type]
+                    start, stop = np.searchsorted(keys, [key, key + 1], side='left')
+                    galaxy_data[particle_type] = {attribute:column[start:stop] for attribute, column in data.items()}
+                else:
+                    galaxy_data[particle_type] = {attribute:np.copy(column) for attribute, column in self.templates.get(particle_type, {
+                        attribute:np.array([]) for attribute in self.particle_attributes[particle_type]}).items()}
+            self.n_finalised += 1
+            yield int(key // 2 ** 32), int(key % 2 ** 32), galaxy_data
+
+
+class SubfindCatalogue:
+    """
+    Persistent local cache of SUBFIND header, subhalo and FOF attributes keyed by simulation path and tag. Attributes are read from the
+    eagle_subfind_tab files on first request only and each one is read again whenever any of these files is modified. Each attribute is
+    cached in its own file, so concurrent jobs which add attributes never overwrite each other's.
+    """
+
+
+    def __init__(self, simulation_path, tag, cache_path):
+        """
+        A constructor method for the class.
+        :param simulation_path: simulation directory.
+        :param tag: redshift directory.
+        :param cache_path: directory of the cache files.
+        """
+        self.simulation_path = simulation_path
+        self.tag = tag
+        self.cache_path = cache_path + re.sub(r'[^A-Za-z0-9]+', '_', simulation_path.strip('/')) + '_' + tag + '/'
+        os.makedirs(self.cache_path, exist_ok=True)
+
+        # Record the modification times of the SUBFIND files the cache is built from #
+        source_files = sorted(glob.glob(simulation_path + 'groups_' + tag + '/eagle_subfind_tab_' + tag + '.*.hdf5'))
+        self.source_mtimes = np.array([os.path.getmtime(file_name) for file_name in source_files], dtype=np.float64)
+
+
+    def get_file_name(self, group, attribute):
+        """
+        Get the cache file of an attribute.
+        :param group: 'Header', 'Subhalo' or 'FOF'.
+        :param attribute: attribute name.
+        :return: file_name
+        """
+        return self.cache_path + group + '_' + re.sub(r'[^A-Za-z0-9]+', '_', attribute) + '.hdf5'
+
+
+    def load(self, group, attribute):
+        """
+        Load an attribute from the cache if it was cached from the current SUBFIND files.
+        :param group: 'Header', 'Subhalo' or 'FOF'.
+        :param attribute: attribute name.
+        :return: values (None if the attribute is not cached or its cache is stale)
+        """
+        try:
+            with h5py.File(self.get_file_name(group, attribute), 'r') as f:
+                if f.attrs.get('attribute') != attribute or not np.array_equal(f.attrs.get('source_mtimes'), self.source_mtimes):
+                    return None
+                values = f['values'][()]
+        except OSError:  # A missing (or unreadable) cache file.
+            return None
+        return values
+
+
+    def read(self, group, attributes):
+        """
+        Read attributes of a SUBFIND group from the cache and add those which are not cached yet (or whose cache is stale).
+        :param group: 'Header', 'Subhalo' or 'FOF'.
+        :param attributes: attribute names.
+        :return: data
+        """
+        data = {}
+        for attribute in attributes:
+            data[attribute] = self.load(group, attribute)
+
+            # Read a missing attribute in h-free physical CGS units from the snapshot and add it to the cache #
+            if data[attribute] is None:
+                if group == 'Header':
+                    data[attribute] = E.read_header('SUBFIND', self.simulation_path, self.tag, attribute)
+                else:
+                    data[attribute] = E.read_array('SUBFIND', self.simulation_path, self.tag, '/' + group + '/' + attribute, numThreads=8)
+                self.write(group, attribute, data[attribute])
+
+        return data
+
+
+    def write(self, group, attribute, values):
+        """
+        Add an attribute to the cache. It is written in a temporary file which then replaces any stale one, so that concurrent readers never see
+        a partially written file and concurrent writers (which write the same values) never fail.
+        :param group: 'Header', 'Subhalo' or 'FOF'.
+        :param attribute: attribute name.
+        :param values: array.
+        :return: None
+        """
+        def write(tmp_file_name):
+            with h5py.File(tmp_file_name, 'w') as f:
+                f.create_dataset('values', data=values)
+                f.attrs['attribute'] = attribute
+                f.attrs['simulation_path'] = self.simulation_path
+                f.attrs['tag'] = self.tag
+                f.attrs['source_mtimes'] = self.source_mtimes
+
+        atomic_write(self.get_file_name(group, attribute), write)
+        return None
+
+
+    def read_header(self, attributes):
+        """
+        Read header attributes.
+        :param attributes: attribute names.
+        :return: box_data
+        """
+        return self.read('Header', attributes)
+
+
+    def read_subhalo(self, attributes):
+        """
+        Read subhalo attributes.
+        :param attributes: attribute names.
+        :return: subhalo_data
+        """
+        return self.read('Subhalo', attributes)
+
+
+    def read_FOF(self, attributes):
+        """
+        Read FOF attributes.
+        :param attributes: attribute names.
+        :return: FOF_data
+        """
+        return self.read('FOF', attributes)
+
+
+    def select_subhaloes(self, attributes, predicate):
+        """
+        Read subhalo attributes and select the subhaloes which satisfy a predicate.
+        :param attributes: attribute names.
+        :param predicate: function which takes the subhalo data dictionary and returns a boolean mask.
+        :return: subhalo_data_tmp
+        """
+        subhalo_data = self.read_subhalo(attributes)
+        halo_mask = predicate(subhalo_data)
+        return {attribute:values[halo_mask] for attribute, values in subhalo_data.items()}
@@ -10,7 +10,7 @@ import plot_tools
 matplotlib.use('Agg')
 
 import numpy as np
-import healpy as hlp
+import healpix_tools
 import matplotlib.cbook
 import astropy.units as u
 import matplotlib.pyplot as plt
@@ -18,6 +18,8 @@ import matplotlib.style as style
 
 from astropy_healpix import HEALPix
 from plot_tools import RotateCoordinates
+from galaxy_catalogue import GalaxyCatalogue
+from morpho_kinematics import MorphoKinematic
 
 style.use("classic")
 plt.rcParams.update({'font.family':'serif'})
@@ -43,7 +45,8 @@ class TestRAEl:
         figure, axes = plt.subplots(nrows=10, ncols=10, figsize=(20, 20), subplot_kw={'projection':'mollweide'})
 
         # Select a random sample from all group numbers #
-        group_numbers = np.load(data_path + '/group_numbers.npy')
+        catalogue = GalaxyCatalogue(data_path + 'galaxy_catalogue.hdf5')
+        group_numbers = catalogue.load('group_numbers')
         group_numbers_sample = random.sample(list(group_numbers), 100)
 
         # for i, axis in enumerate(axes.flatten()):
@@ -140,11 +143,7 @@ class TestRAEl:
         cbar.ax.tick_params(labelsize=15)
 
         # Perform a top-hat smoothing on the densities #
-        smoothed_densities = np.zeros(hp.npix)
-        # Loop over all grid cells #
-        for i in range(hp.npix):
-            mask = hlp.query_disc(nside, hlp.pix2vec(nside, i), np.pi / 6.0)  # Do a 30degree cone search around each grid cell.
-            smoothed_densities[i] = np.mean(densities[mask])  # Average the densities of the ones inside and assign this value to the grid cell.
+        smoothed_densities = healpix_tools.smooth(densities, nside)  # Average the densities within a 30degree cone around each grid cell.
 
         # Find the location of the density maximum and plot its positions and the ra and el of the galactic angular momentum #
         index_densest = np.argmax(smoothed_densities)
@@ -155,9 +154,9 @@ class TestRAEl:
         angular_theta_from_densest = np.arccos(
             np.sin(lat_densest) * np.sin(np.arcsin(prc_unit_vector[:, 2])) + np.cos(lat_densest) * np.cos(np.arcsin(prc_unit_vector[:, 2])) * np.cos(
                 lon_densest - np.arctan2(prc_unit_vector[:, 1], prc_unit_vector[:, 0])))  # In radians.
-        disc_mask = np.where(angular_theta_from_densest < (np.pi / 6.0))
+        disc_mask = np.where(angular_theta_from_densest < MorphoKinematic.disc_angle)
         glx_disc_fractions_IT20 = np.divide(np.sum(stellar_data_tmp['Mass'][disc_mask]), np.sum(stellar_data_tmp['Mass']))
-        chi = 0.5 * (1 - np.cos(np.pi / 6))
+        chi = MorphoKinematic.isotropic_disc_fraction(MorphoKinematic.disc_angle)
         glx_disc_fractions_IT20 = np.divide(1, 1 - chi) * (glx_disc_fractions_IT20 - chi)
 
         disc_fractions.append(glx_disc_fractions_IT20)
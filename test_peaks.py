@@ -0,0 +1,90 @@
+import time
+
+import numpy as np
+
+from galaxy_view import GalaxyView
+from read_add_attributes import AddAttributes
+
+start_global_time = time.time()  # Start the global time.
+
+
+class TestPeaks:
+    """
+    Check AddAttributes.peak_decomposition on synthetic galaxies: single discs with random orientations (and polar discs) have exactly one peak,
+    two counter-rotating discs have two peaks in the order of their masses and isotropic galaxies have no peak.
+    """
+
+
+    def __init__(self, n_galaxies=200, seed=0):
+        """
+        A constructor method for the class.
+        :param n_galaxies: number of synthetic galaxies of each kind.
+        :param seed: seed of the random number generator.
+        """
+        rng = np.random.default_rng(seed)
+        failures = []
+        for i in range(n_galaxies):
+            # Generate a rotating disc and rotate it to a random (or, for every fourth galaxy, a polar) orientation #
+            n_particles = int(rng.integers(200, 20000))
+            rotation = self.get_rotation(rng) if i % 4 else np.array([[1.0, 0.0, 0.0], [0.0, 0.0, -1.0], [0.0, 1.0, 0.0]])
+            stellar_view = self.get_discs(rng, n_particles, rotation)
+            peak_unit_vectors, peak_significances, peak_masses, peak_index = AddAttributes.peak_decomposition(stellar_view)
+            if len(peak_significances) != 1:
+                failures.append('Single disc ' + str(i) + ' with ' + str(n_particles) + ' particles has peaks with masses ' + str(peak_masses))
+
+            # Generate two counter-rotating discs with 70 and 30 per cent of the mass #
+            n_particles = int(rng.integers(2000, 20000))
+            stellar_view = self.get_discs(rng, n_particles, self.get_rotation(rng), counter_fraction=0.3)
+            peak_unit_vectors, peak_significances, peak_masses, peak_index = AddAttributes.peak_decomposition(stellar_view)
+            glx_unit_vector = stellar_view.rotated_X[3]  # The peaks are in the frame of stellar_view.rotated_X.
+            if len(peak_significances) != 2 or np.dot(peak_unit_vectors[0], glx_unit_vector) < np.cos(np.pi / 6.0) or np.dot(
+                peak_unit_vectors[1], -glx_unit_vector) < np.cos(np.pi / 6.0) or np.abs(peak_masses[0] / n_particles - 0.7) > 0.1:
+                failures.append('Counter-rotating discs ' + str(i) + ' with ' + str(n_particles) + ' particles have peaks at ' + str(
+                    peak_unit_vectors) + ' with masses ' + str(peak_masses))
+
+            # Generate an isotropic galaxy #
+            n_particles = int(rng.integers(200, 20000))
+            stellar_view = GalaxyView({'Coordinates':rng.normal(size=(n_particles, 3)) * 3.0, 'Velocity':rng.normal(size=(n_particles, 3)) * 150.0,
+                                       'Mass':np.ones(n_particles)})
+            peak_unit_vectors, peak_significances, peak_masses, peak_index = AddAttributes.peak_decomposition(stellar_view)
+            if len(peak_significances) != 0:
+                failures.append('Isotropic galaxy ' + str(i) + ' with ' + str(n_particles) + ' particles has peaks with masses ' + str(peak_masses))
+
+        for failure in failures:
+            print(failure)
+        assert len(failures) == 0, str(len(failures)) + ' of ' + str(3 * n_galaxies) + ' galaxies do not have the expected peaks'
+
+        print('Finished TestPeaks in %.4s s' % (time.time() - start_global_time))
+        print('–––––––––––––––––––––––––––––––––––––––––––––')
+
+
+    @staticmethod
+    def get_discs(rng, n_particles, rotation, counter_fraction=0.0):
+        """
+        Generate a rotating disc with a velocity dispersion, where a fraction of the particles counter-rotates, and rotate it.
+        :param rng: random number generator.
+        :param n_particles: number of particles.
+        :param rotation: rotation matrix.
+        :param counter_fraction: fraction of the particles that counter-rotates.
+        :return: GalaxyView
+        """
+        coordinates = rng.normal(size=(n_particles, 3)) * [5.0, 5.0, 0.3]  # In kpc.
+        sense = np.where(np.arange(n_particles) < counter_fraction * n_particles, -1.0, 1.0)[:, np.newaxis]
+        velocities = sense * np.cross([0.0, 0.0, 1.0], coordinates) * 20.0 + rng.normal(size=(n_particles, 3)) * rng.uniform(20.0, 80.0)  # In km/s.
+        return GalaxyView({'Coordinates':coordinates @ rotation.T, 'Velocity':velocities @ rotation.T, 'Mass':np.ones(n_particles)})
+
+
+    @staticmethod
+    def get_rotation(rng):
+        """
+        Get a random rotation matrix from the QR decomposition of a Gaussian matrix.
+        :param rng: random number generator.
+        :return: rotation
+        """
+        q, r = np.linalg.qr(rng.normal(size=(3, 3)))
+        rotation = q * np.sign(np.diag(r))
+        return rotation * np.sign(np.linalg.det(rotation))
+
+
+if __name__ == '__main__':
+    x = TestPeaks()
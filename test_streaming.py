@@ -0,0 +1,113 @@
+import os
+import time
+import h5py
+import shutil
+import tempfile
+
+import numpy as np
+
+from snapshot_tools import StreamingReader
+
+start_global_time = time.time()  # Start the global time.
+
+
+class TestStreaming:
+    """
+    For synthetic eagle_subfind_particles files without black hole particles and with gas particles only in the last file: check that
+    StreamingReader.stream_galaxies returns every selected galaxy with all its particles and finalises galaxies before the last file is read.
+    """
+
+
+    def __init__(self, n_files=4, n_groups=40, seed=0):
+        """
+        A constructor method for the class.
+        :param n_files: number of particle files.
+        :param n_groups: number of groups (split evenly among the files).
+        :param seed: seed of the random number generator.
+        """
+        rng = np.random.default_rng(seed)
+        path = tempfile.mkdtemp() + '/'
+        try:
+            particle_counts = self.write_files(path, rng, n_files, n_groups)
+            keys = sorted(key for key in particle_counts.keys() if particle_counts[key]['4'] > 0)
+            group_numbers, subgroup_numbers = np.array([key[0] for key in keys]), np.array([key[1] for key in keys])
+
+            for memory_budget in [4e9, 1e4]:  # Keep all buckets in memory or spill them to disk.
+                self.n_opened = 0
+                particle_attributes = {particle_type:['Mass'] for particle_type in ['0', '1', '4', '5']}
+                streaming_reader = StreamingReader(path, 'T', group_numbers, subgroup_numbers, particle_attributes, path + 'spill/',
+                                                   memory_budget=memory_budget)
+                streaming_reader.file_names = self.count_opened(streaming_reader.file_names)
+
+                n_opened = []
+                for group_number, subgroup_number, galaxy_data in streaming_reader.stream_galaxies():
+                    n_opened.append(self.n_opened)
+                    for particle_type, counts in particle_counts[(group_number, subgroup_number)].items():
+                        assert len(galaxy_data[particle_type]['Mass']) == counts, 'Galaxy ' + str(group_number) + '_' + str(
+                            subgroup_number) + ' has ' + str(len(galaxy_data[particle_type]['Mass'])) + ' instead of ' + str(
+                            counts) + ' particles of type ' + particle_type
+
+                assert len(n_opened) == len(keys), str(len(n_opened)) + ' of ' + str(len(keys)) + ' galaxies were returned'
+                assert n_opened[0] < n_files, 'No galaxy was finalised before the last file was read'
+        finally:
+            shutil.rmtree(path)
+
+        print('Finished TestStreaming in %.4s s' % (time.time() - start_global_time))
+        print('–––––––––––––––––––––––––––––––––––––––––––––')
+
+
+    def count_opened(self, file_names):
+        """
+        Count the particle files the reader has opened so far.
+        :param file_names: names of the particle files.
+        :return: generator of file_name
+        """
+        for file_name in file_names:
+            self.n_opened += 1
+            yield file_name
+
+
+    @staticmethod
+    def write_files(path, rng, n_files, n_groups):
+        """
+        Write the particle files of a snapshot with dark matter and stellar particles in every group, gas particles only in the groups of the last
+        file and no black hole particles.
+        :param path: simulation directory.
+        :param rng: random number generator.
+        :param n_files: number of particle files.
+        :param n_groups: number of groups (split evenly among the files).
+        :return: particle_counts
+        """
+        particle_counts = {}  # Dictionary of (group_number, subgroup_number): {particle_type: number of particles}.
+        group_numbers = {particle_type:[] for particle_type in ['0', '1', '4']}
+        subgroup_numbers = {particle_type:[] for particle_type in ['0', '1', '4']}
+        for group_number in range(1, n_groups + 1):
+            for subgroup_number in range(int(rng.integers(1, 4))):
+                counts = {'0':int(rng.integers(0, 20)) if group_number > n_groups - n_groups // n_files else 0, '1':int(rng.integers(0, 30)),
+                          '4':int(rng.integers(0, 30)), '5':0}
+                particle_counts[(group_number, subgroup_number)] = counts
+                for particle_type in group_numbers.keys():
+                    group_numbers[particle_type] += [group_number] * counts[particle_type]
+                    subgroup_numbers[particle_type] += [subgroup_number] * counts[particle_type]
+
+        os.makedirs(path + 'particledata_T/')
+        for i in range(n_files):
+            with h5py.File(path + 'particledata_T/eagle_subfind_particles_T.' + str(i) + '.hdf5', 'w') as f:
+                n_particles = np.zeros(6, dtype=int)
+                for particle_type in group_numbers.keys():
+                    file_groups = np.array(group_numbers[particle_type])
+                    mask, = np.where((file_groups > i * n_groups // n_files) & (file_groups <= (i + 1) * n_groups // n_files))
+                    n_particles[int(particle_type)] = len(mask)
+                    if len(mask) == 0:
+                        continue
+                    columns = {'GroupNumber':file_groups[mask], 'SubGroupNumber':np.array(subgroup_numbers[particle_type])[mask],
+                               'Mass':rng.random(len(mask))}
+                    for attribute, column in columns.items():
+                        dataset = f.create_dataset('PartType' + particle_type + '/' + attribute, data=column)
+                        dataset.attrs.update({'CGSConversionFactor':1.0, 'aexp-scale-exponent':0.0, 'h-scale-exponent':0.0})
+                f.create_group('Header').attrs.update({'NumPart_ThisFile':n_particles, 'ExpansionFactor':1.0, 'HubbleParam':1.0})
+        return particle_counts
+
+
+if __name__ == '__main__':
+    x = TestStreaming()